@@ -0,0 +1,780 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Бенчмарки Ollama Tray Chat (без GUI и без запущенной Ollama).
+
+Запуск:
+  python3 benchmark.py history            # время возобновления сессии vs размер архива
+  python3 benchmark.py deny               # проверка команды vs число правил чёрного списка
+  python3 benchmark.py commands           # извлечение команд: стрим vs разбор всего ответа
+  python3 benchmark.py shell              # серия мелких команд: процесс на каждую vs общий shell
+  python3 benchmark.py pipeline           # весь путь ответа через окно (offscreen) и мок Ollama
+  python3 benchmark.py pipeline --save-baseline bench.json   # записать эталон
+  python3 benchmark.py pipeline --baseline bench.json        # сравнить с эталоном (код 1 при регрессии)
+  python3 benchmark.py backends           # пул из нескольких мок‑серверов: маршрутизация и failover
+  python3 benchmark.py memory             # поиск по памяти прошлых разговоров (нужен numpy)
+"""
+from __future__ import annotations
+import argparse
+import json
+import os
+import random
+import re
+import resource
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional
+
+# Пути конфига и истории вычисляются при импорте ollama_core: бенчмарки
+# работают во временном HOME и не трогают настоящие данные пользователя
+if __name__ == "__main__":
+    BENCH_HOME = tempfile.mkdtemp(prefix="otc-bench-home-")
+    os.environ["HOME"] = BENCH_HOME
+
+from ollama_core import NEW_CHAT_MARKER, CommandExtractor, DenyMatcher, HistoryLog, ShellSession
+
+
+def _timeit(fn, repeat: int) -> float:
+    """Медианное время вызова в миллисекундах."""
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - t0) * 1000)
+    times.sort()
+    return times[len(times) // 2]
+
+
+# ====== Журнал истории ======
+def bench_history(args):
+    """Возобновление последней сессии должно стоить одинаково при любом размере архива."""
+    print(f"{'записей':>10} {'сегментов':>10} {'на диске':>10} {'resume, мс':>11} {'диапазон, мс':>13}")
+    for total in args.sizes:
+        tmp = tempfile.mkdtemp(prefix="otc-bench-")
+        try:
+            log = HistoryLog(os.path.join(tmp, "history"), legacy_path=None,
+                             segment_bytes=args.segment_kb * 1024)
+            batch = []
+            for i in range(total):
+                if i % args.session_len == 0:
+                    rec = {"ts": i, "role": "system", "content": NEW_CHAT_MARKER}
+                else:
+                    role = "user" if i % 2 else "assistant"
+                    rec = {"ts": i, "role": role, "content": f"сообщение {i} " + "текст " * 20}
+                batch.append((json.dumps(rec, ensure_ascii=False) + "\n").encode("utf-8"))
+                if len(batch) >= 1000:
+                    log.append_lines(batch)
+                    batch = []
+            if batch:
+                log.append_lines(batch)
+            log.wait_idle()
+
+            resume_ms = _timeit(log.last_session, args.repeat)
+            # Узкий диапазон времени в середине архива
+            mid = total // 2
+            range_ms = _timeit(lambda: log.read_range(mid, mid + 50), args.repeat)
+            disk = sum(os.path.getsize(os.path.join(tmp, "history", f))
+                       for f in os.listdir(os.path.join(tmp, "history")))
+            print(f"{total:>10} {len(log.segments()):>10} {disk / 1e6:>8.1f}МБ "
+                  f"{resume_ms:>11.2f} {range_ms:>13.2f}")
+            log.close()
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+
+# ====== Чёрный список команд ======
+# Типичные команды из ответов модели: почти все разрешены
+DENY_SAMPLE_COMMANDS = [
+    "ls -la", "git status", "sudo systemctl restart nginx", "journalctl -u ollama -f",
+    "docker ps -a", "pip install requests", "grep -rn TODO src/", "cat /etc/os-release",
+    "find . -name '*.py' | xargs wc -l", "rm -rf build/", "curl -s https://example.com | jq .",
+    "sudo pacman -Syu", "tar xzf archive.tar.gz", "echo $PATH", "dd if=/dev/zero of=/dev/sda",
+]
+
+
+def _synthetic_rules(count: int, seed: int = 1) -> list:
+    """Правила в духе стандартного списка: в основном с литералом, изредка без."""
+    rnd = random.Random(seed)
+    rules = []
+    for i in range(count):
+        kind = rnd.random()
+        if kind < 0.6:
+            rules.append(rf"\btool{i}\b.*\s-f\b")
+        elif kind < 0.9:
+            rules.append(rf">\s*/srv/area{i}/")
+        else:
+            rules.append(rf"\b(cmd{i}a|cmd{i}b)\s+-[xyz]")
+    return rules
+
+
+def bench_deny(args):
+    """Цена проверки команды не должна расти вместе с числом правил."""
+    print(f"{'правил':>8} {'перебор, мкс':>14} {'DenyMatcher, мкс':>17} {'сборка, мс':>11}")
+    commands = DENY_SAMPLE_COMMANDS
+    for count in args.rules:
+        rules = _synthetic_rules(count)
+
+        # Старый путь: re.search по каждому правилу (кэш re внутри берёт своё)
+        def naive():
+            for cmd in commands:
+                for pat in rules:
+                    try:
+                        if re.search(pat, cmd, flags=re.I):
+                            break
+                    except re.error:
+                        continue
+
+        build_ms = _timeit(lambda: DenyMatcher(rules), max(1, args.repeat // 5))
+        matcher = DenyMatcher(rules)
+        # Результаты обязаны совпадать с перебором
+        for cmd in commands:
+            expected = any(re.search(p, cmd, re.I) for p in rules)
+            assert (matcher.match(cmd) is not None) == expected, cmd
+
+        naive_us = _timeit(naive, args.repeat) * 1000 / len(commands)
+        fast_us = _timeit(lambda: matcher.check_many(commands), args.repeat) * 1000 / len(commands)
+        print(f"{count:>8} {naive_us:>14.1f} {fast_us:>17.1f} {build_ms:>11.1f}")
+
+
+# ====== Извлечение команд ======
+def legacy_parse_commands(text: str) -> list:
+    """Прежний MainWindow.parse_commands: три полных прохода по ответу."""
+    cmds = []
+    if not text:
+        return cmds
+    code_blocks = re.findall(r"```(?:bash|sh|fish)?\s*\n(.*?)```", text, flags=re.S | re.I)
+    for block in code_blocks:
+        for line in block.splitlines():
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if line.startswith("$ ") or line.startswith("> "):
+                line = line[2:].strip()
+            if line:
+                cmds.append(line)
+    for cmd in re.findall(r"`([^`\n]+)`", text):
+        cmd = cmd.strip()
+        parts = cmd.split()
+        if parts and re.match(r"^[a-z0-9_\-./]+$", parts[0], flags=re.I):
+            if cmd not in cmds and len(cmd) < 200:
+                cmds.append(cmd)
+    for line in text.splitlines():
+        s = line.strip()
+        if s.startswith("$ ") or s.startswith("> "):
+            candidate = s[2:].strip()
+            if candidate and candidate not in cmds:
+                cmds.append(candidate)
+        elif s.startswith("sudo ") and s not in cmds:
+            cmds.append(s)
+    return list(dict.fromkeys(cmds))
+
+
+def _synthetic_answer(size: int, seed: int = 1) -> str:
+    """Ответ модели: проза с `инлайн-кодом`, блоки bash и изредка python."""
+    rnd = random.Random(seed)
+    parts, total, n = [], 0, 0
+    while total < size:
+        kind = rnd.random()
+        n += 1
+        if kind < 0.15:
+            body = "\n".join(f"$ tool{n}-{i} --flag {i}" if i % 3 == 0 else f"cmd{n} arg{i}"
+                             for i in range(rnd.randint(2, 8)))
+            chunk = f"```bash\n# шаг {n}\n{body}\n```\n"
+        elif kind < 0.2:
+            chunk = f"```\nsudo systemctl restart svc{n}\n```\n"
+        else:
+            chunk = (f"Проверьте вывод `ls -la /srv/dir{n}` и при необходимости "
+                     f"выполните `grep -rn pattern{n} .` — это обычный текст абзаца.\n")
+        parts.append(chunk)
+        total += len(chunk)
+    return "".join(parts)
+
+
+def _token_chunks(text: str, size: int = 4) -> list:
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def bench_commands(args):
+    """Стрим не должен стоить больше, чем один разбор готового ответа, и делится на дельты."""
+    print(f"{'ответ, КБ':>10} {'разбор целиком, мс':>19} {'стрим всего, мс':>16} "
+          f"{'на дельту, мкс':>15} {'команд':>7} {'совпадают':>10}")
+    for kb in args.sizes:
+        text = _synthetic_answer(kb * 1024)
+        chunks = _token_chunks(text)
+
+        def streamed():
+            ex = CommandExtractor()
+            for delta in chunks:
+                ex.feed(delta)
+            ex.finish()
+            return ex.commands
+
+        legacy_ms = _timeit(lambda: legacy_parse_commands(text), args.repeat)
+        stream_ms = _timeit(streamed, args.repeat)
+        same = set(streamed()) == set(legacy_parse_commands(text))
+        print(f"{kb:>10} {legacy_ms:>19.2f} {stream_ms:>16.2f} "
+              f"{stream_ms * 1000 / len(chunks):>15.2f} {len(streamed()):>7} {'да' if same else 'нет':>10}")
+
+
+# ====== Выполнение команд ======
+DIAGNOSTIC_COMMANDS = ["uname -r", "cat /proc/loadavg", "echo $HOME", "ls /", "id -u", "true"]
+
+
+def bench_shell(args):
+    """Пачка диагностических команд: отдельный Popen на каждую vs один shell на pty."""
+    commands = (DIAGNOSTIC_COMMANDS * (args.count // len(DIAGNOSTIC_COMMANDS) + 1))[:args.count]
+
+    def per_process():
+        for cmd in commands:
+            subprocess.run(shlex.split(cmd), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    shell = ShellSession()
+    shell.run("true")  # запуск shell не входит в замер — он один на разговор
+
+    def in_shell():
+        for cmd in commands:
+            shell.run(cmd, timeout=10)
+
+    proc_ms = _timeit(per_process, args.repeat)
+    shell_ms = _timeit(in_shell, args.repeat)
+    shell.close()
+    print(f"{'способ':>22} {'всего, мс':>10} {'на команду, мс':>15}")
+    print(f"{'процесс на команду':>22} {proc_ms:>10.1f} {proc_ms / len(commands):>15.2f}")
+    print(f"{'общий shell (pty)':>22} {shell_ms:>10.1f} {shell_ms / len(commands):>15.2f}")
+
+
+# ====== Весь путь ответа ======
+class MockOllama:
+    """Локальная замена Ollama: /api/chat отдаёт NDJSON‑стрим заданного
+    размера с заданной скоростью (rate=0 — без пауз).
+
+    Текст ответа — синтетический (проза, `инлайн‑код`, блоки bash), чтобы
+    извлечение и проверка команд работали на реалистичной смеси.
+    /api/embed — «мешок слов» с хэшированием в EMBED_DIM измерений:
+    тексты с общими словами близки, как у настоящей модели эмбеддингов.
+    """
+
+    MODELS = ["bench:1b", "bench:7b"]
+    EMBED_DIM = 256
+
+    def __init__(self, tokens: int = 1000, token_chars: int = 4, rate: float = 0.0,
+                 models: Optional[List[str]] = None):
+        self.tokens = tokens
+        self.token_chars = token_chars
+        self.rate = rate
+        self.models = models or self.MODELS
+        self.requests = 0
+        # down=True — сервер «упал»: идущие стримы обрываются, новые соединения отвергаются
+        self.down = False
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *_):
+                pass
+
+            def _json(self, obj: dict, code: int = 200):
+                body = json.dumps(obj).encode("utf-8")
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path == "/api/tags":
+                    self._json({"models": [{"name": m, "digest": m, "size": 1} for m in mock.models]})
+                elif self.path == "/api/ps":
+                    self._json({"models": [{"name": mock.models[0]}]})
+                else:
+                    self._json({}, 404)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if self.path == "/api/chat":
+                    request = json.loads(body or b"{}")
+                    model = request.get("model")
+                    if model not in mock.models:
+                        self._json({"error": f"model '{model}' not found"}, 404)
+                        return
+                    mock.requests += 1
+                    messages = request.get("messages") or [{}]
+                    # Последнее сообщение assistant — продолжение оборванного ответа
+                    prefill = messages[-1].get("content", "") if messages[-1].get("role") == "assistant" else ""
+                    mock.stream_chat(self, skip=len(prefill))
+                elif self.path == "/api/embed":
+                    texts = json.loads(body or b"{}").get("input") or []
+                    self._json({"embeddings": [mock.embed(t) for t in texts]})
+                elif self.path == "/api/show":
+                    self._json({"details": {"parameter_size": "1B"}, "model_info": {"llama.context_length": 8192}})
+                else:
+                    self._json({"done": True})
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        # Обрывы соединений при «падении» сервера ожидаемы — без трассировок в stderr
+        self.server.handle_error = lambda *_: None
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self) -> "MockOllama":
+        self.thread.start()
+        return self
+
+    def __exit__(self, *_):
+        if not self.down:
+            self.kill()
+
+    def kill(self):
+        """Имитация падения сервера."""
+        self.down = True
+        self.server.shutdown()
+        self.server.server_close()
+
+    def embed(self, text: str) -> list:
+        vec = [0.0] * self.EMBED_DIM
+        for word in re.findall(r"\w+", text.lower()):
+            h = zlib.crc32(word.encode("utf-8"))
+            vec[h % self.EMBED_DIM] += 1.0 if h & 1 << 31 else -1.0
+        return vec
+
+    def reply_chunks(self) -> list:
+        text = _synthetic_answer(self.tokens * self.token_chars)
+        return _token_chunks(text, self.token_chars)[:self.tokens]
+
+    def stream_chat(self, handler: BaseHTTPRequestHandler, skip: int = 0):
+        handler.send_response(200)
+        handler.send_header("Content-Type", "application/x-ndjson")
+        handler.send_header("Transfer-Encoding", "chunked")
+        handler.end_headers()
+
+        def send(obj: dict):
+            data = (json.dumps(obj, ensure_ascii=False) + "\n").encode("utf-8")
+            handler.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+
+        t0 = time.perf_counter()
+        chunks = self.reply_chunks()
+        if skip:
+            text = "".join(chunks)[skip:]
+            chunks = _token_chunks(text, self.token_chars) if text else []
+        for i, delta in enumerate(chunks):
+            if self.down:
+                # Обрыв посреди ответа: без завершающего чанка
+                handler.close_connection = True
+                handler.connection.shutdown(2)
+                return
+            if self.rate:
+                # Держим темп по абсолютному времени, а не sleep на каждый токен
+                delay = t0 + i / self.rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            send({"message": {"role": "assistant", "content": delta}, "done": False})
+        elapsed = int((time.perf_counter() - t0) * 1e9)
+        send({"done": True, "eval_count": len(chunks), "eval_duration": max(1, elapsed),
+              "prompt_eval_count": 32, "prompt_eval_duration": 10 ** 6, "load_duration": 0})
+        handler.wfile.write(b"0\r\n\r\n")
+
+
+# (ключ, подпись, единицы, что лучше: "higher" / "lower")
+PIPELINE_METRICS = [
+    ("stream_tok_s", "стрим через окно", "ток/с", "higher"),
+    ("ttft_ms", "до первого токена", "мс", "lower"),
+    ("gui_ms_per_signal", "on_chunk в GUI", "мс/сигнал", "lower"),
+    ("gui_busy_pct", "занятость GUI‑потока", "%", "lower"),
+    ("loop_lag_max_ms", "макс. задержка цикла событий", "мс", "lower"),
+    ("parse_mb_s", "parse_commands", "МБ/с", "higher"),
+    ("allowed_us", "is_command_allowed", "мкс/команда", "lower"),
+    ("writer_rec_s", "фоновая запись истории", "зап/с", "higher"),
+    ("rss_growth_mb", "рост RSS за прогон", "МБ", "lower"),
+]
+
+
+def _rss_mb() -> float:
+    # ru_maxrss в Linux — в килобайтах
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _run_pipeline(args, mock: MockOllama) -> dict:
+    """Один прогон: окно приложения offscreen, ответы идут из mock."""
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PyQt6 import QtCore, QtWidgets
+    import ollama_core
+    import ollama_tray_chat as app_mod
+
+    ollama_core.set_client(ollama_core.OllamaClient(base_url=mock.url))
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication(sys.argv[:1])
+    window = app_mod.MainWindow()
+    window.state.chunk_mode = args.chunk_mode
+    # Спрашиваем модель из списка мока, а не сохранённую в конфиге
+    if window.models_loader is not None:
+        window.models_loader.wait()
+    app.processEvents()
+
+    # Замер времени GUI‑потока внутри on_chunk: обёртка ставится до on_send,
+    # который подключает сигналы воркера к self.on_chunk
+    gui = {"time": 0.0, "signals": 0}
+    original_on_chunk = window.on_chunk
+
+    def timed_on_chunk(tab, delta):
+        t0 = time.perf_counter()
+        original_on_chunk(tab, delta)
+        gui["time"] += time.perf_counter() - t0
+        gui["signals"] += 1
+
+    errors = []
+    window.on_chunk = timed_on_chunk
+    window.on_failed = lambda tab, err: errors.append(err)
+
+    # Задержка цикла событий: таймер на 10 мс и фактические интервалы
+    lag = {"max": 0.0, "last": None}
+
+    def probe():
+        now = time.perf_counter()
+        if lag["last"] is not None:
+            lag["max"] = max(lag["max"], now - lag["last"] - 0.010)
+        lag["last"] = now
+
+    timer = QtCore.QTimer()
+    timer.setInterval(10)
+    timer.timeout.connect(probe)
+
+    rss0 = _rss_mb()
+    stream_times, ttfts, tokens = [], [], 0
+    timer.start()
+    for i in range(args.repeat):
+        tab = window.tab
+        window.input.setPlainText(f"вопрос {i}")
+        window.on_send()
+        loop = QtCore.QEventLoop()
+        tab.worker.finished.connect(loop.quit)
+        if tab.busy:
+            loop.exec()
+        app.processEvents()
+        timing = tab.worker.timing
+        if timing.total:
+            stream_times.append(timing.total)
+            tokens += timing.deltas
+        if timing.ttft is not None:
+            ttfts.append(timing.ttft * 1000)
+        window.new_chat()
+    timer.stop()
+    if errors:
+        raise SystemExit(f"Ошибка стрима: {errors[0]}")
+
+    # parse_commands и is_command_allowed — на полном тексте ответа
+    text = "".join(mock.reply_chunks())
+    parse_ms = _timeit(lambda: window.parse_commands(text), 5)
+    commands = window.parse_commands(text) or ["ls -la"]
+    allowed_ms = _timeit(lambda: [window.is_command_allowed(c) for c in commands], 5)
+
+    # Фоновая запись: журнал + хранилище + индекс, до завершения flush()
+    records = args.writer_records
+    session_id = window.store.new_session("bench:1b")
+    t0 = time.perf_counter()
+    for i in range(records):
+        rec = {"ts": int(time.time()), "role": "user" if i % 2 else "assistant", "content": f"запись {i} " * 10}
+        window.writer.append_history(rec, session_id, "bench:1b")
+    window.writer.flush()
+    writer_s = time.perf_counter() - t0
+
+    total_stream = sum(stream_times) or 1e-9
+    result = {
+        "stream_tok_s": tokens / total_stream,
+        "ttft_ms": sorted(ttfts)[len(ttfts) // 2] if ttfts else None,
+        "gui_ms_per_signal": gui["time"] * 1000 / max(1, gui["signals"]),
+        "gui_busy_pct": gui["time"] * 100 / total_stream,
+        "loop_lag_max_ms": lag["max"] * 1000,
+        "parse_mb_s": len(text.encode("utf-8")) / 1e6 / max(1e-9, parse_ms / 1000),
+        "allowed_us": allowed_ms * 1000 / len(commands),
+        "writer_rec_s": records / max(1e-9, writer_s),
+        "rss_growth_mb": _rss_mb() - rss0,
+    }
+    window.job_queue.shutdown()
+    window.writer.close()
+    window.search_index.close()
+    window.store.close()
+    window.history_log.close()
+    window.tray.hide()
+    return result
+
+
+def _compare(result: dict, baseline: dict, tolerance: float) -> list:
+    """Строки отчёта и список регрессий относительно эталона."""
+    regressions = []
+    print(f"{'метрика':>30} {'сейчас':>12} {'эталон':>12} {'изм.':>8}")
+    for key, label, unit, better in PIPELINE_METRICS:
+        now, base = result.get(key), baseline.get(key)
+        if now is None or not base:
+            print(f"{label:>30} {now if now is not None else '—':>12} {'—':>12}")
+            continue
+        change = (now - base) / abs(base) * 100
+        worse = change < -tolerance if better == "higher" else change > tolerance
+        # Абсолютно малые величины шумят: регрессия, только если разница заметна
+        if key in ("loop_lag_max_ms", "rss_growth_mb") and abs(now - base) < 5:
+            worse = False
+        mark = " ⚠️" if worse else ""
+        print(f"{label:>30} {now:>12.2f} {base:>12.2f} {change:>+7.1f}%{mark}  {unit}")
+        if worse:
+            regressions.append(key)
+    return regressions
+
+
+def bench_pipeline(args):
+    """Ответ модели целиком: сеть → ChatWorker → on_chunk → команды → запись истории."""
+    params = {"tokens": args.tokens, "token_chars": args.token_chars, "rate": args.rate,
+              "repeat": args.repeat, "chunk_mode": args.chunk_mode}
+    with MockOllama(args.tokens, args.token_chars, args.rate) as mock:
+        result = _run_pipeline(args, mock)
+
+    print("Параметры: " + ", ".join(f"{k}={v}" for k, v in params.items()))
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            saved = json.load(f)
+        if saved.get("params") != params:
+            print(f"⚠️ Эталон снят с другими параметрами: {saved.get('params')}")
+        regressions = _compare(result, saved.get("results", {}), args.tolerance)
+    else:
+        regressions = []
+        for key, label, unit, _ in PIPELINE_METRICS:
+            value = result.get(key)
+            print(f"{label:>30} {'—' if value is None else f'{value:.2f}':>12}  {unit}")
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump({"params": params, "results": result, "python": sys.version.split()[0],
+                       "ts": int(time.time())}, f, ensure_ascii=False, indent=2)
+        print(f"Эталон записан: {args.save_baseline}")
+    if regressions:
+        print(f"❌ Регрессии (допуск {args.tolerance:.0f}%): {', '.join(regressions)}")
+        sys.exit(1)
+
+
+def bench_backends(args):
+    """Несколько мок‑серверов с разными моделями и скоростью; один падает посреди прогона."""
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PyQt6 import QtCore, QtWidgets
+    import ollama_core
+    import ollama_tray_chat as app_mod
+
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication(sys.argv[:1])
+    specs = [  # (модели, ток/с)
+        (["bench:1b"], args.rate * 2),
+        (["bench:1b", "bench:7b"], args.rate),
+        (["bench:7b"], args.rate),
+    ]
+    mocks = [MockOllama(args.tokens, 4, rate, models).__enter__() for models, rate in specs]
+    pool = ollama_core.get_pool()
+    pool.configure([m.url for m in mocks])
+    pool.check_all()
+
+    def run_batch(count: int, on_started=None) -> list:
+        """count запросов одновременно (модели по очереди); результат — воркеры."""
+        workers, loop = [], QtCore.QEventLoop()
+        left = [count]
+
+        def done():
+            left[0] -= 1
+            if not left[0]:
+                loop.quit()
+
+        for i in range(count):
+            model = ("bench:1b", "bench:7b")[i % 2]
+            state = app_mod.ChatState(model=model)
+            worker = app_mod.ChatWorker(state, f"вопрос {i}", ollama_core.ContextBuilder(budget=8192),
+                                        record=False)
+            worker.failed.connect(lambda err, w=worker: setattr(w, "error", err))
+            worker.error = ""
+            worker.text = []
+            worker.chunk.connect(worker.text.append)
+            worker.finished.connect(done)
+            worker.start()
+            workers.append(worker)
+        if on_started:
+            QtCore.QTimer.singleShot(int(args.kill_after * 1000), on_started)
+        loop.exec()
+        return workers
+
+    def report(title: str, workers: list):
+        ok = [w for w in workers if not w.error]
+        expected = "".join(mocks[0].reply_chunks())
+        complete = sum(1 for w in ok if "".join(w.text) == expected)
+        ttfts = sorted(w.timing.ttft * 1000 for w in ok if w.timing.ttft is not None)
+        by_backend = {}
+        for w in ok:
+            by_backend[w.backend_url] = by_backend.get(w.backend_url, 0) + 1
+        p50 = ttfts[len(ttfts) // 2] if ttfts else float("nan")
+        print(f"\n{title}: успешно {len(ok)}/{len(workers)} (целых ответов {complete}), TTFT p50 {p50:.1f} мс")
+        for w in workers:
+            if w.error:
+                print(f"   ❌ {w.model} @ {w.backend_url}: {w.error[:80]}")
+        print(f"{'сервер':>28} {'модели':>20} {'ответов':>8} {'отказов':>8} {'TTFT EWMA':>10} {'доступен':>9}")
+        for mock, b in zip(mocks, pool.snapshot()):
+            ttft = "—" if b["ttft"] is None else f"{b['ttft'] * 1000:.1f} мс"
+            print(f"{b['url']:>28} {','.join(mock.models):>20} {by_backend.get(b['url'], 0):>8} "
+                  f"{b['failures']:>8} {ttft:>10} {'да' if b['healthy'] else 'нет':>9}")
+
+    report("Все серверы живы", run_batch(args.requests))
+    victim = mocks[1]
+    report(f"Сервер {victim.url} падает через {args.kill_after} с",
+           run_batch(args.requests, on_started=victim.kill))
+    report("После падения (проверка здоровья ещё не прошла)", run_batch(args.requests))
+    pool.check_all()
+    report("После проверки здоровья", run_batch(args.requests))
+    for mock in mocks:
+        mock.__exit__()
+
+
+# ====== Память прошлых разговоров ======
+def _synthetic_embeddings(np, count: int, dim: int, clusters: int, seed: int = 1):
+    """Векторы, похожие на настоящие эмбеддинги: общий сдвиг (пространство
+    анизотропно), темы‑кластеры и шум внутри темы."""
+    rng = np.random.default_rng(seed)
+    offset = rng.normal(size=dim).astype(np.float32) * 0.8
+    centers = rng.normal(size=(clusters, dim)).astype(np.float32)
+    labels = rng.integers(0, clusters, size=count)
+    vectors = offset + centers[labels] + rng.normal(size=(count, dim)).astype(np.float32) * 0.9
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def bench_memory(args):
+    """Поиск по 100k векторов должен укладываться в единицы миллисекунд."""
+    from ollama_core import ConversationStore, MemoryIndex, OllamaClient, memory_available
+    if not memory_available():
+        print("❌ Нужен numpy")
+        return
+    import numpy as np
+    tmp = tempfile.mkdtemp(prefix="otc-bench-memory-")
+    try:
+        vectors = _synthetic_embeddings(np, args.count, args.dim, args.clusters)
+        memory = MemoryIndex(None, "bench", root=tmp, candidates=args.candidates)
+        t0 = time.perf_counter()
+        step = 5000
+        for i in range(0, args.count, step):
+            chunk = vectors[i:i + step]
+            memory._add([(i + j + 1, (i + j) // 40, 0, "", "") for j in range(len(chunk))], chunk.tolist())
+        build_s = time.perf_counter() - t0
+        disk = sum(os.path.getsize(os.path.join(memory.dir, f)) for f in os.listdir(memory.dir))
+        print(f"векторов {memory.count} × {memory.dim}: добавление {build_s:.1f} с, "
+              f"на диске {disk / 1e6:.1f} МБ, в памяти (коды) {memory._codes_t.nbytes / 1e6:.1f} МБ")
+
+        rng = np.random.default_rng(2)
+        picks = rng.integers(0, args.count, size=args.queries)
+        queries = vectors[picks] + rng.normal(size=(args.queries, args.dim)).astype(np.float32) * 0.03
+        k = args.k
+        times, brute, hits = [], [], 0
+        for q in queries:
+            t0 = time.perf_counter()
+            found = memory.search(q, k)
+            times.append((time.perf_counter() - t0) * 1000)
+            t0 = time.perf_counter()
+            qn = q / np.linalg.norm(q)
+            top = np.argpartition(-(vectors @ qn), k)[:k]
+            brute.append((time.perf_counter() - t0) * 1000)
+            hits += len({i for i, _ in found} & {int(t) + 1 for t in top})
+        times.sort()
+        brute.sort()
+        print(f"поиск top-{k} ({args.candidates} кандидатов): p50 {times[len(times) // 2]:.2f} мс, "
+              f"p99 {times[int(len(times) * 0.99)]:.2f} мс; "
+              f"полный перебор float32 в памяти: p50 {brute[len(brute) // 2]:.2f} мс; "
+              f"совпадение с перебором {hits * 100 / (k * len(queries)):.1f}%")
+
+        # Индексация через /api/embed мок‑сервера и ответ на похожий вопрос
+        with MockOllama() as mock:
+            store = ConversationStore(os.path.join(tmp, "store.sqlite3"))
+            topics = ["nginx", "docker", "pacman", "systemd", "ssh", "btrfs", "wayland", "python"]
+            for i in range(args.exchanges):
+                sid = store.new_session("bench:1b")
+                topic = topics[i % len(topics)]
+                store.add_message(sid, "user", f"вопрос {i} про {topic} и настройку {topic}", "bench:1b")
+                store.add_message(sid, "assistant", f"ответ {i}: {topic} настраивается так", "bench:1b")
+            store.flush()
+            real = MemoryIndex(store, "bench", root=tmp, client=OllamaClient(base_url=mock.url),
+                               batch_size=args.batch)
+            t0 = time.perf_counter()
+            done = real.index_pending()
+            index_s = time.perf_counter() - t0
+            t0 = time.perf_counter()
+            real.min_score = 0.0  # у «мешка слов» мока косинусы ниже, чем у настоящей модели
+            snippets = real.recall("как настроить btrfs", k=3)
+            recall_ms = (time.perf_counter() - t0) * 1000
+            print(f"индексация через мок: {done} ответов за {index_s:.2f} с "
+                  f"({done / max(index_s, 1e-9):.0f}/с, пачки по {args.batch}); "
+                  f"recall с эмбеддингом запроса {recall_ms:.1f} мс, "
+                  f"по теме: {sum('btrfs' in s for s in snippets)}/{len(snippets)}")
+            store.close()
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки Ollama Tray Chat")
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    p = sub.add_parser("history", help="Сегментированный журнал истории")
+    p.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 400_000])
+    p.add_argument("--session-len", type=int, default=40, help="Записей в одной сессии")
+    p.add_argument("--segment-kb", type=int, default=1024)
+    p.add_argument("--repeat", type=int, default=20)
+    p.set_defaults(func=bench_history)
+
+    p = sub.add_parser("deny", help="Чёрный список команд")
+    p.add_argument("--rules", type=int, nargs="+", default=[20, 100, 500, 2000])
+    p.add_argument("--repeat", type=int, default=20)
+    p.set_defaults(func=bench_deny)
+
+    p = sub.add_parser("commands", help="Извлечение команд из ответа")
+    p.add_argument("--sizes", type=int, nargs="+", default=[4, 64, 512], help="Размер ответа, КБ")
+    p.add_argument("--repeat", type=int, default=10)
+    p.set_defaults(func=bench_commands)
+
+    p = sub.add_parser("shell", help="Выполнение серии команд")
+    p.add_argument("--count", type=int, default=60, help="Команд в серии")
+    p.add_argument("--repeat", type=int, default=5)
+    p.set_defaults(func=bench_shell)
+
+    p = sub.add_parser("pipeline", help="Весь путь ответа через окно приложения (мок Ollama)")
+    p.add_argument("--tokens", type=int, default=4000, help="Токенов в ответе")
+    p.add_argument("--token-chars", type=int, default=4, help="Символов в токене")
+    p.add_argument("--rate", type=float, default=0.0, help="Токенов в секунду (0 — без пауз)")
+    p.add_argument("--repeat", type=int, default=5, help="Ответов за прогон")
+    p.add_argument("--chunk-mode", choices=["coalesced", "per_token"], default="coalesced")
+    p.add_argument("--writer-records", type=int, default=2000)
+    p.add_argument("--baseline", help="JSON эталона для сравнения")
+    p.add_argument("--save-baseline", help="Куда записать результаты как эталон")
+    p.add_argument("--tolerance", type=float, default=15.0, help="Допуск регрессии, %%")
+    p.set_defaults(func=bench_pipeline)
+
+    p = sub.add_parser("backends", help="Пул серверов: маршрутизация и failover (мок‑серверы)")
+    p.add_argument("--requests", type=int, default=12, help="Одновременных запросов в серии")
+    p.add_argument("--tokens", type=int, default=300)
+    p.add_argument("--rate", type=float, default=300.0, help="Скорость самого медленного сервера, ток/с")
+    p.add_argument("--kill-after", type=float, default=0.3, help="Через сколько секунд уронить сервер")
+    p.set_defaults(func=bench_backends)
+
+    p = sub.add_parser("memory", help="Память прошлых разговоров: поиск по векторам (нужен numpy)")
+    p.add_argument("--count", type=int, default=100_000, help="Векторов в индексе")
+    p.add_argument("--dim", type=int, default=768)
+    p.add_argument("--clusters", type=int, default=2000, help="Тем в синтетических данных")
+    p.add_argument("--candidates", type=int, default=512, help="Кандидатов после битовых кодов")
+    p.add_argument("--queries", type=int, default=200)
+    p.add_argument("-k", type=int, default=3)
+    p.add_argument("--exchanges", type=int, default=2000, help="Ответов для индексации через мок")
+    p.add_argument("--batch", type=int, default=16, help="Пачка эмбеддингов")
+    p.set_defaults(func=bench_memory)
+
+    args = parser.parse_args()
+    try:
+        args.func(args)
+    finally:
+        shutil.rmtree(BENCH_HOME, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -11,6 +11,7 @@ echo "📦 Создание .deb пакета для Ubuntu/Debian..."
 set -l DEB_DIR "releases/$APP_NAME-$VERSION-deb"
 mkdir -p "$DEB_DIR/DEBIAN"
 mkdir -p "$DEB_DIR/usr/bin"
+mkdir -p "$DEB_DIR/usr/share/$APP_NAME"
 mkdir -p "$DEB_DIR/usr/share/applications"
 mkdir -p "$DEB_DIR/usr/share/icons/hicolor/scalable/apps"
 mkdir -p "$DEB_DIR/usr/share/doc/$APP_NAME"
@@ -22,6 +23,7 @@ Section: utils
 Priority: optional
 Architecture: amd64
 Depends: python3 (>= 3.10), python3-pyqt6, python3-requests
+Suggests: python3-numpy
 Maintainer: $MAINTAINER
 Description: GUI chat client for Ollama with system tray support
  Ollama Tray Chat is a desktop application that provides a graphical
@@ -41,8 +43,10 @@ exit 0" > "$DEB_DIR/DEBIAN/postinst"
 chmod 755 "$DEB_DIR/DEBIAN/postinst"
 
 # Копируем файлы
-cp ollama_tray_chat.py "$DEB_DIR/usr/bin/$APP_NAME"
-chmod 755 "$DEB_DIR/usr/bin/$APP_NAME"
+cp ollama_tray_chat.py ollama_core.py ollama_tray_ctl.py "$DEB_DIR/usr/share/$APP_NAME/"
+chmod 755 "$DEB_DIR/usr/share/$APP_NAME/ollama_tray_chat.py" "$DEB_DIR/usr/share/$APP_NAME/ollama_tray_ctl.py"
+ln -sf "/usr/share/$APP_NAME/ollama_tray_chat.py" "$DEB_DIR/usr/bin/$APP_NAME"
+ln -sf "/usr/share/$APP_NAME/ollama_tray_ctl.py" "$DEB_DIR/usr/bin/$APP_NAME-ctl"
 cp ollama-tray-chat.desktop "$DEB_DIR/usr/share/applications/"
 cp icons/ollama-chat.svg "$DEB_DIR/usr/share/icons/hicolor/scalable/apps/"
 cp README.md LICENSE "$DEB_DIR/usr/share/doc/$APP_NAME/"
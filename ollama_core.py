@@ -0,0 +1,3375 @@
+# -*- coding: utf-8 -*-
+"""
+Ядро Ollama Tray Chat без зависимостей от Qt.
+
+Здесь живёт всё, что не рисует окна: общий HTTP‑клиент к Ollama и прочая
+«не‑GUI» логика, которую использует ollama_tray_chat.py.
+"""
+from __future__ import annotations
+import glob
+import hashlib
+import json
+import mmap
+import os
+import queue
+import re
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+from collections import deque
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+if TYPE_CHECKING:
+    # requests (с urllib3 и certifi) — самый тяжёлый импорт; грузится при первом запросе
+    import requests
+
+OLLAMA_URL = os.environ.get("OLLAMA_URL", "http://127.0.0.1:11434")
+APP_ID = "ollama-tray-chat"
+CONFIG_DIR = os.path.join(os.path.expanduser("~"), ".config", APP_ID)
+DATA_DIR = os.path.join(os.path.expanduser("~"), ".local", "share", APP_ID)
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", APP_ID)
+CONFIG_PATH = os.path.join(CONFIG_DIR, "config.json")
+# Старый единый лог; теперь он переносится в сегменты HISTORY_DIR
+HISTORY_PATH = os.path.join(DATA_DIR, "history.jsonl")
+HISTORY_DIR = os.path.join(DATA_DIR, "history")
+MODELS_CACHE_PATH = os.path.join(CACHE_DIR, "models.json")
+RESPONSE_CACHE_PATH = os.path.join(CACHE_DIR, "responses.sqlite3")
+# Сокет локального API запущенного приложения (в runtime‑каталоге пользователя, если он есть)
+IPC_SOCKET_PATH = os.path.join(os.environ.get("XDG_RUNTIME_DIR") or CACHE_DIR, f"{APP_ID}.sock")
+STORE_PATH = os.path.join(DATA_DIR, "conversations.sqlite3")
+SEARCH_PATH = os.path.join(DATA_DIR, "search.sqlite3")
+# Векторная память прошлых разговоров: по каталогу на модель эмбеддингов
+MEMORY_DIR = os.path.join(DATA_DIR, "memory")
+# Маркер начала нового чата в history.jsonl
+NEW_CHAT_MARKER = "--- new chat ---"
+
+# Таймауты по умолчанию: соединение должно подниматься быстро,
+# а чтение стрима может долго ждать первый токен (холодная загрузка модели)
+DEFAULT_CONNECT_TIMEOUT = 5.0
+DEFAULT_READ_TIMEOUT = 120.0
+# Сколько секунд считаем метаданные /api/show свежими
+MODELS_CACHE_TTL = 24 * 3600
+# Сколько Ollama держит модель в памяти после запроса (формат Ollama: "30m", "1h", "-1")
+DEFAULT_KEEP_ALIVE = "30m"
+# num_ctx, с которым Ollama запускает модель, если в Modelfile не задано иное
+DEFAULT_NUM_CTX = 2048
+# Модель эмбеддингов для памяти прошлых разговоров (ollama pull nomic-embed-text)
+DEFAULT_EMBED_MODEL = "nomic-embed-text"
+
+
+def ensure_paths():
+    os.makedirs(CONFIG_DIR, exist_ok=True)
+    os.makedirs(DATA_DIR, exist_ok=True)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+
+
+def write_text_atomic(path: str, text: str) -> None:
+    """Запись через временный файл + rename, чтобы не оставить полфайла."""
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def write_json_atomic(path: str, data, indent: Optional[int] = None) -> None:
+    write_text_atomic(path, json.dumps(data, ensure_ascii=False, indent=indent))
+
+
+# ====== HTTP клиент ======
+class EndpointStats:
+    """Потокобезопасные счётчики соединений по эндпоинтам (/api/chat, /api/tags, ...)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data: Dict[str, Dict[str, int]] = {}
+
+    def record(self, endpoint: str, fresh: bool):
+        with self._lock:
+            rec = self._data.setdefault(endpoint, {"requests": 0, "new": 0, "reused": 0})
+            rec["requests"] += 1
+            rec["new" if fresh else "reused"] += 1
+
+    def snapshot(self) -> Dict[str, Dict[str, int]]:
+        with self._lock:
+            return {k: dict(v) for k, v in self._data.items()}
+
+    def reset(self):
+        with self._lock:
+            self._data.clear()
+
+
+def _counting_pool_classes(stats: EndpointStats) -> dict:
+    """Пулы urllib3, которые отмечают, пошёл ли запрос по новому TCP‑соединению.
+
+    У соединения без сокета перед запросом сокет будет открыт заново —
+    это «новое» соединение; иначе запрос ушёл по keep‑alive.
+    """
+    from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+    def make(base):
+        class _CountingPool(base):
+            def _make_request(self, conn, method, url, *args, **kwargs):
+                fresh = getattr(conn, "sock", None) is None
+                stats.record(url.split("?", 1)[0], fresh)
+                return super()._make_request(conn, method, url, *args, **kwargs)
+        return _CountingPool
+
+    return {"http": make(HTTPConnectionPool), "https": make(HTTPSConnectionPool)}
+
+
+def _counting_adapter(stats: EndpointStats, **kwargs):
+    """HTTPAdapter со счётчиками соединений (класс строится при первом вызове)."""
+    from requests.adapters import HTTPAdapter
+
+    class _CountingAdapter(HTTPAdapter):
+        def init_poolmanager(self, *args, **kw):
+            super().init_poolmanager(*args, **kw)
+            self.poolmanager.pool_classes_by_scheme = _counting_pool_classes(stats)
+
+    return _CountingAdapter(**kwargs)
+
+
+class OllamaClient:
+    """Единая точка всех запросов к Ollama.
+
+    Держит одну requests.Session с пулом keep‑alive соединений, поэтому
+    повторные запросы не тратят время на установку TCP. Сессию можно
+    использовать из нескольких потоков (пул urllib3 потокобезопасен),
+    таймауты соединения и чтения задаются раздельно. Сессия (и импорт
+    requests) создаётся при первом запросе, а не при старте приложения.
+    """
+
+    def __init__(
+        self,
+        base_url: str = OLLAMA_URL,
+        connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+        read_timeout: float = DEFAULT_READ_TIMEOUT,
+        pool_maxsize: int = 8,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.stats = EndpointStats()
+        self.pool_maxsize = pool_maxsize
+        self._session_obj: Optional["requests.Session"] = None
+        self._session_lock = threading.Lock()
+
+    @property
+    def _session(self) -> "requests.Session":
+        if self._session_obj is None:
+            with self._session_lock:
+                if self._session_obj is None:
+                    import requests
+                    session = requests.Session()
+                    # Повтор только на этапе соединения: POST /api/chat нельзя повторять после отправки
+                    adapter = _counting_adapter(
+                        self.stats, pool_connections=4, pool_maxsize=self.pool_maxsize, max_retries=1
+                    )
+                    session.mount("http://", adapter)
+                    session.mount("https://", adapter)
+                    self._session_obj = session
+        return self._session_obj
+
+    def set_timeouts(self, connect_timeout: float, read_timeout: float):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+    def _timeout(self, read_timeout: Optional[float]) -> Tuple[float, float]:
+        return (self.connect_timeout, self.read_timeout if read_timeout is None else read_timeout)
+
+    def url(self, path: str) -> str:
+        return f"{self.base_url}{path}"
+
+    def get(self, path: str, headers: Optional[dict] = None, read_timeout: Optional[float] = None) -> requests.Response:
+        """GET без разбора тела; 304 Not Modified ошибкой не считается."""
+        r = self._session.get(self.url(path), headers=headers, timeout=self._timeout(read_timeout))
+        if r.status_code != 304:
+            r.raise_for_status()
+        return r
+
+    def get_json(self, path: str, read_timeout: Optional[float] = None) -> dict:
+        return self.get(path, read_timeout=read_timeout).json()
+
+    def post_json(self, path: str, payload: dict, read_timeout: Optional[float] = None) -> dict:
+        r = self._session.post(self.url(path), json=payload, timeout=self._timeout(read_timeout))
+        r.raise_for_status()
+        return r.json()
+
+    def post_stream(self, path: str, payload: dict, read_timeout: Optional[float] = None) -> requests.Response:
+        """POST со стримингом ответа. Использовать как контекстный менеджер,
+        чтобы соединение вернулось в пул после чтения."""
+        r = self._session.post(
+            self.url(path), json=payload, stream=True, timeout=self._timeout(read_timeout)
+        )
+        try:
+            r.raise_for_status()
+        except Exception:
+            r.close()
+            raise
+        return r
+
+    def close(self):
+        if self._session_obj is not None:
+            self._session_obj.close()
+
+
+_client: Optional[OllamaClient] = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> OllamaClient:
+    """Общий на всё приложение клиент (создаётся при первом обращении)."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = OllamaClient()
+        return _client
+
+
+def set_client(client: OllamaClient) -> Optional[OllamaClient]:
+    """Подменяет общий клиент (другой сервер, бенчмарки); возвращает прежний."""
+    global _client
+    with _client_lock:
+        previous, _client = _client, client
+        return previous
+
+
+# ====== Состояние чата и конфиг ======
+@dataclass
+class ChatMessage:
+    role: str  # "system" | "user" | "assistant"
+    content: str
+    id: Optional[int] = None  # id в ConversationStore, если уже сохранено
+
+
+@dataclass
+class ChatState:
+    model: str = "phi3.5:3.8b-mini-instruct"
+    system_prompt: str = (
+        "Ты — локальный помощник по Linux (Arch) и fish. Отвечай кратко, давай команды безопасно.\n\n"
+        "ВАЖНО: Все команды оборачивай в блоки кода с ```bash или помечай через `команда`.\n"
+        "Пример:\n"
+        "```bash\n"
+        "ls -la\n"
+        "```\n"
+        "или просто: `ls -la`"
+    )
+    messages: List[ChatMessage] = field(default_factory=list)
+    # Таймауты HTTP (секунды): установка соединения и ожидание данных
+    connect_timeout: float = DEFAULT_CONNECT_TIMEOUT
+    read_timeout: float = DEFAULT_READ_TIMEOUT
+    # Окно контекста: 0 — взять num_ctx модели; политика для старых реплик
+    num_ctx: int = 0
+    context_policy: str = "drop"  # "drop" | "summarize"
+    # Сколько Ollama держит модель загруженной после запроса
+    keep_alive: str = DEFAULT_KEEP_ALIVE
+    # Доставка стрима в GUI: "coalesced" — пачками по таймеру/объёму, "per_token" — каждую дельту
+    chunk_mode: str = "coalesced"
+    chunk_flush_ms: int = 33  # ~30 кадров/с
+    chunk_flush_bytes: int = 512
+    # Вывод выполняемых команд: сколько строк держать и как часто отдавать в окно
+    runner_max_lines: int = 5000
+    runner_flush_ms: int = 100
+    # Очередь одобренных команд: сколько выполнять одновременно и как связывать пакет
+    job_concurrency: int = 2
+    job_mode: str = "parallel"  # см. JOB_MODES в окне
+    # Сколько запросов к Ollama идёт одновременно (все вкладки и сравнение моделей)
+    max_inflight: int = 2
+    # Серверы Ollama (пусто — один OLLAMA_URL); запрос уходит на лучший доступный
+    backends: List[str] = field(default_factory=list)
+    # Кэш ответов: тот же вопрос к той же модели в том же контексте — без генерации
+    response_cache: bool = False
+    cache_ttl_hours: float = 168.0
+    cache_max_mb: int = 50
+    # Память: похожие прошлые ответы (поиск по эмбеддингам) подмешиваются в контекст
+    memory_enabled: bool = False
+    embed_model: str = DEFAULT_EMBED_MODEL
+    memory_k: int = 3
+    memory_tokens: int = 512
+    # Открытые вкладки (id разговоров) и активная вкладка — восстанавливаются при запуске
+    open_tabs: List[int] = field(default_factory=list)
+    active_tab: int = 0
+    # Сравнение моделей: сколько ответов генерировать одновременно
+    fanout_concurrency: int = 2
+    fanout_models: List[str] = field(default_factory=list)
+    exec_backend: str = "process"  # см. EXEC_BACKENDS в окне
+    shell_timeout: float = 300.0  # секунд на команду в общем shell
+    # Настройки безопасности команд
+    safe_sudo_commands: List[str] = field(default_factory=lambda: [
+        "systemctl", "journalctl", "pacman", "apt", "dnf", "yum",
+        "docker", "podman", "snap", "flatpak", "cat", "less", "tail",
+        "head", "grep", "find", "ls", "lsblk", "lsusb", "lspci",
+        "ip", "ss", "netstat", "dmesg",
+    ])
+    deny_patterns: List[str] = field(default_factory=lambda: [
+        r"\brm\s+(-[rf]*[rf]|-[rf]*[rf])",
+        r"\brm\b.*--no-preserve-root",
+        r"\bdd\b.*if=.*of=/dev/",
+        r"\bmkfs\.",
+        r"\bfdisk\b",
+        r"\bparted\b",
+        r":\s*\(\s*\)\s*\{",
+        r"while\s+true.*do",
+        r">\s*/etc/",
+        r">\s*/boot/",
+        r">\s*/sys/",
+        r"\bchmod\s+777\s+/",
+        r"\bchown\s+.*\s+/\s*$",
+        r"\bhping",
+        r"\bnmap.*-sS",
+        r"curl.*\|\s*bash",
+        r"wget.*\|\s*sh",
+        r"curl.*\|\s*sh",
+        r">\s*/dev/null\s+2>&1\s*&",
+        r"\b(mkfs|shutdown|reboot|halt|poweroff|init\s+[06])\b",
+    ])
+
+
+def load_chat_state(path: str = CONFIG_PATH) -> ChatState:
+    """Настройки из config.json (окно и --ask читают один и тот же файл)."""
+    if os.path.exists(path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                cfg = json.load(f)
+            st = ChatState(
+                model=cfg.get("model", "phi3.5:3.8b-mini-instruct"),
+                system_prompt=cfg.get("system_prompt", ""),
+                messages=[],
+            )
+            st.num_ctx = int(cfg.get("num_ctx", 0))
+            st.keep_alive = str(cfg.get("keep_alive", DEFAULT_KEEP_ALIVE))
+            if cfg.get("chunk_mode") in ("coalesced", "per_token"):
+                st.chunk_mode = cfg["chunk_mode"]
+            st.chunk_flush_ms = int(cfg.get("chunk_flush_ms", st.chunk_flush_ms))
+            st.chunk_flush_bytes = int(cfg.get("chunk_flush_bytes", st.chunk_flush_bytes))
+            st.runner_max_lines = int(cfg.get("runner_max_lines", st.runner_max_lines))
+            st.runner_flush_ms = int(cfg.get("runner_flush_ms", st.runner_flush_ms))
+            st.job_concurrency = max(1, int(cfg.get("job_concurrency", st.job_concurrency)))
+            st.max_inflight = max(1, int(cfg.get("max_inflight", st.max_inflight)))
+            st.backends = [str(u) for u in cfg.get("backends", st.backends)]
+            st.response_cache = bool(cfg.get("response_cache", st.response_cache))
+            st.cache_ttl_hours = float(cfg.get("cache_ttl_hours", st.cache_ttl_hours))
+            st.cache_max_mb = max(1, int(cfg.get("cache_max_mb", st.cache_max_mb)))
+            st.memory_enabled = bool(cfg.get("memory", st.memory_enabled))
+            st.embed_model = str(cfg.get("embed_model", st.embed_model)) or DEFAULT_EMBED_MODEL
+            st.memory_k = max(1, int(cfg.get("memory_k", st.memory_k)))
+            st.memory_tokens = max(0, int(cfg.get("memory_tokens", st.memory_tokens)))
+            st.open_tabs = [int(sid) for sid in cfg.get("tabs", [])]
+            st.active_tab = int(cfg.get("active_tab", 0))
+            st.fanout_concurrency = max(1, int(cfg.get("fanout_concurrency", st.fanout_concurrency)))
+            st.fanout_models = list(cfg.get("fanout_models", []))
+            st.job_mode = str(cfg.get("job_mode", st.job_mode))
+            st.exec_backend = str(cfg.get("exec_backend", st.exec_backend))
+            st.shell_timeout = float(cfg.get("shell_timeout", st.shell_timeout))
+            if cfg.get("context_policy") in CONTEXT_POLICIES:
+                st.context_policy = cfg["context_policy"]
+            st.connect_timeout = float(cfg.get("connect_timeout", DEFAULT_CONNECT_TIMEOUT))
+            st.read_timeout = float(cfg.get("read_timeout", DEFAULT_READ_TIMEOUT))
+            # Загружаем настройки безопасности
+            if "safe_sudo_commands" in cfg:
+                st.safe_sudo_commands = cfg["safe_sudo_commands"]
+            if "deny_patterns" in cfg:
+                st.deny_patterns = cfg["deny_patterns"]
+            return st
+        except Exception:
+            pass
+    return ChatState()
+
+
+# ====== Несколько серверов Ollama ======
+@dataclass
+class Backend:
+    """Один сервер Ollama в пуле и то, что о нём известно по проверкам."""
+    url: str
+    client: OllamaClient
+    healthy: bool = True
+    models: Optional[frozenset] = None  # None — ещё не проверяли
+    loaded: frozenset = frozenset()     # модели, сейчас загруженные в память (/api/ps)
+    ttft: Optional[float] = None        # скользящее среднее TTFT, секунды
+    inflight: int = 0
+    served: int = 0
+    failures: int = 0
+    last_check: float = 0.0
+    last_error: str = ""
+
+    def has_model(self, model: str) -> Optional[bool]:
+        """True/False или None, если список моделей ещё неизвестен."""
+        return None if self.models is None else model in self.models
+
+
+class BackendPool:
+    """Пул серверов Ollama с проверкой здоровья и выбором сервера на запрос.
+
+    Фоновый поток раз в interval секунд опрашивает /api/tags и /api/ps
+    каждого сервера (параллельно, чтобы недоступный не задерживал
+    остальных). Запрос уходит на здоровый сервер с нужной моделью: сначала
+    наименее загруженный (запросов в работе), затем тот, где модель уже в
+    памяти, затем с меньшим TTFT. Сервер, отказавший при запросе, считается
+    недоступным до следующей успешной проверки.
+    """
+
+    def __init__(self, urls: Sequence[str] = (), interval: float = 15.0,
+                 check_timeout: float = 3.0, ttft_alpha: float = 0.3):
+        self.interval = interval
+        self.check_timeout = check_timeout
+        self.ttft_alpha = ttft_alpha
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.backends: List[Backend] = []
+        self.configure(urls)
+
+    def configure(self, urls: Sequence[str]):
+        """Задать список серверов; для уже известных адресов состояние сохраняется."""
+        urls = [u.strip().rstrip("/") for u in urls if u and u.strip()]
+        urls = list(dict.fromkeys(urls)) or [get_client().base_url]
+        with self._lock:
+            known = {b.url: b for b in self.backends}
+            backends = []
+            for url in urls:
+                backend = known.get(url)
+                if backend is None:
+                    client = get_client() if url == get_client().base_url else OllamaClient(url)
+                    backend = Backend(url, client)
+                backends.append(backend)
+            self.backends = backends
+        self._wake.set()
+
+    def urls(self) -> List[str]:
+        with self._lock:
+            return [b.url for b in self.backends]
+
+    # --- проверка здоровья ---
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="backend-health", daemon=True)
+            self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        self._wake.set()
+
+    def check_now(self):
+        """Попросить фоновый поток проверить серверы вне очереди."""
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.check_all()
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def check_all(self):
+        with self._lock:
+            backends = list(self.backends)
+        threads = [threading.Thread(target=self.check, args=(b,), daemon=True) for b in backends]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(self.check_timeout * 2 + 1)
+
+    def check(self, backend: Backend):
+        try:
+            tags = backend.client.get_json("/api/tags", read_timeout=self.check_timeout)
+            models = frozenset(m.get("name", "") for m in tags.get("models", []))
+            try:
+                ps = backend.client.get_json("/api/ps", read_timeout=self.check_timeout)
+                loaded = frozenset(m.get("name", "") for m in ps.get("models", []))
+            except Exception:
+                loaded = frozenset()
+        except Exception as e:
+            with self._lock:
+                backend.healthy = False
+                backend.last_error = str(e)
+                backend.last_check = time.time()
+            return
+        with self._lock:
+            backend.healthy = True
+            backend.models = models
+            backend.loaded = loaded
+            backend.last_error = ""
+            backend.last_check = time.time()
+
+    # --- выбор сервера ---
+    def all_models(self) -> List[str]:
+        with self._lock:
+            names = set()
+            for b in self.backends:
+                if b.models:
+                    names |= b.models
+        return sorted(names)
+
+    def candidates(self, model: str) -> List[Backend]:
+        """Серверы в порядке попыток для запроса к model."""
+        with self._lock:
+            backends = list(self.backends)
+
+            def rank(b: Backend):
+                # Сервер без замеров TTFT пробуем первым среди равных — так он получит замер
+                return (b.inflight, model not in b.loaded, b.ttft or 0.0)
+
+            healthy = [b for b in backends if b.healthy]
+            with_model = sorted((b for b in healthy if b.has_model(model)), key=rank)
+            unknown = sorted((b for b in healthy if b.has_model(model) is None), key=rank)
+            # Недоступные — последней попыткой: проверка могла устареть
+            down = sorted((b for b in backends if not b.healthy and b.has_model(model) is not False),
+                          key=lambda b: b.last_check)
+            ordered = with_model + unknown + down
+            if not ordered:
+                # Модели нет ни у кого по последним данным — пусть ответит сам сервер
+                ordered = sorted(healthy, key=rank) or backends
+        return ordered
+
+    def acquire(self, backend: Backend):
+        with self._lock:
+            backend.inflight += 1
+
+    def release(self, backend: Backend, ttft: Optional[float] = None, error: Optional[str] = None):
+        """Запрос закончен: учёт нагрузки, TTFT и отказа сервера (error — сервер недоступен)."""
+        with self._lock:
+            backend.inflight = max(0, backend.inflight - 1)
+            if error is not None:
+                backend.healthy = False
+                backend.failures += 1
+                backend.last_error = error
+                self._wake.set()
+                return
+            backend.served += 1
+            if ttft is not None:
+                a = self.ttft_alpha
+                backend.ttft = ttft if backend.ttft is None else a * ttft + (1 - a) * backend.ttft
+
+    def snapshot(self) -> List[dict]:
+        with self._lock:
+            return [
+                {
+                    "url": b.url, "healthy": b.healthy,
+                    "models": None if b.models is None else len(b.models),
+                    "loaded": sorted(b.loaded), "ttft": b.ttft, "inflight": b.inflight,
+                    "served": b.served, "failures": b.failures,
+                    "last_check": b.last_check, "last_error": b.last_error,
+                }
+                for b in self.backends
+            ]
+
+
+_pool: Optional[BackendPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> BackendPool:
+    """Общий пул серверов; по умолчанию в нём один сервер — get_client()."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = BackendPool()
+        return _pool
+
+
+# ====== Модели в памяти ======
+def normalize_keep_alive(value) -> object:
+    """Строка из настроек -> значение keep_alive для Ollama.
+
+    Числа (в т.ч. "-1" — держать всегда) передаём числом секунд,
+    длительности вида "30m"/"2h" — строкой как есть.
+    """
+    text = str(value).strip()
+    if not text:
+        return DEFAULT_KEEP_ALIVE
+    try:
+        return int(text)
+    except ValueError:
+        return text
+
+
+def preload_model(model: str, keep_alive, client: Optional[OllamaClient] = None) -> None:
+    """Загрузить веса модели заранее: /api/generate без prompt только грузит модель."""
+    client = client or get_client()
+    client.post_json("/api/generate", {"model": model, "keep_alive": normalize_keep_alive(keep_alive)})
+
+
+def unload_model(model: str, client: Optional[OllamaClient] = None) -> None:
+    client = client or get_client()
+    client.post_json("/api/generate", {"model": model, "keep_alive": 0}, read_timeout=30)
+
+
+def running_models(client: Optional[OllamaClient] = None) -> List[dict]:
+    """Модели, загруженные в память сервера (/api/ps)."""
+    client = client or get_client()
+    data = client.get_json("/api/ps", read_timeout=5)
+    return [
+        {
+            "name": m.get("name", ""),
+            "size": int(m.get("size", 0)),
+            "size_vram": int(m.get("size_vram", 0)),
+            "expires_at": m.get("expires_at", ""),
+        }
+        for m in data.get("models", [])
+    ]
+
+
+def format_size(num: int) -> str:
+    for unit in ("Б", "КБ", "МБ", "ГБ"):
+        if num < 1024 or unit == "ГБ":
+            return f"{num:.0f} {unit}" if unit == "Б" else f"{num:.1f} {unit}"
+        num /= 1024
+    return str(num)
+
+
+# ====== Каталог моделей ======
+def _show_metadata(info: dict) -> dict:
+    """Выжимка из ответа /api/show: контекст, размер, квантизация."""
+    details = info.get("details") or {}
+    meta = {
+        "parameter_size": details.get("parameter_size", ""),
+        "quantization": details.get("quantization_level", ""),
+        "family": details.get("family", ""),
+        "context_length": 0,
+    }
+    for key, value in (info.get("model_info") or {}).items():
+        if key.endswith(".context_length") and isinstance(value, int):
+            meta["context_length"] = value
+            break
+    # num_ctx из Modelfile важнее архитектурного максимума
+    for line in (info.get("parameters") or "").splitlines():
+        parts = line.split()
+        if len(parts) == 2 and parts[0] == "num_ctx" and parts[1].isdigit():
+            meta["num_ctx"] = int(parts[1])
+    return meta
+
+
+class ModelCatalog:
+    """Список моделей Ollama с дисковым кэшем.
+
+    Файл кэша хранит последний ответ /api/tags (с ETag, если сервер его
+    прислал) и метаданные /api/show, привязанные к digest модели. Пока
+    digest не изменился и не истёк TTL, /api/show повторно не запрашивается.
+    """
+
+    def __init__(self, path: str = MODELS_CACHE_PATH, ttl: float = MODELS_CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._data = {"fetched_at": 0, "etag": None, "models": [], "show": {}}
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if isinstance(data.get("models"), list) and isinstance(data.get("show"), dict):
+                self._data.update(data)
+        except Exception:
+            pass
+
+    def _save(self):
+        try:
+            ensure_paths()
+            write_json_atomic(self.path, self._data)
+        except OSError:
+            pass
+
+    def names(self) -> List[str]:
+        with self._lock:
+            return [m["name"] for m in self._data["models"] if m.get("name")]
+
+    def is_fresh(self) -> bool:
+        with self._lock:
+            return time.time() - self._data["fetched_at"] < self.ttl
+
+    def info(self, name: str) -> dict:
+        """Метаданные модели (пустой dict, если /api/show ещё не загружен)."""
+        with self._lock:
+            for m in self._data["models"]:
+                if m.get("name") == name:
+                    meta = self._data["show"].get(m.get("digest", ""), {})
+                    return {k: v for k, v in meta.items() if k != "ts"}
+        return {}
+
+    def digest(self, name: str) -> str:
+        with self._lock:
+            for m in self._data["models"]:
+                if m.get("name") == name:
+                    return m.get("digest", "")
+        return ""
+
+    def refresh(self, client: Optional[OllamaClient] = None) -> List[str]:
+        """Обновить каталог из сети. Блокирующий вызов — только из фонового потока."""
+        client = client or get_client()
+        with self._lock:
+            etag = self._data.get("etag")
+        r = client.get("/api/tags", headers={"If-None-Match": etag} if etag else None, read_timeout=5)
+        now = time.time()
+        if r.status_code == 304:
+            with self._lock:
+                models = list(self._data["models"])
+        else:
+            models = [
+                {"name": m.get("name"), "digest": m.get("digest", ""), "size": m.get("size", 0)}
+                for m in r.json().get("models", [])
+                if m.get("name")
+            ]
+        with self._lock:
+            show = dict(self._data["show"])
+
+        # /api/show только для новых digest или устаревших записей
+        for m in models:
+            cached = show.get(m["digest"])
+            if cached and now - cached.get("ts", 0) < self.ttl:
+                continue
+            try:
+                meta = _show_metadata(client.post_json("/api/show", {"model": m["name"]}, read_timeout=10))
+            except Exception:
+                continue
+            meta["ts"] = now
+            show[m["digest"]] = meta
+        live = {m["digest"] for m in models}
+        show = {d: meta for d, meta in show.items() if d in live}
+
+        with self._lock:
+            self._data = {
+                "fetched_at": now,
+                "etag": etag if r.status_code == 304 else r.headers.get("ETag"),
+                "models": models,
+                "show": show,
+            }
+        self._save()
+        return [m["name"] for m in models]
+
+
+# ====== Сборка контекста ======
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка числа токенов без токенизатора модели.
+
+    BPE‑токенизаторы дают ~4 символа на токен для английского и заметно
+    меньше для кириллицы, поэтому берём 3 символа — лучше переоценить.
+    """
+    return (len(text) + 2) // 3
+
+
+# Служебные токены шаблона чата на каждое сообщение (роль, разделители)
+MESSAGE_OVERHEAD_TOKENS = 4
+CONTEXT_POLICIES = ("drop", "summarize")
+
+
+@dataclass
+class ContextResult:
+    messages: List[dict]
+    used_tokens: int
+    budget: int
+    dropped: int = 0
+    summarized: bool = False
+    recalled: int = 0  # сколько фрагментов памяти вошло
+
+
+@dataclass
+class ContextBuilder:
+    """Собирает messages для /api/chat в пределах бюджета токенов.
+
+    Системный промпт, текущий вопрос и последние pinned_turns пар
+    вопрос/ответ закреплены; более старые реплики по политике
+    отбрасываются ("drop") или сворачиваются в короткую сводку
+    ("summarize"). История просматривается с конца и только до
+    исчерпания бюджета, поэтому стоимость сборки не растёт с длиной чата.
+    """
+    budget: int = DEFAULT_NUM_CTX
+    policy: str = "drop"
+    pinned_turns: int = 1
+    # Доля окна, оставляемая под ответ модели
+    reply_reserve: float = 0.25
+    estimator: Callable[[str], int] = estimate_tokens
+    summary_tokens: int = 200
+    # Сколько окна можно отдать под фрагменты прошлых разговоров (память)
+    memory_tokens: int = 512
+
+    def cost(self, role: str, content: str) -> int:
+        return self.estimator(content) + MESSAGE_OVERHEAD_TOKENS
+
+    def build(self, system_prompt: str, history: Sequence, user_prompt: str,
+              memory: Sequence[str] = ()) -> ContextResult:
+        """history — последовательность объектов с полями role и content.
+
+        memory — фрагменты прошлых разговоров по убыванию релевантности:
+        отдельным системным сообщением, сколько влезет в memory_tokens.
+        """
+        limit = max(1, int(self.budget * (1.0 - self.reply_reserve)))
+        head = [{"role": "system", "content": system_prompt}] if system_prompt.strip() else []
+        tail = [{"role": "user", "content": user_prompt}] if user_prompt else []
+        used = sum(self.cost(m["role"], m["content"]) for m in head + tail)
+
+        recalled = 0
+        if memory:
+            room = min(self.memory_tokens, limit - used) - MESSAGE_OVERHEAD_TOKENS
+            block, recalled = self._memory_block(memory, room)
+            if block:
+                head = head + [{"role": "system", "content": block}]
+                used += self.cost("system", block)
+
+        # В режиме сводки заранее оставляем под неё место
+        if self.policy == "summarize":
+            walk_limit = max(1, limit - self.summary_tokens)
+        else:
+            walk_limit = limit
+
+        # Идём от свежих реплик к старым
+        kept: List[dict] = []
+        pinned = self.pinned_turns * 2
+        idx = len(history)
+        while idx > 0:
+            m = history[idx - 1]
+            c = self.cost(m.role, m.content)
+            # Закреплённым репликам разрешено занять и резерв под ответ,
+            # но не выйти за окно модели
+            allowed = self.budget if len(kept) < pinned else walk_limit
+            if used + c > allowed:
+                break
+            kept.append({"role": m.role, "content": m.content})
+            used += c
+            idx -= 1
+        # Не начинаем контекст с «висящего» ответа ассистента
+        if kept and kept[-1]["role"] == "assistant" and idx > 0:
+            used -= self.cost("assistant", kept.pop()["content"])
+            idx += 1
+        kept.reverse()
+
+        summarized = False
+        if idx > 0 and self.policy == "summarize":
+            room = limit - used - MESSAGE_OVERHEAD_TOKENS
+            summary = self._summarize(history, idx, room)
+            if summary:
+                head = head + [{"role": "system", "content": summary}]
+                used += self.cost("system", summary)
+                summarized = True
+
+        return ContextResult(
+            messages=head + kept + tail,
+            used_tokens=used,
+            budget=self.budget,
+            dropped=idx,
+            summarized=summarized,
+            recalled=recalled,
+        )
+
+    def _memory_block(self, memory: Sequence[str], room: int) -> Tuple[str, int]:
+        """Фрагменты целиком, пока влезают; первый — хотя бы обрезанным."""
+        title = "Фрагменты прошлых разговоров (используй, только если они относятся к вопросу):"
+        spent = self.estimator(title)
+        parts: List[str] = []
+        for text in memory:
+            c = self.estimator(text) + 1
+            if spent + c > room:
+                if not parts and room - spent > 50:
+                    # ~3 символа на токен, как в estimate_tokens
+                    parts.append(text[:(room - spent) * 3 - 1].rstrip() + "…")
+                break
+            parts.append(text)
+            spent += c
+        if not parts:
+            return "", 0
+        return "\n\n".join([title] + parts), len(parts)
+
+    def _summarize(self, history: Sequence, end: int, room: int) -> str:
+        """Экстрактивная сводка отброшенных вопросов пользователя.
+
+        Без дополнительного запроса к модели: первые строки вопросов,
+        самые свежие — в приоритете, пока есть место.
+        """
+        if room <= 0:
+            return ""
+        title = "Кратко о более ранней части разговора (вопросы пользователя):"
+        spent = self.estimator(title)
+        lines: List[str] = []
+        for i in range(end - 1, -1, -1):
+            m = history[i]
+            if m.role != "user":
+                continue
+            first = m.content.strip().splitlines()[0] if m.content.strip() else ""
+            line = f"- {first[:160]}"
+            c = self.estimator(line)
+            if spent + c > room:
+                break
+            lines.append(line)
+            spent += c
+        if not lines:
+            return ""
+        lines.reverse()
+        return "\n".join([title] + lines)
+
+
+def context_budget(meta: dict, override: int = 0) -> int:
+    """Размер окна модели: явная настройка > num_ctx из Modelfile > умолчание Ollama."""
+    if override > 0:
+        return override
+    if meta.get("num_ctx"):
+        return int(meta["num_ctx"])
+    ctx_len = int(meta.get("context_length") or 0)
+    return min(ctx_len, DEFAULT_NUM_CTX) if ctx_len else DEFAULT_NUM_CTX
+
+
+# ====== Хранилище разговоров ======
+_STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    title TEXT NOT NULL DEFAULT '',
+    model TEXT NOT NULL DEFAULT '',
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    session_id INTEGER NOT NULL REFERENCES sessions(id) ON DELETE CASCADE,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    model TEXT NOT NULL DEFAULT '',
+    ts REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_session ON messages(session_id, id);
+CREATE INDEX IF NOT EXISTS sessions_updated ON sessions(updated_at);
+CREATE TABLE IF NOT EXISTS metrics (
+    message_id INTEGER PRIMARY KEY REFERENCES messages(id) ON DELETE CASCADE,
+    model TEXT NOT NULL DEFAULT '',
+    ts REAL NOT NULL,
+    ttft_ms REAL,
+    total_ms REAL,
+    jitter_ms REAL,
+    gap_max_ms REAL,
+    tokens_per_sec REAL,
+    eval_count INTEGER,
+    eval_ms REAL,
+    prompt_eval_count INTEGER,
+    prompt_eval_ms REAL,
+    load_ms REAL
+);
+CREATE INDEX IF NOT EXISTS metrics_model_ts ON metrics(model, ts);
+"""
+# Поля таблицы metrics, которые заполняет StreamTiming.metrics()
+METRIC_FIELDS = (
+    "ttft_ms", "total_ms", "jitter_ms", "gap_max_ms", "tokens_per_sec",
+    "eval_count", "eval_ms", "prompt_eval_count", "prompt_eval_ms", "load_ms",
+)
+
+
+class ConversationStore:
+    """SQLite‑хранилище сессий и сообщений.
+
+    База в режиме WAL; записи копятся в открытой транзакции и
+    коммитятся пачкой — по batch_size сообщений, не реже чем раз в
+    commit_interval секунд при очередной записи, а также по flush().
+    Все методы потокобезопасны.
+    """
+
+    def __init__(self, path: str = STORE_PATH, batch_size: int = 32, commit_interval: float = 1.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.commit_interval = commit_interval
+        self._lock = threading.RLock()
+        self._pending = 0
+        self._last_commit = time.monotonic()
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("PRAGMA foreign_keys=ON")
+        self._db.executescript(_STORE_SCHEMA)
+
+    # --- запись ---
+    def _write(self, sql: str, params: tuple) -> int:
+        with self._lock:
+            if not self._db.in_transaction:
+                self._db.execute("BEGIN")
+            cur = self._db.execute(sql, params)
+            self._pending += 1
+            if (self._pending >= self.batch_size
+                    or time.monotonic() - self._last_commit >= self.commit_interval):
+                self._commit()
+            return cur.lastrowid
+
+    def _commit(self):
+        if self._db.in_transaction:
+            self._db.execute("COMMIT")
+        self._pending = 0
+        self._last_commit = time.monotonic()
+
+    def flush(self):
+        with self._lock:
+            self._commit()
+
+    def close(self):
+        with self._lock:
+            self._commit()
+            self._db.close()
+
+    def new_session(self, model: str = "", ts: Optional[float] = None,
+                    session_id: Optional[int] = None) -> int:
+        """session_id — заранее выданный id (WriteBehind.new_session), иначе следующий."""
+        ts = time.time() if ts is None else ts
+        return self._write(
+            "INSERT INTO sessions (id, model, created_at, updated_at) VALUES (?, ?, ?, ?)",
+            (session_id, model, ts, ts),
+        )
+
+    def max_session_id(self) -> int:
+        return self._query("SELECT COALESCE(MAX(id), 0) FROM sessions")[0][0]
+
+    def add_message(self, session_id: int, role: str, content: str, model: str = "",
+                    ts: Optional[float] = None, metrics: Optional[dict] = None) -> int:
+        """metrics — замеры ответа (StreamTiming.metrics()), пишутся рядом с сообщением."""
+        ts = time.time() if ts is None else ts
+        with self._lock:
+            msg_id = self._write(
+                "INSERT INTO messages (session_id, role, content, model, ts) VALUES (?, ?, ?, ?, ?)",
+                (session_id, role, content, model, ts),
+            )
+            if metrics:
+                self._db.execute(
+                    f"INSERT INTO metrics (message_id, model, ts, {', '.join(METRIC_FIELDS)})"
+                    f" VALUES (?, ?, ?{', ?' * len(METRIC_FIELDS)})",
+                    (msg_id, model, ts, *(metrics.get(f) for f in METRIC_FIELDS)),
+                )
+            # Заголовок сессии — первый вопрос пользователя
+            title = content.strip().splitlines()[0][:80] if role == "user" and content.strip() else ""
+            self._db.execute(
+                "UPDATE sessions SET updated_at = ?, model = CASE WHEN ? != '' THEN ? ELSE model END,"
+                " title = CASE WHEN title = '' THEN ? ELSE title END WHERE id = ?",
+                (ts, model, model, title, session_id),
+            )
+            return msg_id
+
+    def delete_session(self, session_id: int):
+        with self._lock:
+            self._write("DELETE FROM sessions WHERE id = ?", (session_id,))
+            self._commit()
+
+    # --- чтение ---
+    def _query(self, sql: str, params: tuple = ()) -> list:
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def last_session(self) -> Optional[int]:
+        rows = self._query("SELECT id FROM sessions ORDER BY updated_at DESC, id DESC LIMIT 1")
+        return rows[0][0] if rows else None
+
+    def load_messages(self, session_id: int, limit: int = 200, before_id: Optional[int] = None) -> List[dict]:
+        """Страница сообщений сессии в хронологическом порядке: последние
+        limit штук, либо limit штук перед before_id."""
+        rows = self._query(
+            "SELECT id, role, content, model, ts FROM messages"
+            " WHERE session_id = ? AND id < ? ORDER BY id DESC LIMIT ?",
+            (session_id, before_id if before_id is not None else 2 ** 62, limit),
+        )
+        return [
+            {"id": r[0], "role": r[1], "content": r[2], "model": r[3], "ts": r[4]}
+            for r in reversed(rows)
+        ]
+
+    def list_sessions(self, offset: int = 0, limit: int = 50) -> List[dict]:
+        rows = self._query(
+            "SELECT s.id, s.title, s.model, s.created_at, s.updated_at,"
+            " (SELECT COUNT(*) FROM messages m WHERE m.session_id = s.id)"
+            " FROM sessions s ORDER BY s.updated_at DESC, s.id DESC LIMIT ? OFFSET ?",
+            (limit, offset),
+        )
+        return [
+            {"id": r[0], "title": r[1], "model": r[2], "created_at": r[3], "updated_at": r[4], "count": r[5]}
+            for r in rows
+        ]
+
+    def messages_after(self, msg_id: int, limit: int = 1000) -> List[tuple]:
+        """(id, session_id, role, content, ts) с id больше заданного — для догоняющей индексации."""
+        return self._query(
+            "SELECT id, session_id, role, content, ts FROM messages WHERE id > ? ORDER BY id LIMIT ?",
+            (msg_id, limit),
+        )
+
+    # Ответ ассистента и ближайший перед ним вопрос из той же сессии
+    _EXCHANGE_SQL = (
+        "SELECT a.id, a.session_id, a.ts,"
+        " (SELECT u.content FROM messages u WHERE u.session_id = a.session_id AND u.id < a.id"
+        "  AND u.role = 'user' ORDER BY u.id DESC LIMIT 1),"
+        " a.content FROM messages a WHERE a.role = 'assistant' AND "
+    )
+
+    def exchanges_after(self, msg_id: int, limit: int = 100) -> List[tuple]:
+        """(id ответа, session_id, ts, вопрос, ответ) с id больше заданного — для памяти."""
+        return self._query(self._EXCHANGE_SQL + "a.id > ? ORDER BY a.id LIMIT ?", (msg_id, limit))
+
+    def count_answers_after(self, msg_id: int) -> int:
+        return self._query("SELECT COUNT(*) FROM messages WHERE role = 'assistant' AND id > ?", (msg_id,))[0][0]
+
+    def exchanges(self, ids: Sequence[int]) -> Dict[int, tuple]:
+        """Те же кортежи по id ответов (удалённых в результате нет)."""
+        if not ids:
+            return {}
+        marks = ",".join("?" * len(ids))
+        rows = self._query(self._EXCHANGE_SQL + f"a.id IN ({marks})", tuple(ids))
+        return {r[0]: r for r in rows}
+
+    def is_empty(self) -> bool:
+        return not self._query("SELECT 1 FROM sessions LIMIT 1")
+
+    def metric_models(self) -> List[str]:
+        return [r[0] for r in self._query("SELECT DISTINCT model FROM metrics ORDER BY model")]
+
+    def load_metrics(self, model: Optional[str] = None, since: Optional[float] = None) -> List[dict]:
+        """Замеры ответов в хронологическом порядке (с фильтром по модели и времени)."""
+        sql = f"SELECT message_id, model, ts, {', '.join(METRIC_FIELDS)} FROM metrics WHERE ts >= ?"
+        params: list = [since or 0]
+        if model:
+            sql += " AND model = ?"
+            params.append(model)
+        rows = self._query(sql + " ORDER BY ts", tuple(params))
+        keys = ("message_id", "model", "ts") + METRIC_FIELDS
+        return [dict(zip(keys, r)) for r in rows]
+
+    def import_records(self, records: Iterable[dict]) -> int:
+        """Разовый перенос записей журнала истории: сессии режутся по NEW_CHAT_MARKER."""
+        count = 0
+        session_id = None
+        with self._lock:
+            for rec in records:
+                role, content, ts = rec.get("role", ""), rec.get("content", ""), float(rec.get("ts", 0))
+                if role == "system" and content == NEW_CHAT_MARKER:
+                    session_id = None
+                    continue
+                if session_id is None:
+                    session_id = self.new_session(ts=ts)
+                self.add_message(session_id, role, content, ts=ts)
+                count += 1
+            self._commit()
+        return count
+
+
+# ====== Полнотекстовый поиск ======
+# Маркеры подсветки в сниппетах (управляющие символы не встречаются в тексте)
+HIT_START = "\x02"
+HIT_END = "\x03"
+
+
+def fts_query(text: str) -> str:
+    """Пользовательский ввод -> запрос FTS5: все слова обязательны, последнее — префикс."""
+    words = re.findall(r"\w+", text.lower())
+    if not words:
+        return ""
+    terms = [f'"{w}"' for w in words[:-1]] + [f'"{words[-1]}"*']
+    return " ".join(terms)
+
+
+class SearchIndex:
+    """Инвертированный индекс (SQLite FTS5) по всем сообщениям.
+
+    Отдельный файл, чтобы индексатор не конкурировал за блокировку с
+    основным хранилищем. Новые сообщения ставятся в очередь и
+    индексируются фоновым потоком пачками; при старте поток догоняет
+    сообщения, которых в индексе ещё нет (rowid = id сообщения).
+    Поиск выполняется в вызывающем потоке по отдельному соединению.
+    """
+
+    def __init__(self, path: str = SEARCH_PATH):
+        self.path = path
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._queue: "queue.Queue[Optional[tuple]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._db = self._connect()
+        self._db.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+            "content, session_id UNINDEXED, role UNINDEXED, ts UNINDEXED,"
+            " tokenize = 'unicode61 remove_diacritics 2')"
+        )
+        self._db.commit()
+
+    def _connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute("PRAGMA busy_timeout=5000")
+        return db
+
+    def start(self, store: Optional[ConversationStore] = None):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, args=(store,), name="search-index", daemon=True)
+            self._thread.start()
+
+    def add(self, msg_id: int, session_id: int, role: str, content: str, ts: float):
+        self._queue.put(("add", (msg_id, session_id, role, content, ts)))
+
+    def delete_session(self, session_id: int):
+        self._queue.put(("delete", session_id))
+
+    def stop(self, timeout: float = 5.0):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self, store: Optional[ConversationStore]):
+        db = self._connect()
+        if store is not None:
+            self._catch_up(db, store)
+        while True:
+            item = self._queue.get()
+            batch = [item]
+            # Забираем всё, что уже накопилось, одной транзакцией
+            while item is not None and len(batch) < 500:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                batch.append(item)
+            for entry in batch:
+                if entry is None:
+                    continue
+                kind, arg = entry
+                if kind == "add":
+                    self._insert(db, [arg])
+                else:
+                    db.execute("DELETE FROM messages_fts WHERE session_id = ?", (arg,))
+            db.commit()
+            if batch[-1] is None:
+                db.close()
+                return
+
+    @staticmethod
+    def _insert(db: sqlite3.Connection, rows: list):
+        db.executemany(
+            "INSERT OR REPLACE INTO messages_fts (rowid, content, session_id, role, ts) VALUES (?, ?, ?, ?, ?)",
+            [(r[0], r[3], r[1], r[2], r[4]) for r in rows],
+        )
+
+    def _catch_up(self, db: sqlite3.Connection, store: ConversationStore):
+        last = db.execute("SELECT COALESCE(MAX(rowid), 0) FROM messages_fts").fetchone()[0]
+        while True:
+            rows = store.messages_after(last)
+            if not rows:
+                break
+            self._insert(db, rows)
+            db.commit()
+            last = rows[-1][0]
+
+    def search(self, text: str, limit: int = 50) -> List[dict]:
+        """Результаты по релевантности (BM25) со сниппетом, где совпадения
+        обрамлены HIT_START/HIT_END."""
+        query = fts_query(text)
+        if not query:
+            return []
+        with self._lock:
+            try:
+                rows = self._db.execute(
+                    "SELECT rowid, session_id, role, ts,"
+                    " snippet(messages_fts, 0, ?, ?, '…', 16)"
+                    " FROM messages_fts WHERE messages_fts MATCH ? ORDER BY bm25(messages_fts) LIMIT ?",
+                    (HIT_START, HIT_END, query, limit),
+                ).fetchall()
+            except sqlite3.OperationalError:
+                return []
+        return [
+            {"id": r[0], "session_id": r[1], "role": r[2], "ts": r[3], "snippet": r[4]}
+            for r in rows
+        ]
+
+    def close(self):
+        self.stop()
+        with self._lock:
+            self._db.close()
+
+
+# ====== Память: семантический поиск по прошлым разговорам ======
+
+def _numpy():
+    """numpy нужен только памяти — необязательная зависимость."""
+    try:
+        import numpy
+    except ImportError as e:
+        raise RuntimeError("для памяти нужен numpy (pip install numpy)") from e
+    return numpy
+
+
+def memory_available() -> bool:
+    try:
+        _numpy()
+    except RuntimeError:
+        return False
+    return True
+
+
+def embed_texts(client: OllamaClient, model: str, texts: List[str]) -> List[List[float]]:
+    """Эмбеддинги пачкой через /api/embed; Ollama до 0.3 — /api/embeddings по одному."""
+    try:
+        return client.post_json("/api/embed", {"model": model, "input": texts})["embeddings"]
+    except Exception as e:
+        r = getattr(e, "response", None)
+        # «404 page not found» без JSON — эндпоинта нет; «model not found» — ошибка как есть
+        if r is None or r.status_code != 404 or "model" in r.text:
+            raise
+    return [client.post_json("/api/embeddings", {"model": model, "prompt": t})["embedding"] for t in texts]
+
+
+def exchange_text(question: Optional[str], answer: str, limit: int = 1500) -> str:
+    """Текст обмена вопрос→ответ: и для эмбеддинга, и для подмешивания в контекст."""
+    q = (question or "").strip()
+    text = f"Вопрос: {q[:500]}\nОтвет: {answer.strip()}" if q else answer.strip()
+    return text[:limit]
+
+
+class MemoryIndex:
+    """Векторный индекс прошлых ответов для подмешивания в контекст.
+
+    Единица — ответ ассистента вместе с вопросом перед ним. Эмбеддинги
+    считает Ollama фоновым потоком пачками по batch_size; при старте и
+    по notify() поток догоняет ответы, которых в индексе ещё нет (по id,
+    как SearchIndex). Файлы в каталоге модели только дописываются:
+      vectors.i8, scales.f32 — нормированные векторы в int8 и масштаб строки
+                               (memmap, ~dim байт на строку);
+      codes.u8               — знаки (вектор − center), бит на измерение;
+      ids.i64, sessions.i64  — id ответа и разговора для каждой строки;
+      meta.json              — размерность, число строк, last_id, center.
+
+    Поиск в два шага: расстояние Хэмминга по битовым кодам (в памяти,
+    ~dim/8 байт на строку) отбирает около candidates строк, их
+    переранжирует косинус по int8‑векторам из memmap. center
+    пересчитывается, когда индекс вырастает вчетверо. Удалённые разговоры отсеиваются при выдаче,
+    из файлов их убирает rebuild().
+    """
+
+    FILES = ("vectors.i8", "scales.f32", "codes.u8", "ids.i64", "sessions.i64", "meta.json")
+
+    def __init__(self, store: Optional[ConversationStore], model: str = DEFAULT_EMBED_MODEL,
+                 root: str = MEMORY_DIR, client: Optional[OllamaClient] = None,
+                 batch_size: int = 16, candidates: int = 512, min_score: float = 0.5):
+        self.np = _numpy()
+        self.store = store
+        self.model = model
+        self.dir = os.path.join(root, re.sub(r"[^\w.-]+", "_", model))
+        self.client = client
+        self.batch_size = batch_size
+        self.candidates = candidates
+        self.min_score = min_score
+        self.last_error = ""
+        self.indexing = False
+        self._lock = threading.Lock()  # массивы для поиска
+        self._write_lock = threading.Lock()  # один пишущий: фоновый поток или rebuild
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._rebuild = False
+        self._thread: Optional[threading.Thread] = None
+        os.makedirs(self.dir, exist_ok=True)
+        self._load()
+
+    # --- файлы ---
+    def _path(self, name: str) -> str:
+        return os.path.join(self.dir, name)
+
+    def _load(self):
+        np = self.np
+        try:
+            with open(self._path("meta.json"), "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            meta = {}
+        self.count = int(meta.get("count", 0))
+        self.dim = int(meta.get("dim", 0))
+        self.last_id = int(meta.get("last_id", 0))
+        self.center_count = int(meta.get("center_count", 0))
+        self.center = np.asarray(meta["center"], dtype=np.float32) if meta.get("center") else None
+        self.words = (self.dim + 63) // 64
+        n = self.count
+        if n:
+            codes = np.fromfile(self._path("codes.u8"), dtype=np.uint8, count=n * self.words * 8)
+            self._codes_t = np.ascontiguousarray(codes.view(np.uint64).reshape(n, self.words).T)
+            self._ids = np.fromfile(self._path("ids.i64"), dtype=np.int64, count=n)
+            self._sessions = np.fromfile(self._path("sessions.i64"), dtype=np.int64, count=n)
+            self._scales = np.fromfile(self._path("scales.f32"), dtype=np.float32, count=n)
+            self._vectors = self._map_vectors(n)
+        else:
+            self._codes_t = np.zeros((self.words, 0), dtype=np.uint64)
+            self._ids = np.zeros(0, dtype=np.int64)
+            self._sessions = np.zeros(0, dtype=np.int64)
+            self._scales = np.zeros(0, dtype=np.float32)
+            self._vectors = None
+
+    def _map_vectors(self, n: int):
+        # Голый ndarray поверх memmap: без накладных расходов подкласса на каждый поиск
+        np = self.np
+        return np.asarray(np.memmap(self._path("vectors.i8"), dtype=np.int8, mode="r", shape=(n, self.dim)))
+
+    def _save_meta(self):
+        meta = {
+            "model": self.model, "dim": self.dim, "count": self.count, "last_id": self.last_id,
+            "center_count": self.center_count,
+            "center": None if self.center is None else [round(float(x), 6) for x in self.center],
+        }
+        write_text_atomic(self._path("meta.json"), json.dumps(meta))
+
+    def _append(self, name: str, data: bytes, offset: int):
+        # Хвост после сбоя (строки без meta) обрезается
+        path = self._path(name)
+        with open(path, "r+b" if os.path.exists(path) else "wb") as f:
+            f.seek(offset)
+            f.truncate()
+            f.write(data)
+
+    def _pack(self, mat) -> "object":
+        """Битовые коды (строки × words×8 байт): знак (v − center) по измерениям."""
+        np = self.np
+        bits = np.zeros((len(mat), self.words * 64), dtype=bool)
+        bits[:, :self.dim] = mat > self.center
+        return np.packbits(bits, axis=1)
+
+    def _add(self, rows: List[tuple], vectors: List[List[float]]):
+        np = self.np
+        mat = np.asarray(vectors, dtype=np.float32)
+        if mat.ndim != 2 or len(mat) != len(rows):
+            raise ValueError("неожиданный ответ эмбеддингов")
+        if not self.dim:
+            self.dim = mat.shape[1]
+            self.words = (self.dim + 63) // 64
+            self._codes_t = np.zeros((self.words, 0), dtype=np.uint64)
+        elif mat.shape[1] != self.dim:
+            raise ValueError(f"размерность {mat.shape[1]} вместо {self.dim} — перестройте память")
+        mat /= np.maximum(np.linalg.norm(mat, axis=1, keepdims=True), 1e-12)
+        if self.center is None:
+            self.center = mat.mean(axis=0)
+            self.center_count = len(mat)
+        n = self.count
+        codes = self._pack(mat)
+        scales = np.maximum(np.abs(mat).max(axis=1), 1e-12) / 127
+        quantized = np.rint(mat / scales[:, None]).astype(np.int8)
+        ids = np.array([r[0] for r in rows], dtype=np.int64)
+        sessions = np.array([r[1] for r in rows], dtype=np.int64)
+        self._append("vectors.i8", quantized.tobytes(), n * self.dim)
+        self._append("scales.f32", scales.astype(np.float32).tobytes(), n * 4)
+        self._append("codes.u8", codes.tobytes(), n * self.words * 8)
+        self._append("ids.i64", ids.tobytes(), n * 8)
+        self._append("sessions.i64", sessions.tobytes(), n * 8)
+        vectors_map = self._map_vectors(n + len(rows))
+        codes_t = np.concatenate([self._codes_t, codes.view(np.uint64).T], axis=1)
+        with self._lock:
+            self._codes_t = codes_t
+            self._ids = np.concatenate([self._ids, ids])
+            self._sessions = np.concatenate([self._sessions, sessions])
+            self._scales = np.concatenate([self._scales, scales.astype(np.float32)])
+            self._vectors = vectors_map
+            self.count = n + len(rows)
+        if self.count >= 4 * self.center_count:
+            self._recenter()
+
+    def _recenter(self, chunk: int = 8192):
+        """Центр по всем векторам и новые коды для всех строк (без запросов к Ollama)."""
+        np = self.np
+
+        def rows(i: int):
+            return self._vectors[i:i + chunk].astype(np.float32) * self._scales[i:i + chunk, None]
+
+        total = np.zeros(self.dim, dtype=np.float64)
+        for i in range(0, self.count, chunk):
+            total += rows(i).sum(axis=0)
+        self.center = (total / max(1, self.count)).astype(np.float32)
+        self.center_count = self.count
+        codes = np.concatenate([self._pack(rows(i)) for i in range(0, self.count, chunk)])
+        self._append("codes.u8", codes.tobytes(), 0)
+        codes_t = np.ascontiguousarray(codes.view(np.uint64).T)
+        with self._lock:
+            self._codes_t = codes_t
+
+    def _reset(self):
+        with self._lock:
+            for name in self.FILES:
+                try:
+                    os.unlink(self._path(name))
+                except FileNotFoundError:
+                    pass
+            self._load()
+
+    # --- индексация ---
+    def index_pending(self, progress: Optional[Callable[[int], None]] = None) -> int:
+        """Догоняет новые ответы из хранилища; возвращает, сколько добавлено."""
+        done = 0
+        with self._write_lock:
+            while not self._stop.is_set():
+                rows = self.store.exchanges_after(self.last_id, self.batch_size)
+                if not rows:
+                    break
+                rows_with_text = [(r, exchange_text(r[3], r[4])) for r in rows]
+                rows_with_text = [(r, t) for r, t in rows_with_text if t]
+                if rows_with_text:
+                    vectors = embed_texts(self.client or get_client(), self.model,
+                                          [t for _, t in rows_with_text])
+                    self._add([r for r, _ in rows_with_text], vectors)
+                self.last_id = rows[-1][0]
+                self._save_meta()
+                done += len(rows)
+                if progress is not None:
+                    progress(done)
+        return done
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="memory-index", daemon=True)
+            self._thread.start()
+
+    def notify(self):
+        """В хранилище появились новые ответы."""
+        self._wake.set()
+
+    def rebuild(self, progress: Optional[Callable[[int], None]] = None) -> int:
+        """Индекс заново: удалённые разговоры уходят, все векторы пересчитываются.
+        С фоновым потоком — в нём (сразу возвращает 0), иначе синхронно."""
+        if self._thread is not None:
+            self._rebuild = True
+            self._wake.set()
+            return 0
+        with self._write_lock:
+            self._reset()
+        return self.index_pending(progress)
+
+    def _run(self):
+        while not self._stop.is_set():
+            if self._rebuild:
+                self._rebuild = False
+                with self._write_lock:
+                    self._reset()
+            self.indexing = True
+            wait: Optional[float] = None
+            try:
+                self.index_pending()
+                self.last_error = ""
+            except Exception as e:
+                # Ollama недоступна или модель эмбеддингов не скачана — попробуем позже
+                self.last_error = str(e)
+                wait = 60.0
+            finally:
+                self.indexing = False
+            self._wake.wait(wait)
+            self._wake.clear()
+
+    def stop(self, timeout: float = 5.0):
+        if self._thread is not None:
+            self._stop.set()
+            self._wake.set()
+            self._thread.join(timeout)
+            self._thread = None
+
+    def close(self):
+        self.stop()
+
+    # --- поиск ---
+    def _hamming(self, codes_t, qwords):
+        np = self.np
+        n = codes_t.shape[1]
+        dist = np.zeros(n, dtype=np.uint16)
+        x = np.empty(n, dtype=np.uint64)
+        count = getattr(np, "bitwise_count", None)  # numpy 2.0+
+        bits = np.empty(n, dtype=np.uint8)
+        for j in range(codes_t.shape[0]):
+            np.bitwise_xor(codes_t[j], qwords[j], out=x)
+            if count is not None:
+                count(x, out=bits)
+                dist += bits
+            else:
+                dist += _popcount8(np)[x.view(np.uint8).reshape(-1, 8)].sum(axis=1, dtype=np.uint16)
+        return dist
+
+    def search(self, query: Sequence[float], k: int = 3,
+               exclude_session: Optional[int] = None) -> List[Tuple[int, float]]:
+        """(id ответа, косинус) лучших k строк; exclude_session — текущий разговор."""
+        np = self.np
+        with self._lock:
+            codes_t, ids, sessions = self._codes_t, self._ids, self._sessions
+            vectors, scales = self._vectors, self._scales
+        n = len(ids)
+        if not n:
+            return []
+        q = np.asarray(query, dtype=np.float32)
+        if q.shape != (self.dim,):
+            raise ValueError(f"размерность запроса {q.shape[0]} вместо {self.dim}")
+        q /= max(float(np.linalg.norm(q)), 1e-12)
+        if n <= self.candidates:
+            cand = np.arange(n)
+        else:
+            dist = self._hamming(codes_t, self._pack(q[None, :])[0].view(np.uint64))
+            if exclude_session is not None:
+                dist[sessions == exclude_session] = self.dim + 1
+            # Расстояния — целые 0..dim: порог по гистограмме дешевле argpartition
+            cut = int(np.searchsorted(np.cumsum(np.bincount(dist)), self.candidates))
+            cand = np.flatnonzero(dist <= cut)
+            if len(cand) > 2 * self.candidates:
+                cand = np.sort(cand[np.argpartition(dist[cand], self.candidates)[:self.candidates]])
+        scores = (vectors[cand].astype(np.float32) @ q) * scales[cand]
+        if exclude_session is not None:
+            scores[sessions[cand] == exclude_session] = -np.inf
+        top = np.argsort(-scores)[:k]
+        return [(int(ids[cand[i]]), float(scores[i])) for i in top if np.isfinite(scores[i])]
+
+    def recall(self, text: str, k: int = 3, exclude_session: Optional[int] = None) -> List[str]:
+        """Фрагменты для ContextBuilder.build(memory=...). Ошибка — пустой список:
+        память не должна мешать ответу."""
+        if not self.count:
+            return []
+        try:
+            vector = embed_texts(self.client or get_client(), self.model, [text])[0]
+            hits = [(i, s) for i, s in self.search(vector, k, exclude_session) if s >= self.min_score]
+            rows = self.store.exchanges([i for i, _ in hits])
+        except Exception as e:
+            self.last_error = str(e)
+            return []
+        out = []
+        for msg_id, _score in hits:
+            r = rows.get(msg_id)
+            if r is not None:
+                day = time.strftime("%Y-%m-%d", time.localtime(r[2]))
+                out.append(f"[{day}] {exchange_text(r[3], r[4], limit=1200)}")
+        return out
+
+    def status(self) -> dict:
+        size = 0
+        for name in self.FILES:
+            try:
+                size += os.path.getsize(self._path(name))
+            except OSError:
+                pass
+        pending = self.store.count_answers_after(self.last_id) if self.store is not None else 0
+        return {"model": self.model, "count": self.count, "dim": self.dim, "pending": pending,
+                "bytes": size, "indexing": self.indexing, "error": self.last_error}
+
+
+_popcount_table = None
+
+
+def _popcount8(np):
+    """Таблица popcount для байтов — если в numpy нет bitwise_count."""
+    global _popcount_table
+    if _popcount_table is None:
+        _popcount_table = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+    return _popcount_table
+
+
+# ====== Сегментированный журнал истории ======
+def _parse_lines(data: bytes) -> List[dict]:
+    out = []
+    for line in data.splitlines():
+        if not line:
+            continue
+        try:
+            out.append(json.loads(line))
+        except ValueError:
+            continue
+    return out
+
+
+def _is_marker(rec: dict) -> bool:
+    return rec.get("role") == "system" and rec.get("content") == NEW_CHAT_MARKER
+
+
+def _find_last_marker(buf, marker: bytes) -> Optional[Tuple[int, int]]:
+    """(начало, конец) последней строки‑маркера нового чата в bytes/mmap.
+
+    Совпадение проверяется разбором строки: текст «--- new chat ---»
+    внутри обычного сообщения маркером не считается.
+    """
+    pos = buf.rfind(marker)
+    while pos >= 0:
+        start = buf.rfind(b"\n", 0, pos) + 1
+        end = buf.find(b"\n", pos)
+        if end < 0:
+            end = len(buf)
+        recs = _parse_lines(buf[start:end])
+        if recs and _is_marker(recs[0]):
+            return start, end
+        pos = buf.rfind(marker, 0, pos)
+    return None
+
+
+def gzip_member(data: bytes, level: int = 6) -> bytes:
+    """Один самостоятельный gzip‑member (распаковывается zlib с wbits=31)."""
+    comp = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return comp.compress(data) + comp.flush()
+
+
+class HistoryLog:
+    """Журнал history в виде сегментов ограниченного размера.
+
+    Активный сегмент — обычный seg-NNNNNN.jsonl, в него дописываются
+    записи. Когда он превышает segment_bytes, открывается следующий, а
+    закрытый фоновый поток сжимает в seg-NNNNNN.jsonl.gz: каждые
+    ~block_bytes записей — отдельный gzip‑member, поэтому любой блок
+    распаковывается сам по себе. Рядом кладётся разреженный индекс
+    seg-NNNNNN.idx.json: для каждого блока смещение, длина, диапазон ts и
+    позиция последнего маркера нового чата.
+
+    Последняя сессия ищется с конца: активный сегмент memory‑map'ится и
+    просматривается rfind'ом, сжатые — по индексу, так что время не
+    зависит от размера архива.
+    """
+
+    MARKER_BYTES = json.dumps(NEW_CHAT_MARKER).encode("utf-8")
+
+    def __init__(self, directory: str = HISTORY_DIR, legacy_path: Optional[str] = HISTORY_PATH,
+                 segment_bytes: int = 4 * 1024 * 1024, block_bytes: int = 64 * 1024):
+        self.dir = directory
+        self.segment_bytes = segment_bytes
+        self.block_bytes = block_bytes
+        self._lock = threading.RLock()
+        self._index_cache: Dict[int, dict] = {}
+        self._jobs: "queue.Queue[Optional[int]]" = queue.Queue()
+        os.makedirs(self.dir, exist_ok=True)
+        if legacy_path and os.path.exists(legacy_path) and not self._segment_numbers():
+            os.replace(legacy_path, self._path(1))
+        plain = [n for n, gz in self.segments() if not gz]
+        self._active = max([n for n, _ in self.segments()], default=0)
+        if not plain or plain[-1] != self._active:
+            self._active += 1
+        self._fh = open(self._path(self._active), "ab")
+        self._worker = threading.Thread(target=self._compress_loop, name="history-compress", daemon=True)
+        self._worker.start()
+        # Закрытые, но не сжатые сегменты (например, после аварийного выхода)
+        for n in plain:
+            if n != self._active:
+                self._jobs.put(n)
+
+    # --- пути и список сегментов ---
+    def _path(self, no: int, gz: bool = False) -> str:
+        return os.path.join(self.dir, f"seg-{no:06d}.jsonl" + (".gz" if gz else ""))
+
+    def _index_path(self, no: int) -> str:
+        return os.path.join(self.dir, f"seg-{no:06d}.idx.json")
+
+    def _segment_numbers(self) -> List[int]:
+        return sorted({n for n, _ in self.segments()})
+
+    def segments(self) -> List[Tuple[int, bool]]:
+        """(номер, сжат ли) по возрастанию; сжатый вариант важнее несжатого."""
+        found: Dict[int, bool] = {}
+        for path in glob.glob(os.path.join(self.dir, "seg-*.jsonl*")):
+            name = os.path.basename(path)
+            if not (name.endswith(".jsonl") or name.endswith(".jsonl.gz")):
+                continue
+            try:
+                no = int(name[4:10])
+            except ValueError:
+                continue
+            found[no] = found.get(no, False) or name.endswith(".gz")
+        return sorted(found.items())
+
+    # --- запись ---
+    def append(self, rec: dict):
+        line = (json.dumps(rec, ensure_ascii=False) + "\n").encode("utf-8")
+        self.append_lines([line])
+
+    def append_lines(self, lines: List[bytes]):
+        with self._lock:
+            self._fh.write(b"".join(lines))
+            self._fh.flush()
+            if self._fh.tell() >= self.segment_bytes:
+                self._roll()
+
+    def _roll(self):
+        self._fh.close()
+        self._jobs.put(self._active)
+        self._active += 1
+        self._fh = open(self._path(self._active), "ab")
+
+    # --- сжатие ---
+    def _compress_loop(self):
+        while True:
+            no = self._jobs.get()
+            try:
+                if no is None:
+                    return
+                self._compress(no)
+            except Exception:
+                pass
+            finally:
+                self._jobs.task_done()
+
+    def _compress(self, no: int):
+        src = self._path(no)
+        if not os.path.exists(src):
+            return
+        blocks = []
+        gz_tmp = self._path(no, gz=True) + ".tmp"
+        with open(src, "rb") as f, open(gz_tmp, "wb") as out:
+            while True:
+                raw = f.read(self.block_bytes)
+                if not raw:
+                    break
+                # Блок заканчиваем на границе строки
+                if not raw.endswith(b"\n"):
+                    raw += f.readline()
+                blocks.append(self._block_meta(raw, out.tell()))
+                member = gzip_member(raw)
+                out.write(member)
+                blocks[-1]["len"] = len(member)
+        index = {"blocks": blocks}
+        write_json_atomic(self._index_path(no), index)
+        os.replace(gz_tmp, self._path(no, gz=True))
+        os.remove(src)
+        with self._lock:
+            self._index_cache[no] = index
+
+    @classmethod
+    def _block_meta(cls, raw: bytes, offset: int) -> dict:
+        recs = _parse_lines(raw)
+        meta = {
+            "off": offset,
+            "len": 0,
+            "ts0": recs[0].get("ts", 0) if recs else 0,
+            "ts1": recs[-1].get("ts", 0) if recs else 0,
+            "marker": -1,
+        }
+        found = _find_last_marker(raw, cls.MARKER_BYTES)
+        if found:
+            meta["marker"] = found[0]
+        return meta
+
+    def wait_idle(self):
+        """Дождаться окончания фонового сжатия (для тестов и бенчмарков)."""
+        self._jobs.join()
+
+    # --- чтение ---
+    def _index(self, no: int) -> dict:
+        with self._lock:
+            idx = self._index_cache.get(no)
+        if idx is None:
+            try:
+                with open(self._index_path(no), "r", encoding="utf-8") as f:
+                    idx = json.load(f)
+            except (OSError, ValueError):
+                idx = {"blocks": []}
+            with self._lock:
+                self._index_cache[no] = idx
+        return idx
+
+    def _read_block(self, no: int, block: dict) -> bytes:
+        with open(self._path(no, gz=True), "rb") as f:
+            f.seek(block["off"])
+            return zlib.decompress(f.read(block["len"]), wbits=31)
+
+    def _read_plain(self, no: int) -> bytes:
+        with self._lock:
+            if no == self._active:
+                self._fh.flush()
+        try:
+            with open(self._path(no), "rb") as f:
+                return f.read()
+        except OSError:
+            return b""
+
+    def _tail_after_marker_plain(self, no: int) -> Optional[bytes]:
+        """Данные активного/несжатого сегмента после последнего маркера (mmap + rfind)."""
+        with self._lock:
+            if no == self._active:
+                self._fh.flush()
+        path = self._path(no)
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            return None
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            found = _find_last_marker(mm, self.MARKER_BYTES)
+            return mm[found[1] + 1:] if found else None
+
+    def last_session(self) -> List[dict]:
+        """Записи после последнего маркера нового чата (или весь журнал, если маркеров нет)."""
+        parts: List[bytes] = []
+        for no, gz in reversed(self.segments()):
+            if not gz:
+                tail = self._tail_after_marker_plain(no)
+                if tail is not None:
+                    parts.append(tail)
+                    break
+                parts.append(self._read_plain(no))
+                continue
+            blocks = self._index(no)["blocks"]
+            found = False
+            for block in reversed(blocks):
+                raw = self._read_block(no, block)
+                if block["marker"] >= 0:
+                    nl = raw.find(b"\n", block["marker"])
+                    parts.append(raw[nl + 1:] if nl >= 0 else b"")
+                    found = True
+                    break
+                parts.append(raw)
+            if found:
+                break
+        return _parse_lines(b"".join(reversed(parts)))
+
+    def read_range(self, ts_from: float, ts_to: float) -> List[dict]:
+        """Записи с ts в [ts_from, ts_to]; сжатые блоки вне диапазона не читаются."""
+        out: List[dict] = []
+        for no, gz in self.segments():
+            if gz:
+                for block in self._index(no)["blocks"]:
+                    if block["ts1"] < ts_from or block["ts0"] > ts_to:
+                        continue
+                    out.extend(_parse_lines(self._read_block(no, block)))
+            else:
+                out.extend(_parse_lines(self._read_plain(no)))
+        return [r for r in out if ts_from <= r.get("ts", 0) <= ts_to]
+
+    def iter_records(self) -> Iterator[dict]:
+        for no, gz in self.segments():
+            if gz:
+                for block in self._index(no)["blocks"]:
+                    yield from _parse_lines(self._read_block(no, block))
+            else:
+                yield from _parse_lines(self._read_plain(no))
+
+    # --- обслуживание ---
+    def compact(self, max_bytes: int = 64 * 1024 * 1024) -> Tuple[int, int]:
+        """Склеить соседние сжатые сегменты в файлы до max_bytes.
+
+        gzip‑member'ы просто дописываются друг к другу, индексы сдвигаются —
+        без повторного сжатия. Возвращает (сегментов до, сегментов после).
+        """
+        self.wait_idle()
+        with self._lock:
+            segs = self.segments()
+            closed = [n for n, gz in segs if gz]
+            before = len(segs)
+            groups: List[List[int]] = []
+            size = 0
+            for no in closed:
+                seg_size = os.path.getsize(self._path(no, gz=True))
+                if groups and size + seg_size <= max_bytes:
+                    groups[-1].append(no)
+                    size += seg_size
+                else:
+                    groups.append([no])
+                    size = seg_size
+            for group in groups:
+                if len(group) < 2:
+                    continue
+                head = group[0]
+                blocks = list(self._index(head)["blocks"])
+                with open(self._path(head, gz=True), "ab") as out:
+                    for no in group[1:]:
+                        shift = out.tell()
+                        with open(self._path(no, gz=True), "rb") as f:
+                            out.write(f.read())
+                        for block in self._index(no)["blocks"]:
+                            blocks.append(dict(block, off=block["off"] + shift))
+                index = {"blocks": blocks}
+                write_json_atomic(self._index_path(head), index)
+                self._index_cache[head] = index
+                for no in group[1:]:
+                    os.remove(self._path(no, gz=True))
+                    os.remove(self._index_path(no))
+                    self._index_cache.pop(no, None)
+            return before, len(self.segments())
+
+    def close(self):
+        self._jobs.put(None)
+        self._worker.join(timeout=10)
+        with self._lock:
+            self._fh.close()
+
+
+
+# ====== Фоновая запись ======
+class WriteBehind:
+    """Фоновый писатель: конфиг и история уходят с GUI‑потока.
+
+    - save_config: последняя версия за пачку побеждает; файл
+      переписывается атомарно и только если содержимое изменилось;
+    - new_session: id разговора выдаётся сразу из счётчика в памяти,
+      а строка в хранилище создаётся здесь же, перед его сообщениями —
+      GUI‑поток не ждёт SQLite даже на первом сообщении чата;
+    - append_history: записи копятся и дописываются в журнал одной
+      операцией, затем попадают в хранилище и поисковый индекс,
+      а память (MemoryIndex) узнаёт о новых ответах;
+    - flush() ждёт, пока всё поставленное в очередь будет записано.
+
+    Журнал, каждая запись хранилища и каждый конфиг пишутся отдельно:
+    сбой одного не отменяет остальные. Неудавшаяся запись повторяется
+    один раз через retry_delay, затем ошибка печатается в stderr и
+    уходит в on_error(текст) — вызывается из фонового потока.
+    """
+
+    def __init__(self, history_log: "HistoryLog", store: Optional[ConversationStore] = None,
+                 search_index: Optional["SearchIndex"] = None, idle_flush: float = 1.0,
+                 memory: Optional[MemoryIndex] = None, on_error: Optional[Callable[[str], None]] = None,
+                 retry_delay: float = 0.5):
+        self.history_log = history_log
+        self.store = store
+        self.search_index = search_index
+        self.memory = memory
+        self.on_error = on_error
+        self.retry_delay = retry_delay
+        self.idle_flush = idle_flush
+        self._queue: "queue.Queue[Optional[tuple]]" = queue.Queue()
+        self._written: Dict[str, str] = {}
+        # Хранилище пишет только этот поток, поэтому id сессий можно выдавать заранее
+        self._next_session = store.max_session_id() + 1 if store is not None else 1
+        self._session_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+
+    def save_config(self, path: str, data: dict):
+        self._queue.put(("config", path, data))
+
+    def new_session(self, model: str = "") -> int:
+        """id нового разговора; строка в хранилище появится до его первого сообщения."""
+        with self._session_lock:
+            session_id = self._next_session
+            self._next_session += 1
+        self._queue.put(("session", session_id, model, time.time()))
+        return session_id
+
+    def append_history(self, rec: dict, session_id: Optional[int] = None, model: str = ""):
+        """rec — запись журнала {"ts", "role", "content"}; session_id=None — только журнал."""
+        self._queue.put(("history", rec, session_id, model))
+
+    def flush(self):
+        self._queue.join()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join(timeout=10)
+
+    def _run(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=self.idle_flush)
+            except queue.Empty:
+                # Простой — фиксируем отложенные транзакции хранилища
+                if self.store is not None:
+                    self._attempt("хранилище (commit)", self.store.flush)
+                continue
+            batch = [item]
+            while item is not None:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                batch.append(item)
+            try:
+                self._write_batch([b for b in batch if b is not None])
+            except Exception as e:
+                self._report("пачка записей", e)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+            if batch[-1] is None:
+                if self.store is not None:
+                    self._attempt("хранилище (commit)", self.store.flush)
+                return
+
+    def _report(self, what: str, error: BaseException):
+        text = f"не удалось записать {what}: {error}"
+        print(f"❌ {text}", file=sys.stderr)
+        if self.on_error is not None:
+            try:
+                self.on_error(text)
+            except Exception:
+                pass
+
+    def _attempt(self, what: str, fn: Callable, *args):
+        """fn(*args) с одним повтором; (True, результат) или (False, None) после отчёта об ошибке."""
+        for attempt in range(2):
+            try:
+                return True, fn(*args)
+            except Exception as e:
+                if attempt:
+                    self._report(what, e)
+                else:
+                    time.sleep(self.retry_delay)
+        return False, None
+
+    def _write_batch(self, batch: List[tuple]):
+        configs: Dict[str, dict] = {}
+        lines: List[bytes] = []
+        records = []
+        sessions = []
+        for entry in batch:
+            if entry[0] == "config":
+                configs[entry[1]] = entry[2]
+                continue
+            if entry[0] == "session":
+                sessions.append(entry[1:])
+                continue
+            _, rec, session_id, model = entry
+            try:
+                lines.append((json.dumps(rec, ensure_ascii=False) + "\n").encode("utf-8"))
+            except (TypeError, ValueError) as e:
+                self._report("строку журнала", e)
+                continue
+            if session_id is not None:
+                records.append((rec, session_id, model))
+        if lines:
+            self._attempt("журнал истории", self.history_log.append_lines, lines)
+        # Сессии пачки выданы раньше её сообщений — создаём их первыми
+        for session_id, model, ts in sessions:
+            if self.store is not None:
+                self._attempt("разговор в хранилище", self.store.new_session, model, ts, session_id)
+        stored = False
+        for rec, session_id, model in records:
+            if self.store is None:
+                break
+            ok, msg_id = self._attempt(
+                "сообщение в хранилище", lambda r=rec, sid=session_id, m=model: self.store.add_message(
+                    sid, r["role"], r["content"], m, ts=r["ts"], metrics=r.get("metrics")))
+            if not ok:
+                continue
+            stored = stored or rec["role"] == "assistant"
+            if self.search_index is not None:
+                self._attempt("поисковый индекс", self.search_index.add,
+                              msg_id, session_id, rec["role"], rec["content"], rec["ts"])
+        memory = self.memory
+        if memory is not None and stored:
+            memory.notify()
+        for path, data in configs.items():
+            self._attempt(f"конфиг {path}", self._write_config, path, data)
+
+    def _write_config(self, path: str, data: dict):
+        text = json.dumps(data, ensure_ascii=False, indent=2)
+        if path not in self._written:
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    self._written[path] = f.read()
+            except OSError:
+                self._written[path] = ""
+        if text == self._written[path]:
+            return
+        write_text_atomic(path, text)
+        self._written[path] = text
+
+
+# ====== Чёрный список команд ======
+try:  # Python 3.11+
+    from re import _constants as _sre_c, _parser as _sre_parse
+except ImportError:  # pragma: no cover - Python < 3.11
+    import sre_constants as _sre_c
+    import sre_parse as _sre_parse
+
+# Узлы нулевой ширины не разрывают цепочку литералов (\b, ^, $)
+_ZERO_WIDTH = {_sre_c.AT}
+
+
+def _literal_options(items) -> Tuple[str, ...]:
+    """Лучший набор литералов для последовательности узлов sre.
+
+    Набор означает «в совпадении есть хотя бы одна из этих строк».
+    Цепочка литералов даёт набор из одной строки; группа — набор своего
+    содержимого; альтернатива — объединение наборов веток (если у каждой
+    ветки он есть). Из кандидатов берётся тот, у которого самая короткая
+    строка длиннее: она и определяет, насколько редко правило всплывает.
+    """
+    candidates: List[Tuple[str, ...]] = []
+    run: List[str] = []
+
+    def close_run():
+        if run:
+            candidates.append(("".join(run),))
+            run.clear()
+
+    for op, arg in items:
+        if op is _sre_c.LITERAL:
+            run.append(chr(arg))
+            continue
+        if op in _ZERO_WIDTH:
+            continue
+        close_run()
+        if op is _sre_c.SUBPATTERN:
+            sub = _literal_options(arg[-1])
+            if sub:
+                candidates.append(sub)
+        elif op is _sre_c.BRANCH:
+            branches = [_literal_options(b) for b in arg[1]]
+            if branches and all(branches):
+                candidates.append(tuple(sorted({lit for b in branches for lit in b})))
+    close_run()
+    candidates = [c for c in candidates if min(map(len, c)) >= 2]
+    if not candidates:
+        return ()
+    return max(candidates, key=lambda c: (min(map(len, c)), -len(c)))
+
+
+def required_literals(pattern: str) -> Tuple[str, ...]:
+    """Строки (в нижнем регистре), одна из которых есть в любом совпадении.
+
+    Пустой кортеж — подходящих литералов нет (или regex невалиден),
+    и правило приходится проверять на каждой команде.
+    """
+    try:
+        parsed = _sre_parse.parse(pattern, re.I)
+    except re.error:
+        return ()
+    return tuple(lit.lower() for lit in _literal_options(list(parsed)))
+
+
+class DenyMatcher:
+    """Чёрный список regex, скомпилированный один раз на набор правил.
+
+    Проверка команды не перебирает все правила:
+    - у правила с обязательными литералами («mkfs.», «--no-preserve-root»,
+      ветки «shutdown|reboot») литералы разложены в словарь по первым
+      2–3 символам, и по команде делается один проход — кандидатами
+      становятся только правила, чей литерал в ней действительно встретился;
+    - правила без литерала склеены в одну альтернативу с группой на
+      каждое правило, так что для них хватает одного re.search.
+    Цена проверки зависит от длины команды и числа кандидатов, а не от
+    размера списка. Невалидные regex пропускаются (как и раньше) и
+    перечислены в .invalid.
+    """
+
+    def __init__(self, patterns: Sequence[str]):
+        self.patterns: List[str] = list(patterns)
+        self.invalid: List[str] = []
+        self.hits: List[int] = [0] * len(self.patterns)
+        self._compiled: Dict[int, re.Pattern] = {}
+        # Префиксные индексы литералов: первые 2 или 3 символа -> [(литерал, правило)]
+        self._prefix2: Dict[str, List[Tuple[str, int]]] = {}
+        self._prefix3: Dict[str, List[Tuple[str, int]]] = {}
+        self._always: List[int] = []
+        self._combined: Optional[re.Pattern] = None
+        self._group_rule: List[Tuple[int, int]] = []  # (номер группы, правило)
+
+        combinable = []
+        for idx, pat in enumerate(self.patterns):
+            try:
+                self._compiled[idx] = re.compile(pat, re.I)
+            except re.error:
+                self.invalid.append(pat)
+                continue
+            lits = required_literals(pat)
+            for lit in lits:
+                table = self._prefix3 if len(lit) >= 3 else self._prefix2
+                table.setdefault(lit[:3], []).append((lit, idx))
+            if lits:
+                continue
+            if self._compiled[idx].groupindex or "(?P=" in pat or re.search(r"\\\d", pat):
+                self._always.append(idx)
+            else:
+                combinable.append(idx)
+
+        if combinable:
+            parts, group = [], 1
+            for idx in combinable:
+                parts.append(f"({self.patterns[idx]})")
+                self._group_rule.append((group, idx))
+                group += 1 + self._compiled[idx].groups
+            try:
+                self._combined = re.compile("|".join(parts), re.I)
+            except re.error:
+                # Флаги вида (?x) внутри правила не переживают склейку
+                self._always.extend(combinable)
+                self._group_rule = []
+
+    def __len__(self) -> int:
+        return len(self._compiled)
+
+    def _candidates(self, low: str) -> List[int]:
+        found = set()
+        p2, p3 = self._prefix2, self._prefix3
+        for i in range(len(low) - 1):
+            bucket = p2.get(low[i:i + 2])
+            if bucket:
+                for lit, idx in bucket:
+                    if low.startswith(lit, i):
+                        found.add(idx)
+            bucket = p3.get(low[i:i + 3])
+            if bucket:
+                for lit, idx in bucket:
+                    if low.startswith(lit, i):
+                        found.add(idx)
+        return sorted(found)
+
+    def match(self, cmd: str) -> Optional[int]:
+        """Индекс первого по порядку в списке сработавшего правила или None."""
+        if not cmd:
+            return None
+        candidates = self._candidates(cmd.lower())
+        hit = None
+        for idx in candidates:
+            if self._compiled[idx].search(cmd):
+                hit = idx
+                break
+        if hit is None and self._combined is not None:
+            m = self._combined.search(cmd)
+            if m:
+                hit = next(idx for group, idx in self._group_rule if m.start(group) != -1)
+        if hit is None:
+            for idx in self._always:
+                if self._compiled[idx].search(cmd):
+                    hit = idx
+                    break
+        if hit is None:
+            return None
+        # Источники находят «какое‑то» правило: склейка — самое левое совпадение,
+        # кандидаты проверяются раньше остальных. Раньше в списке может стоять
+        # правило без литерала или из другого источника — досматриваем только
+        # их; на командах без срабатывания это ничего не стоит
+        earlier = [i for i in candidates if i < hit]
+        earlier += [i for _, i in self._group_rule if i < hit] if self._combined is not None else []
+        earlier += [i for i in self._always if i < hit]
+        for idx in sorted(earlier):
+            if self._compiled[idx].search(cmd):
+                hit = idx
+                break
+        self.hits[hit] += 1
+        return hit
+
+    def rule_for(self, cmd: str) -> Optional[str]:
+        """Текст сработавшего правила или None."""
+        idx = self.match(cmd)
+        return None if idx is None else self.patterns[idx]
+
+    def check_many(self, commands: Iterable[str]) -> List[Optional[str]]:
+        """Пакетная проверка: для каждой команды — сработавшее правило или None."""
+        return [self.rule_for(cmd) for cmd in commands]
+
+    def stats(self) -> List[Tuple[str, int]]:
+        """Правила со счётчиками срабатываний, самые частые первыми."""
+        pairs = [(pat, n) for pat, n in zip(self.patterns, self.hits) if n]
+        return sorted(pairs, key=lambda p: -p[1])
+
+
+# ====== Извлечение команд из ответа ======
+# Языки блоков кода, строки которых считаются командами
+SHELL_FENCE_LANGS = ("", "bash", "sh", "fish")
+_INLINE_CODE_RE = re.compile(r"`([^`\n]+)`")
+_COMMAND_HEAD_RE = re.compile(r"^[a-z0-9_\-./]+$", re.I)
+
+
+class CommandExtractor:
+    """Потоковое извлечение shell-команд из ответа ассистента.
+
+    Конечный автомат по строкам: следит, внутри ли мы блока ```
+    (и shell ли это), ловит `инлайн-код` и строки с `$ `, `> `, `sudo `.
+    feed() принимает очередную дельту стрима и возвращает только новые
+    команды; каждая строка разбирается один раз, когда пришёл её перевод
+    строки, так что работа на дельту пропорциональна её длине, а не
+    всему ответу. Незаконченная последняя строка разбирается в finish().
+    """
+
+    def __init__(self):
+        self.commands: List[str] = []
+        self._seen = set()
+        self._pending: List[str] = []  # куски текущей незаконченной строки
+        self._in_fence = False
+        self._shell_fence = False
+
+    def feed(self, delta: str) -> List[str]:
+        """Новые команды, найденные в строках, которые закончились в delta."""
+        if "\n" not in delta:
+            if delta:
+                self._pending.append(delta)
+            return []
+        found: List[str] = []
+        head, *middle, tail = delta.split("\n")
+        self._pending.append(head)
+        self._line("".join(self._pending), found)
+        for line in middle:
+            self._line(line, found)
+        self._pending = [tail] if tail else []
+        return found
+
+    def finish(self) -> List[str]:
+        """Разбирает хвост без перевода строки; вызывается по концу ответа."""
+        found: List[str] = []
+        if self._pending:
+            self._line("".join(self._pending), found)
+            self._pending = []
+        return found
+
+    def _add(self, cmd: str, found: List[str]) -> None:
+        if cmd and cmd not in self._seen:
+            self._seen.add(cmd)
+            self.commands.append(cmd)
+            found.append(cmd)
+
+    def _line(self, line: str, found: List[str]) -> None:
+        s = line.strip()
+        if self._in_fence:
+            fence = s.find("```")
+            if fence != -1:
+                s = s[:fence].strip()
+                self._in_fence = False
+            if self._shell_fence:
+                # Строка блока shell: без комментариев и приглашений $ / >
+                if s and not s.startswith("#"):
+                    if s.startswith("$ ") or s.startswith("> "):
+                        s = s[2:].strip()
+                    self._add(s, found)
+                return
+        elif s.startswith("```"):
+            self._in_fence = True
+            self._shell_fence = s[3:].strip().lower() in SHELL_FENCE_LANGS
+            return
+        else:
+            for cmd in _INLINE_CODE_RE.findall(line):
+                cmd = cmd.strip()
+                parts = cmd.split()
+                if parts and len(cmd) < 200 and _COMMAND_HEAD_RE.match(parts[0]):
+                    self._add(cmd, found)
+        # Строки с приглашением или sudo — в любом месте ответа
+        if s.startswith("$ ") or s.startswith("> "):
+            self._add(s[2:].strip(), found)
+        elif s.startswith("sudo "):
+            self._add(s, found)
+
+
+def parse_commands(text: str) -> List[str]:
+    """Все команды из готового текста (тот же автомат за один проход)."""
+    extractor = CommandExtractor()
+    extractor.feed(text or "")
+    extractor.finish()
+    return extractor.commands
+
+
+# ====== Вывод выполняемых команд ======
+class OutputRing:
+    """Кольцевой буфер строк вывода процесса, ограниченный по числу строк.
+
+    Читатель кладёт сюда сырые байты (feed), GUI забирает накопленное
+    пачкой (take). Если GUI не успевает и в буфере больше max_lines
+    строк, старые выбрасываются (счётчик dropped). Строка длиннее
+    max_line_bytes обрезается (счётчик truncated) — так и поток без
+    переводов строки (прогресс‑бары через \\r) не раздувает память.
+    """
+
+    def __init__(self, max_lines: int = 5000, max_line_bytes: int = 4096):
+        self.max_lines = max(1, max_lines)
+        self.max_line_bytes = max(16, max_line_bytes)
+        self.lines_total = 0
+        self.bytes_total = 0
+        self.dropped = 0
+        self.truncated = 0
+        self.started = time.monotonic()
+        self.ended: Optional[float] = None
+        self._lines: "deque[Tuple[str, str]]" = deque()
+        # Недочитанная строка по каждому потоку: (байты, была ли обрезана)
+        self._partial: Dict[str, Tuple[bytearray, bool]] = {}
+        self._lock = threading.Lock()
+
+    def _append_piece(self, stream: str, piece: bytes) -> None:
+        buf, cut = self._partial.get(stream) or (bytearray(), False)
+        room = self.max_line_bytes - len(buf)
+        if len(piece) > room:
+            piece, cut = piece[:max(0, room)], True
+        buf += piece
+        self._partial[stream] = (buf, cut)
+
+    def _end_line(self, stream: str) -> None:
+        buf, cut = self._partial.pop(stream, (bytearray(), False))
+        text = buf.decode("utf-8", errors="replace").rstrip("\r")
+        if cut:
+            self.truncated += 1
+            text += " …"
+        self._lines.append((stream, text))
+        self.lines_total += 1
+        if len(self._lines) > self.max_lines:
+            self._lines.popleft()
+            self.dropped += 1
+
+    def feed(self, stream: str, data: bytes) -> None:
+        """Добавляет сырые байты потока ("out" / "err")."""
+        with self._lock:
+            self.bytes_total += len(data)
+            start = 0
+            while True:
+                nl = data.find(b"\n", start)
+                if nl == -1:
+                    break
+                self._append_piece(stream, data[start:nl])
+                self._end_line(stream)
+                start = nl + 1
+            if start < len(data):
+                self._append_piece(stream, data[start:])
+
+    def close(self) -> None:
+        """Досбрасывает строки без завершающего перевода строки."""
+        with self._lock:
+            for stream in list(self._partial):
+                self._end_line(stream)
+            self.ended = time.monotonic()
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._lines)
+
+    def take(self) -> List[Tuple[str, str]]:
+        """Забирает всё накопленное: [(поток, строка), ...]."""
+        with self._lock:
+            lines = list(self._lines)
+            self._lines.clear()
+            return lines
+
+    def rate(self) -> float:
+        """Строк в секунду от старта до конца вывода (или до текущего момента)."""
+        end = self.ended if self.ended is not None else time.monotonic()
+        return self.lines_total / max(1e-6, end - self.started)
+
+
+# ====== Постоянный shell ======
+class ShellTimeout(Exception):
+    """Команда не завершилась даже после Ctrl+C — shell перезапущен."""
+
+
+class ShellSession:
+    """Долгоживущий shell на pty: cd, переменные и функции переживают команды.
+
+    Команда выполняется как `{ команда\\n} < /dev/null` (чтобы она не
+    съела служебную строку из stdin), после неё shell печатает случайный
+    маркер с кодом возврата — по нему и отделяется вывод. stdout и stderr
+    идут через один терминал и не различаются. Если команда не уложилась
+    в timeout, ей посылается Ctrl+C; если и это не помогло за
+    interrupt_grace секунд, shell убивается и поднимается заново.
+
+    Команды выполняются строго по одной. owner в run() и interrupt()
+    отличает, чья команда сейчас в shell: interrupt(owner) не трогает
+    чужую, а отменённую до захвата shell команду run() не запускает.
+    """
+
+    def __init__(self, shell: Optional[str] = None, cwd: Optional[str] = None,
+                 interrupt_grace: float = 3.0):
+        if shell is None:
+            shell = "/bin/bash" if os.path.exists("/bin/bash") else "/bin/sh"
+        self.shell = shell
+        self.cwd = cwd or os.path.expanduser("~")
+        self.interrupt_grace = interrupt_grace
+        self.commands_run = 0
+        self.restarts = 0
+        self._proc = None
+        self._fd: Optional[int] = None
+        self._sentinel = b""
+        self._interrupted_at: Optional[float] = None
+        self._owner: object = None
+        self._lock = threading.Lock()
+
+    def alive(self) -> bool:
+        return self._proc is not None and self._proc.poll() is None
+
+    def _start(self) -> None:
+        import fcntl
+        import pty
+        import secrets
+        import subprocess
+        import termios
+
+        master, slave = pty.openpty()
+        # Без эха и без \n -> \r\n: читаем ровно то, что напечатала команда.
+        # NOFLSH: Ctrl+C не должен стирать уже отправленную строку с маркером
+        attrs = termios.tcgetattr(slave)
+        attrs[1] &= ~termios.ONLCR
+        attrs[3] &= ~(termios.ECHO | termios.ECHONL)
+        attrs[3] |= termios.NOFLSH
+        termios.tcsetattr(slave, termios.TCSANOW, attrs)
+
+        def make_controlling_tty():
+            # Свой сеанс и pty как управляющий терминал: Ctrl+C дойдёт до команды
+            os.setsid()
+            fcntl.ioctl(0, termios.TIOCSCTTY, 0)
+
+        env = dict(os.environ, PS1="", PS2="", PS4="", PROMPT_COMMAND="",
+                   TERM="dumb", HISTFILE="/dev/null")
+        args = [self.shell]
+        if os.path.basename(self.shell) == "bash":
+            args += ["--norc", "--noprofile", "--noediting"]
+        self._proc = subprocess.Popen(
+            args, stdin=slave, stdout=slave, stderr=slave, cwd=self.cwd, env=env,
+            preexec_fn=make_controlling_tty, close_fds=True,
+        )
+        os.close(slave)
+        self._fd = master
+        self._sentinel = f"__OTC_{secrets.token_hex(8)}__".encode()
+
+    def _stop_process(self) -> None:
+        if self._fd is not None:
+            # Закрытие master — hangup для shell и его заданий
+            try:
+                os.close(self._fd)
+            except OSError:
+                pass
+            self._fd = None
+        if self._proc is not None:
+            try:
+                self._proc.wait(timeout=1)
+            except Exception:
+                self._proc.kill()
+                self._proc.wait()
+            self._proc = None
+
+    def _restart(self) -> None:
+        self._stop_process()
+        self.restarts += 1
+        self._start()
+
+    def interrupt(self, owner: object = None) -> bool:
+        """Ctrl+C текущей команде (можно звать из другого потока).
+        С owner — только если сейчас выполняется команда этого владельца."""
+        fd = self._fd
+        if fd is None or (owner is not None and self._owner is not owner):
+            return False
+        self._interrupted_at = time.monotonic()
+        try:
+            os.write(fd, b"\x03")
+        except OSError:
+            return False
+        return True
+
+    def run(self, command: str, on_data: Optional[Callable[[bytes], None]] = None,
+            timeout: Optional[float] = None, owner: object = None,
+            cancelled: Optional[Callable[[], bool]] = None) -> int:
+        """Выполняет команду и возвращает её код; вывод отдаётся в on_data.
+
+        124 — команда прервана по таймауту (как у timeout(1)); 130 — cancelled()
+        стал True, пока команда ждала shell, и она не запускалась.
+        """
+        with self._lock:
+            if cancelled is not None and cancelled():
+                return 130
+            self._owner = owner
+            try:
+                if not self.alive():
+                    self._stop_process()
+                    self._start()
+                self._interrupted_at = None
+                script = (f"{{ {command}\n}} < /dev/null\n"
+                          f"__otc_rc=$?; printf '%s%d\\n' '{self._sentinel.decode()}' \"$__otc_rc\"\n")
+                os.write(self._fd, script.encode("utf-8"))
+                self.commands_run += 1
+                return self._read_result(on_data or (lambda data: None), timeout)
+            finally:
+                self._owner = None
+
+    def _read_result(self, on_data: Callable[[bytes], None], timeout: Optional[float]) -> int:
+        import select
+
+        sentinel = self._sentinel
+        keep = len(sentinel) - 1
+        deadline = time.monotonic() + timeout if timeout else None
+        timed_out = False
+        buf = b""
+        while True:
+            ready, _, _ = select.select([self._fd], [], [], 0.1)
+            if ready:
+                try:
+                    data = os.read(self._fd, 65536)
+                except OSError:  # EIO: shell закрыл терминал
+                    data = b""
+                if not data:
+                    # Shell завершился (например, команда exit)
+                    if buf:
+                        on_data(buf)
+                    rc = self._proc.wait()
+                    self._stop_process()
+                    return rc
+                buf += data
+                idx = buf.find(sentinel)
+                if idx == -1:
+                    if len(buf) > keep:
+                        on_data(buf[:-keep] if keep else buf)
+                        buf = buf[-keep:] if keep else b""
+                    continue
+                if idx:
+                    on_data(buf[:idx])
+                    buf = buf[idx:]
+                nl = buf.find(b"\n")
+                if nl == -1:
+                    continue
+                rc = int(buf[len(sentinel):nl] or b"0")
+                return 124 if timed_out else rc
+            now = time.monotonic()
+            if deadline is not None and now > deadline:
+                deadline = None
+                timed_out = True
+                self.interrupt()
+            if self._interrupted_at is not None and now - self._interrupted_at > self.interrupt_grace:
+                self._restart()
+                raise ShellTimeout("команда не реагирует на Ctrl+C, shell перезапущен")
+
+    def close(self) -> None:
+        with self._lock:
+            if self.alive():
+                try:
+                    os.write(self._fd, b"exit\n")
+                except OSError:
+                    pass
+            self._stop_process()
+
+
+# ====== Замеры стрима ======
+@dataclass
+class StreamTiming:
+    """Время одного ответа: до первого токена, всего и скорость генерации.
+
+    Метки ставит поток, читающий стрим; final — последний объект
+    Ollama (done=true) со счётчиками eval_count / eval_duration. Если
+    его нет (стрим прерван), скорость считается по дельтам.
+
+    Паузы между дельтами копятся как сумма и сумма квадратов: джиттер —
+    их стандартное отклонение, без хранения всех интервалов.
+    """
+    started: float = 0.0
+    first_token: Optional[float] = None
+    finished: Optional[float] = None
+    deltas: int = 0
+    final: Optional[dict] = None
+    last_delta: Optional[float] = None
+    gap_sum: float = 0.0
+    gap_sumsq: float = 0.0
+    gap_max: float = 0.0
+
+    def mark_start(self) -> None:
+        self.started = time.monotonic()
+
+    def mark_delta(self) -> None:
+        now = time.monotonic()
+        if self.first_token is None:
+            self.first_token = now
+        else:
+            gap = now - self.last_delta
+            self.gap_sum += gap
+            self.gap_sumsq += gap * gap
+            if gap > self.gap_max:
+                self.gap_max = gap
+        self.last_delta = now
+        self.deltas += 1
+
+    def mark_done(self, final: Optional[dict] = None) -> None:
+        self.finished = time.monotonic()
+        if final is not None:
+            self.final = final
+
+    @property
+    def ttft(self) -> Optional[float]:
+        """Секунды до первого токена."""
+        return None if self.first_token is None else self.first_token - self.started
+
+    @property
+    def total(self) -> Optional[float]:
+        """Секунды от запроса до конца ответа."""
+        return None if self.finished is None else self.finished - self.started
+
+    @property
+    def jitter(self) -> Optional[float]:
+        """Стандартное отклонение пауз между дельтами, секунды."""
+        n = self.deltas - 1
+        if n < 2:
+            return None
+        mean = self.gap_sum / n
+        return max(0.0, self.gap_sumsq / n - mean * mean) ** 0.5
+
+    @property
+    def tokens(self) -> int:
+        if self.final and self.final.get("eval_count"):
+            return int(self.final["eval_count"])
+        return self.deltas
+
+    @property
+    def tokens_per_sec(self) -> Optional[float]:
+        final = self.final or {}
+        if final.get("eval_count") and final.get("eval_duration"):
+            return final["eval_count"] / (final["eval_duration"] / 1e9)
+        if self.first_token is None:
+            return None
+        end = self.finished if self.finished is not None else time.monotonic()
+        return self.deltas / max(1e-6, end - self.first_token)
+
+    def summary(self) -> str:
+        parts = []
+        if self.ttft is not None:
+            parts.append(f"TTFT {self.ttft * 1000:.0f} мс")
+        tps = self.tokens_per_sec
+        if tps is not None:
+            parts.append(f"{tps:.1f} ток/с")
+        if self.total is not None:
+            parts.append(f"всего {self.total:.2f} с")
+        parts.append(f"{self.tokens} ток.")
+        if self.jitter is not None:
+            parts.append(f"джиттер {self.jitter * 1000:.0f} мс")
+        return " · ".join(parts)
+
+    def metrics(self) -> dict:
+        """Запись для таблицы metrics: клиентские замеры и счётчики Ollama, в мс."""
+        final = self.final or {}
+
+        def ms(value: Optional[float]) -> Optional[float]:
+            return None if value is None else round(value * 1000, 2)
+
+        def ns(key: str) -> Optional[float]:
+            return round(final[key] / 1e6, 2) if final.get(key) is not None else None
+
+        tps = self.tokens_per_sec
+        return {
+            "ttft_ms": ms(self.ttft),
+            "total_ms": ms(self.total),
+            "jitter_ms": ms(self.jitter),
+            "gap_max_ms": ms(self.gap_max) if self.deltas > 1 else None,
+            "tokens_per_sec": None if tps is None else round(tps, 2),
+            "eval_count": final.get("eval_count"),
+            "eval_ms": ns("eval_duration"),
+            "prompt_eval_count": final.get("prompt_eval_count"),
+            "prompt_eval_ms": ns("prompt_eval_duration"),
+            "load_ms": ns("load_duration"),
+        }
+
+
+def percentile(values: Sequence[float], q: float) -> Optional[float]:
+    """Перцентиль q (0–100) с линейной интерполяцией; None для пустого набора."""
+    data = sorted(values)
+    if not data:
+        return None
+    pos = (len(data) - 1) * q / 100
+    lo = int(pos)
+    hi = min(lo + 1, len(data) - 1)
+    return data[lo] + (data[hi] - data[lo]) * (pos - lo)
+
+
+def summarize_metrics(rows: Iterable[dict], bucket_seconds: int = 86400,
+                      fields: Sequence[str] = METRIC_FIELDS,
+                      quantiles: Sequence[int] = (50, 90, 99)) -> List[dict]:
+    """Перцентили замеров по (модели, интервалу времени).
+
+    Интервалы — по bucket_seconds от начала эпохи (локальное время не
+    учитывается); у каждой строки ключи model, start, count и
+    <поле>_p<q> для всех полей и перцентилей.
+    """
+    groups: Dict[Tuple[str, int], List[dict]] = {}
+    for row in rows:
+        start = int(row["ts"] // bucket_seconds * bucket_seconds)
+        groups.setdefault((row["model"], start), []).append(row)
+    out = []
+    for (model, start), items in sorted(groups.items(), key=lambda kv: (kv[0][0], kv[0][1])):
+        summary = {"model": model, "start": start, "count": len(items)}
+        for name in fields:
+            values = [r[name] for r in items if r.get(name) is not None]
+            for q in quantiles:
+                summary[f"{name}_p{q}"] = percentile(values, q)
+        out.append(summary)
+    return out
+
+
+def export_metrics(rows: List[dict], path: str) -> int:
+    """Выгрузка замеров: .csv — таблицей, иначе NDJSON (запись на строку)."""
+    if path.lower().endswith(".csv"):
+        import csv
+        keys = list(rows[0]) if rows else ["message_id", "model", "ts", *METRIC_FIELDS]
+        with open(path, "w", encoding="utf-8", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=keys)
+            writer.writeheader()
+            writer.writerows(rows)
+    else:
+        with open(path, "w", encoding="utf-8") as f:
+            for row in rows:
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
+    return len(rows)
+
+
+# ====== Кэш ответов ======
+def response_cache_key(digest: str, model: str, messages: List[dict], options: Optional[dict] = None) -> str:
+    """Ключ ответа: digest модели (или имя, если digest неизвестен), собранные
+    сообщения (с системным промптом) и параметры генерации."""
+    blob = json.dumps(
+        {"model": digest or model, "messages": messages, "options": options or {}},
+        ensure_ascii=False, sort_keys=True, separators=(",", ":"),
+    )
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """Кэш готовых ответов на диске (SQLite).
+
+    Запись живёт ttl секунд; при превышении max_bytes вытесняются давно
+    не использованные (LRU по last_used). Счётчики попаданий и промахов
+    хранятся в той же базе — статистика переживает перезапуск.
+    Методы потокобезопасны.
+    """
+
+    def __init__(self, path: str = RESPONSE_CACHE_PATH, max_bytes: int = 50 * 1024 * 1024,
+                 ttl: float = 7 * 86400):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.evicted = 0
+        self._lock = threading.Lock()
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                content TEXT NOT NULL,
+                final TEXT,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                last_used REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS responses_last_used ON responses(last_used);
+            CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+        """)
+
+    def _bump(self, name: str):
+        self._db.execute(
+            "INSERT INTO counters (name, value) VALUES (?, 1)"
+            " ON CONFLICT(name) DO UPDATE SET value = value + 1", (name,),
+        )
+
+    def get(self, key: str) -> Optional[dict]:
+        """{"content", "final", "created"} или None (промах либо запись устарела)."""
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT content, final, created FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and now - row[2] > self.ttl:
+                self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.evicted += 1
+                row = None
+            if row is None:
+                self._bump("misses")
+                return None
+            self._db.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+            self._bump("hits")
+        return {"content": row[0], "final": json.loads(row[1]) if row[1] else None, "created": row[2]}
+
+    def put(self, key: str, model: str, content: str, final: Optional[dict] = None):
+        now = time.time()
+        size = len(content.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, model, content, final, size, created, last_used)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, model, content, json.dumps(final) if final else None, size, now, now),
+            )
+            self._evict(now)
+
+    def _evict(self, now: float):
+        cur = self._db.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+        self.evicted += max(0, cur.rowcount)
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Вытесняем самые давно использованные, пока не влезем в лимит
+        victims = []
+        for key, size in self._db.execute("SELECT key, size FROM responses ORDER BY last_used"):
+            if total <= self.max_bytes:
+                break
+            victims.append((key,))
+            total -= size
+        self._db.executemany("DELETE FROM responses WHERE key = ?", victims)
+        self.evicted += len(victims)
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM responses")
+            self._db.execute("DELETE FROM counters")
+            self.evicted = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries, size = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+            counters = dict(self._db.execute("SELECT name, value FROM counters").fetchall())
+        hits, misses = counters.get("hits", 0), counters.get("misses", 0)
+        return {
+            "entries": entries, "bytes": size, "hits": hits, "misses": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses else 0.0, "evicted": self.evicted,
+        }
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+# ====== Один ответ чата ======
+class _DeliveryError(Exception):
+    """Исключение из on_delta: отличает сбой получателя от сбоя сервера (причина — __cause__)."""
+
+
+class ChatRequest:
+    """Один ответ /api/chat: контекст, кэш ответов, выбор сервера, стрим, замеры.
+
+    Общий для окна (ChatWorker добавляет к нему сигналы Qt) и для --ask в
+    терминале. Дельты уходят в on_delta в потоке, вызвавшем run(); stop()
+    из другого потока обрывает стрим на следующей строке.
+
+    model переопределяет state.model (сравнение моделей); с record=False
+    реплики не дописываются в state.messages. Время ответа — в timing.
+
+    С cache ответ сначала ищется в кэше по ключу (digest модели, собранные
+    сообщения, параметры): попадание отдаётся одной дельтой без запроса к
+    Ollama (cached=True), промах после полного ответа сохраняется.
+    bypass_cache — спросить заново и обновить запись.
+
+    recall(user_prompt) — фрагменты прошлых разговоров (MemoryIndex.recall),
+    они встают в контекст после системного промпта.
+    """
+
+    def __init__(self, state: ChatState, user_prompt: str, builder: ContextBuilder,
+                 model: Optional[str] = None, record: bool = True,
+                 cache: Optional[ResponseCache] = None, digest: str = "", bypass_cache: bool = False,
+                 recall: Optional[Callable[[str], List[str]]] = None):
+        self.state = state
+        self.user_prompt = user_prompt
+        self.builder = builder
+        self.model = model or state.model
+        self.record = record
+        self.cache = cache
+        self.digest = digest
+        self.bypass_cache = bypass_cache
+        self.recall = recall
+        self.cached = False
+        self.backend_url = ""
+        self.timing = StreamTiming()
+        self.stopped = False
+        self.context: Optional[ContextResult] = None
+
+    def stop(self):
+        self.stopped = True
+
+    def build(self) -> ContextResult:
+        """Собирает историю в формат Ollama /api/chat в пределах окна модели."""
+        memory = self.recall(self.user_prompt) if self.recall is not None else ()
+        self.context = self.builder.build(self.state.system_prompt, self.state.messages, self.user_prompt,
+                                          memory=memory)
+        return self.context
+
+    def run(self, on_delta: Callable[[str], None],
+            on_reply: Optional[Callable[[], None]] = None) -> Optional[str]:
+        """Ответ целиком; None — остановлен через stop(). Ошибки сети пробрасываются.
+
+        on_reply вызывается, когда ответ пошёл: из сети или из кэша.
+        """
+        ctx = self.context or self.build()
+        payload = {
+            "model": self.model,
+            "messages": ctx.messages,
+            "stream": True,
+            "keep_alive": normalize_keep_alive(self.state.keep_alive),
+        }
+        if self.state.num_ctx > 0:
+            payload["options"] = {"num_ctx": self.state.num_ctx}
+        cache_key = None
+        if self.cache is not None:
+            cache_key = response_cache_key(self.digest, self.model, ctx.messages, payload.get("options"))
+            hit = None if self.bypass_cache else self.cache.get(cache_key)
+            if hit is not None:
+                return self._replay(hit["content"], on_delta, on_reply)
+        if on_reply is not None:
+            on_reply()
+        self.timing.mark_start()
+        try:
+            full, final = self._stream_with_failover(payload, on_delta)
+        except BaseException:
+            self.timing.mark_done()
+            raise
+        self.timing.mark_done(final)
+        # если не было принудительной остановки — добавим в историю целиком
+        if self.stopped:
+            return None
+        answer = "".join(full)
+        if cache_key is not None and final is not None and answer:
+            self.cache.put(cache_key, self.model, answer, final)
+        self._record(answer)
+        return answer
+
+    def _stream_with_failover(self, payload: dict, on_delta: Callable[[str], None]) -> tuple:
+        """Стрим с лучшего сервера пула; отказ сервера — повод попробовать следующий.
+
+        Если сервер оборвал ответ посередине, следующий получает уже отданный
+        текст последним сообщением assistant и продолжает его (Ollama
+        дописывает такое сообщение), так что читатель видит один ответ.
+        """
+        import requests
+
+        pool = get_pool()
+        last_error: Optional[Exception] = None
+        full: List[str] = []
+        for backend in pool.candidates(self.model):
+            if self.stopped:
+                break
+            pool.acquire(backend)
+            self.backend_url = backend.url
+            started = time.monotonic()
+            attempt = payload
+            if full:
+                attempt = dict(payload, messages=payload["messages"] + [
+                    {"role": "assistant", "content": "".join(full)}])
+            try:
+                final = self._stream(backend.client, attempt, on_delta, full)
+            except _DeliveryError as e:
+                # Упал получатель (например, закрытый stdout у --ask | head), а не сервер
+                pool.release(backend)
+                raise e.__cause__
+            except (requests.RequestException, OSError) as e:
+                status = getattr(getattr(e, "response", None), "status_code", 0) or 0
+                # 4xx (например, модели нет на сервере) — сервер жив, просто идём дальше
+                pool.release(backend, error=None if 400 <= status < 500 else str(e))
+                last_error = e
+                continue
+            except BaseException:
+                pool.release(backend)
+                raise
+            # TTFT сервера известен, только если весь ответ пришёл от него
+            ttft = None
+            if attempt is payload and final is not None and self.timing.first_token is not None:
+                ttft = self.timing.first_token - started
+            pool.release(backend, ttft=ttft)
+            return full, final
+        if last_error is not None:
+            raise last_error
+        return full, None
+
+    def _stream(self, client: OllamaClient, payload: dict, on_delta: Callable[[str], None],
+                full: List[str]) -> Optional[dict]:
+        """Дельты дописываются в full (и после обрыва там остаётся отданное)."""
+        with client.post_stream("/api/chat", payload) as r:
+            final = None
+            for line in r.iter_lines(decode_unicode=True):
+                if self.stopped:
+                    break
+                if not line:
+                    continue
+                try:
+                    obj = json.loads(line)
+                except Exception:
+                    continue
+                if obj.get("done"):
+                    final = obj
+                    break
+                msg = obj.get("message", {})
+                delta = msg.get("content", "")
+                if delta:
+                    self.timing.mark_delta()
+                    full.append(delta)
+                    try:
+                        on_delta(delta)
+                    except Exception as e:
+                        raise _DeliveryError() from e
+        return final
+
+    def _record(self, answer: str):
+        if self.record:
+            self.state.messages.append(ChatMessage(role="user", content=self.user_prompt))
+            self.state.messages.append(ChatMessage(role="assistant", content=answer))
+
+    def _replay(self, answer: str, on_delta: Callable[[str], None],
+                on_reply: Optional[Callable[[], None]]) -> str:
+        """Ответ из кэша: сразу целиком, тем же путём, что и стрим."""
+        self.cached = True
+        if on_reply is not None:
+            on_reply()
+        self.timing.mark_start()
+        self.timing.mark_delta()
+        on_delta(answer)
+        self.timing.mark_done()
+        self._record(answer)
+        return answer
+
+
+# ====== Локальный API (Unix‑сокет) ======
+# Один запрос на соединение: строка JSON {"cmd": ...}, в ответ строки JSON
+# до закрытия соединения сервером. Сервер — IpcServer в окне приложения.
+# Предел строки запроса: вопрос с вложенным логом влезает, бесконечный поток — нет
+IPC_MAX_REQUEST_BYTES = 1024 * 1024
+
+def ipc_available() -> bool:
+    return hasattr(socket, "AF_UNIX")
+
+
+def _ipc_connect(path: str, timeout: Optional[float]) -> socket.socket:
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def ipc_running(path: str = IPC_SOCKET_PATH) -> bool:
+    """Запущено ли приложение. Сокет, оставшийся от упавшего процесса, удаляется."""
+    if not ipc_available() or not os.path.exists(path):
+        return False
+    try:
+        _ipc_connect(path, 1.0).close()
+        return True
+    except (ConnectionRefusedError, FileNotFoundError):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        return False
+    except OSError:
+        return False
+
+
+def ipc_request(request: dict, path: str = IPC_SOCKET_PATH,
+                timeout: Optional[float] = None) -> Iterator[dict]:
+    """Отправляет запрос запущенному приложению и отдаёт ответы по мере прихода.
+
+    ConnectionError — приложение не запущено.
+    """
+    if not ipc_available():
+        raise ConnectionError("локальный API доступен только на Unix")
+    try:
+        sock = _ipc_connect(path, timeout)
+    except (ConnectionRefusedError, FileNotFoundError) as e:
+        raise ConnectionError(f"приложение не запущено ({path})") from e
+    with sock, sock.makefile("rb") as stream:
+        sock.sendall(json.dumps(request, ensure_ascii=False).encode("utf-8") + b"\n")
+        for line in stream:
+            if line.strip():
+                yield json.loads(line)
+
+
+# ====== Ответ в терминал (--ask) ======
+def ask_in_terminal(prompt: str, model: Optional[str] = None, bypass_cache: bool = False,
+                    out=None, err=None) -> int:
+    """Один вопрос без GUI: ответ печатается в out по мере генерации.
+
+    Конфиг, системный промпт, серверы, кэш ответов и журнал истории — те же,
+    что у окна (ChatRequest). Если окно уже запущено, вопрос уходит ему через
+    локальный API в новую вкладку — историю пишет один процесс.
+    Код возврата: 0 — ответ получен, 1 — ошибка, 130 — прервано (Ctrl+C).
+    """
+    out = out or sys.stdout
+    err = err or sys.stderr
+    prompt = prompt.strip()
+    if not prompt:
+        print("❌ Пустой вопрос", file=err)
+        return 1
+    tail = ["\n"]
+
+    def write(delta: str):
+        out.write(delta)
+        out.flush()
+        tail[0] = delta[-1:]
+
+    def newline():
+        if tail[0] != "\n":
+            write("\n")
+
+    if ipc_running():
+        rc = _ask_via_ipc(prompt, model, bypass_cache, write, err)
+        newline()
+        return rc
+
+    state = load_chat_state()
+    model = model or state.model
+    client = get_client()
+    client.set_timeouts(state.connect_timeout, state.read_timeout)
+    pool = get_pool()
+    pool.configure(state.backends)
+    catalog = ModelCatalog()
+    cache = None
+    if state.response_cache:
+        cache = ResponseCache(max_bytes=state.cache_max_mb * 1024 * 1024, ttl=state.cache_ttl_hours * 3600)
+    builder = ContextBuilder(budget=context_budget(catalog.info(model), state.num_ctx),
+                             policy=state.context_policy, memory_tokens=state.memory_tokens)
+    # Журнал и хранилище — как у окна; поисковый индекс и память догонят их при запуске окна
+    history_log = HistoryLog()
+    store = ConversationStore()
+    if store.is_empty():
+        store.import_records(history_log.iter_records())
+    recall = None
+    if state.memory_enabled and memory_available():
+        memory = MemoryIndex(store, state.embed_model)
+        recall = lambda text: memory.recall(text, state.memory_k)
+    request = ChatRequest(state, prompt, builder, model=model, record=False, cache=cache,
+                          digest=catalog.digest(model), bypass_cache=bypass_cache, recall=recall)
+    writer = WriteBehind(history_log, store)
+    asked_at = int(time.time())
+    rc = 1
+    try:
+        answer = request.run(write)
+        newline()
+        if answer is not None:
+            # Разговор пишется только с ответом: неудачный --ask не оставляет
+            # в истории, поиске и памяти вопрос без ответа
+            session_id = store.new_session(model)
+            writer.append_history({"ts": asked_at, "role": "user", "content": prompt}, session_id, model)
+            rec = {"ts": int(time.time()), "role": "assistant", "content": answer}
+            if not request.cached:
+                rec["metrics"] = request.timing.metrics()
+            writer.append_history(rec, session_id, model)
+            rc = 0
+    except KeyboardInterrupt:
+        newline()
+        rc = 130
+    except Exception as e:
+        newline()
+        print(f"❌ Не удалось получить ответ от Ollama: {e}", file=err)
+    finally:
+        writer.close()
+        store.close()
+        history_log.close()
+        if cache is not None:
+            cache.close()
+        pool.close()
+        client.close()
+    return rc
+
+
+def index_memory_in_terminal(rebuild: bool = False, err=None) -> int:
+    """--index-memory / --rebuild-memory: догнать или перестроить память без окна."""
+    err = err or sys.stderr
+    if ipc_running():
+        print("❌ Приложение запущено — память индексирует оно (перестроить: 🧠 Память в меню)", file=err)
+        return 1
+    if not memory_available():
+        print("❌ Для памяти нужен numpy (pip install numpy)", file=err)
+        return 1
+    state = load_chat_state()
+    store = ConversationStore()
+    memory = MemoryIndex(store, state.embed_model)
+    get_client().set_timeouts(state.connect_timeout, state.read_timeout)
+    history_log = HistoryLog()
+    if store.is_empty():
+        store.import_records(history_log.iter_records())
+    total = store.count_answers_after(0 if rebuild else memory.last_id)
+    t0 = time.perf_counter()
+
+    def progress(done: int):
+        print(f"\r🧠 {done}/{total}", end="", file=err, flush=True)
+
+    rc = 0
+    try:
+        done = memory.rebuild(progress) if rebuild else memory.index_pending(progress)
+        print(f"\r✅ Проиндексировано ответов: {done} за {time.perf_counter() - t0:.1f} с, "
+              f"в памяти {memory.count} ({state.embed_model})", file=err)
+    except KeyboardInterrupt:
+        print(f"\n⏹️ Прервано, в памяти {memory.count} — продолжится с этого места", file=err)
+        rc = 130
+    except Exception as e:
+        print(f"\n❌ Не удалось получить эмбеддинги ({state.embed_model}): {e}", file=err)
+        rc = 1
+    finally:
+        store.close()
+        history_log.close()
+    return rc
+
+
+def _ask_via_ipc(prompt: str, model: Optional[str], bypass_cache: bool,
+                 write: Callable[[str], None], err) -> int:
+    request = {"cmd": "ask", "prompt": prompt, "model": model, "new_tab": True, "no_cache": bypass_cache}
+    rc = 1
+    try:
+        for msg in ipc_request(request):
+            if "delta" in msg:
+                write(msg["delta"])
+            elif "error" in msg:
+                print(f"\n❌ {msg['error']}", file=err)
+            elif msg.get("done") and not msg.get("stopped"):
+                rc = 0
+    except KeyboardInterrupt:
+        rc = 130  # соединение закрыто — окно остановит ответ само
+    except ConnectionError as e:
+        print(f"❌ {e}", file=err)
+    return rc
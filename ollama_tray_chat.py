@@ -7,7 +7,8 @@ Ollama Tray Chat — минималистичный GUI‑клиент под Ar
 - Стриминг ответа в реальном времени, кнопка Стоп
 - Выбор модели (список из /api/tags), поле системного промпта
 - Трей‑иконка (сворачивание в трей, контекстное меню: Показать/Скрыть, Новый чат, Выход)
-- Автосохранение истории в ~/.local/share/ollama-tray-chat/history.jsonl
+- Автосохранение истории в ~/.local/share/ollama-tray-chat/history/: сегменты seg-*.jsonl,
+  закрытые сжимаются в seg-*.jsonl.gz с разреженным индексом seg-*.idx.json
 - Конфиг в ~/.config/ollama-tray-chat/config.json
 
 Зависимости:
@@ -16,155 +17,1614 @@ Ollama Tray Chat — минималистичный GUI‑клиент под Ar
 Запуск:
   python3 ollama_tray_chat.py  # по умолчанию
   python3 ollama_tray_chat.py --minimize  # старт сразу в трее
+  python3 ollama_tray_chat.py --minimize --startup-profile  # время фаз запуска в stderr
+  python3 ollama_tray_chat.py --ask "вопрос"  # ответ в терминал, без Qt (годится для SSH)
+  journalctl -b -p err | python3 ollama_tray_chat.py --ask  # вопрос из stdin
+  python3 ollama_tray_chat.py --index-memory  # эмбеддинги прошлых ответов для 🧠 Памяти
 
 Совет: предварительно установи и запусти Ollama:
   yay -S ollama-bin && systemctl --user enable --now ollama
   ollama pull phi3.5:3.8b-mini-instruct
 """
 from __future__ import annotations
+import argparse
 import json
 import os
 import sys
+import threading
+import html
 import time
-from dataclasses import dataclass, field
-from typing import List, Optional
+from collections import OrderedDict, deque
+from dataclasses import dataclass, replace
+from functools import partial
+from typing import Callable, List, Optional
 from pathlib import Path
 
-import requests
-from PyQt6 import QtCore, QtGui, QtWidgets
+# Начало отсчёта для --startup-profile: дальше импорт Qt и ядра
+_STARTUP_T0 = time.perf_counter()
 
-OLLAMA_URL = os.environ.get("OLLAMA_URL", "http://127.0.0.1:11434")
-APP_ID = "ollama-tray-chat"
 APP_NAME = "Ollama Tray Chat"
 APP_VERSION = "1.1.0"
-CONFIG_DIR = os.path.join(os.path.expanduser("~"), ".config", APP_ID)
-DATA_DIR = os.path.join(os.path.expanduser("~"), ".local", "share", APP_ID)
-CONFIG_PATH = os.path.join(CONFIG_DIR, "config.json")
-HISTORY_PATH = os.path.join(DATA_DIR, "history.jsonl")
-
-# Путь к иконке (относительно директории скрипта)
-SCRIPT_DIR = Path(__file__).parent
-ICON_PATH = SCRIPT_DIR / "icons" / "ollama-chat.svg"
 
 
-def ensure_paths():
-    os.makedirs(CONFIG_DIR, exist_ok=True)
-    os.makedirs(DATA_DIR, exist_ok=True)
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=f"{APP_NAME} v{APP_VERSION}")
+    parser.add_argument("--minimize", action="store_true", help="Старт свернутым в трей")
+    parser.add_argument("--version", action="version", version=f"{APP_NAME} {APP_VERSION}")
+    parser.add_argument("--compact-history", action="store_true",
+                        help="Склеить старые сжатые сегменты журнала истории и выйти")
+    parser.add_argument("--startup-profile", action="store_true",
+                        help="Печатать в stderr время каждой фазы запуска")
+    parser.add_argument("--ask", nargs="?", const="-", metavar="ТЕКСТ",
+                        help="Задать вопрос и напечатать ответ без окна (без текста или «-» — из stdin)")
+    parser.add_argument("--model", help="Модель для --ask (по умолчанию из конфига)")
+    parser.add_argument("--no-cache", action="store_true", help="Для --ask: не брать ответ из кэша")
+    parser.add_argument("--index-memory", action="store_true",
+                        help="Догнать индекс памяти прошлых разговоров и выйти (нужен numpy)")
+    parser.add_argument("--rebuild-memory", action="store_true",
+                        help="Перестроить индекс памяти заново и выйти")
+    return parser.parse_args(argv)
+
+
+# --ask и индексация памяти работают в терминале и выходят, не загружая PyQt6:
+# старт за миллисекунды и работа на машинах без дисплея
+if __name__ == "__main__":
+    ARGS = parse_args()
+    if ARGS.index_memory or ARGS.rebuild_memory:
+        from ollama_core import ensure_paths, index_memory_in_terminal
+        ensure_paths()
+        sys.exit(index_memory_in_terminal(rebuild=ARGS.rebuild_memory))
+    if ARGS.ask is not None:
+        from ollama_core import ask_in_terminal, ensure_paths
+        ensure_paths()
+        sys.exit(ask_in_terminal(sys.stdin.read() if ARGS.ask == "-" else ARGS.ask,
+                                 ARGS.model, ARGS.no_cache))
 
+from PyQt6 import QtCore, QtGui, QtWidgets
 
-@dataclass
-class ChatMessage:
-    role: str  # "system" | "user" | "assistant"
-    content: str
+from ollama_core import (
+    CONFIG_PATH,
+    DEFAULT_KEEP_ALIVE,
+    HIT_END,
+    HIT_START,
+    IPC_MAX_REQUEST_BYTES,
+    IPC_SOCKET_PATH,
+    NEW_CHAT_MARKER,
+    ChatMessage,
+    ChatRequest,
+    ChatState,
+    CommandExtractor,
+    ContextBuilder,
+    ConversationStore,
+    DenyMatcher,
+    HistoryLog,
+    MemoryIndex,
+    ModelCatalog,
+    OutputRing,
+    ResponseCache,
+    SearchIndex,
+    ShellSession,
+    ShellTimeout,
+    WriteBehind,
+    context_budget,
+    ensure_paths,
+    export_metrics,
+    format_size,
+    get_client,
+    get_pool,
+    ipc_available,
+    ipc_request,
+    ipc_running,
+    load_chat_state,
+    memory_available,
+    parse_commands,
+    preload_model,
+    running_models,
+    summarize_metrics,
+    unload_model,
+)
 
+# Путь к иконке (относительно директории скрипта)
+SCRIPT_DIR = Path(__file__).parent
+ICON_PATH = SCRIPT_DIR / "icons" / "ollama-chat.svg"
 
-@dataclass
-class ChatState:
-    model: str = "phi3.5:3.8b-mini-instruct"
-    system_prompt: str = (
-        "Ты — локальный помощник по Linux (Arch) и fish. Отвечай кратко, давай команды безопасно.\n\n"
-        "ВАЖНО: Все команды оборачивай в блоки кода с ```bash или помечай через `команда`.\n"
-        "Пример:\n"
-        "```bash\n"
-        "ls -la\n"
-        "```\n"
-        "или просто: `ls -la`"
-    )
-    messages: List[ChatMessage] = field(default_factory=list)
-    # Настройки безопасности команд
-    safe_sudo_commands: List[str] = field(default_factory=lambda: [
-        "systemctl", "journalctl", "pacman", "apt", "dnf", "yum",
-        "docker", "podman", "snap", "flatpak", "cat", "less", "tail",
-        "head", "grep", "find", "ls", "lsblk", "lsusb", "lspci",
-        "ip", "ss", "netstat", "dmesg",
-    ])
-    deny_patterns: List[str] = field(default_factory=lambda: [
-        r"\brm\s+(-[rf]*[rf]|-[rf]*[rf])",
-        r"\brm\b.*--no-preserve-root",
-        r"\bdd\b.*if=.*of=/dev/",
-        r"\bmkfs\.",
-        r"\bfdisk\b",
-        r"\bparted\b",
-        r":\s*\(\s*\)\s*\{",
-        r"while\s+true.*do",
-        r">\s*/etc/",
-        r">\s*/boot/",
-        r">\s*/sys/",
-        r"\bchmod\s+777\s+/",
-        r"\bchown\s+.*\s+/\s*$",
-        r"\bhping",
-        r"\bnmap.*-sS",
-        r"curl.*\|\s*bash",
-        r"wget.*\|\s*sh",
-        r"curl.*\|\s*sh",
-        r">\s*/dev/null\s+2>&1\s*&",
-        r"\b(mkfs|shutdown|reboot|halt|poweroff|init\s+[06])\b",
-    ])
+# Оформление сообщений: подпись, фон, цвет подписи
+ROLE_STYLES = {
+    "user": ("👤 Вы", "#e3f2fd", "#1565c0"),      # Голубой фон, синий текст
+    "assistant": ("🤖 Модель", "#f1f8e9", "#33691e"),  # Светло-зелёный фон, тёмно-зелёный текст
+    "system": ("⚙️ System", "#fff9c4", "#f57f17"),     # Жёлтый фон, оранжевый текст
+}
+# Сколько отрисованных сообщений (QTextDocument) держать в памяти
+RENDER_CACHE_SIZE = 150
+# Сколько последних сообщений сессии подгружать при открытии и при прокрутке вверх
+HISTORY_PAGE_SIZE = 200
+# Режимы пакета команд в очереди: параллельно / по очереди / цепочкой (стоп на первой ошибке)
+JOB_MODES = {
+    "parallel": "Параллельно",
+    "sequential": "По очереди",
+    "chain": "Цепочкой (стоп при ошибке)",
+}
+# Как выполнять одобренные команды: новый процесс на каждую или общий shell сессии
+EXEC_BACKENDS = {
+    "process": "Отдельный процесс",
+    "shell": "Общий shell (pty)",
+}
+# Сколько shell‑сессий (по одной на разговор) держать живыми
+SHELL_SESSIONS_MAX = 4
+JOB_STATUS_LABELS = {
+    "queued": "⏳ В очереди",
+    "running": "▶️ Выполняется",
+    "done": "✅ Готово",
+    "failed": "❌ Ошибка",
+    "cancelled": "⛔ Отменено",
+    "skipped": "⏭️ Пропущено",
+}
 
 
 class ChatWorker(QtCore.QThread):
+    """Стримит ответ /api/chat в GUI: ChatRequest в отдельном потоке плюс сигналы.
+
+    В режиме "coalesced" дельты копятся в буфере и уходят в GUI одним
+    сигналом chunk по таймеру (chunk_flush_ms) или при накоплении
+    chunk_flush_bytes символов — вместо перерисовки на каждый токен.
+    Буфер всегда разбирается в GUI‑потоке, поэтому порядок текста
+    сохраняется.
+
+    Параметры model, record, cache, digest, bypass_cache, recall — как у
+    ChatRequest; ответ из кэша приходит тем же chunk одной дельтой.
+    """
     chunk = QtCore.pyqtSignal(str)
     started_reply = QtCore.pyqtSignal()
     finished_ok = QtCore.pyqtSignal()
     failed = QtCore.pyqtSignal(str)
+    context_info = QtCore.pyqtSignal(int, int, int, int)  # used, budget, dropped, recalled
+    _wake = QtCore.pyqtSignal()
 
-    def __init__(self, state: ChatState, user_prompt: str, parent=None):
+    def __init__(self, state: ChatState, user_prompt: str, builder: ContextBuilder, parent=None,
+                 model: Optional[str] = None, record: bool = True,
+                 cache: Optional[ResponseCache] = None, digest: str = "", bypass_cache: bool = False,
+                 recall: Optional[Callable[[str], List[str]]] = None):
         super().__init__(parent)
         self.state = state
-        self.user_prompt = user_prompt
-        self._stop_flag = False
+        self.request = ChatRequest(state, user_prompt, builder, model=model, record=record,
+                                   cache=cache, digest=digest, bypass_cache=bypass_cache, recall=recall)
+        self.model = self.request.model
+        self.timing = self.request.timing
+        # Счётчики доставки: дельты из сети и сигналы chunk в GUI
+        self.delta_count = 0
+        self.signal_count = 0
+        self.coalesce = state.chunk_mode != "per_token"
+        self._buf: List[str] = []
+        self._buf_len = 0
+        self._buf_lock = threading.Lock()
+        self._flush_timer = QtCore.QTimer(self)
+        self._flush_timer.setInterval(max(1, state.chunk_flush_ms))
+        self._flush_timer.timeout.connect(self.flush)
+        self._wake.connect(self.flush)
+        if self.coalesce:
+            self.started.connect(self._flush_timer.start)
+            self.finished.connect(self._flush_timer.stop)
+
+    @property
+    def cached(self) -> bool:
+        return self.request.cached
+
+    @property
+    def backend_url(self) -> str:
+        return self.request.backend_url
 
     def stop(self):
-        self._stop_flag = True
+        self.request.stop()
+
+    def _deliver(self, delta: str):
+        self.delta_count += 1
+        if not self.coalesce:
+            self.signal_count += 1
+            self.chunk.emit(delta)
+            return
+        with self._buf_lock:
+            self._buf.append(delta)
+            self._buf_len += len(delta)
+            full = self._buf_len >= self.state.chunk_flush_bytes
+        if full:
+            self._wake.emit()
+
+    def _flush_pending(self):
+        """Из рабочего потока: досылаем хвост буфера до finished_ok/failed."""
+        with self._buf_lock:
+            pending = bool(self._buf)
+        if pending:
+            self._wake.emit()
+
+    def flush(self):
+        """Слот GUI‑потока: отдать накопленный текст одним сигналом."""
+        with self._buf_lock:
+            if not self._buf:
+                return
+            text = "".join(self._buf)
+            self._buf.clear()
+            self._buf_len = 0
+        self.signal_count += 1
+        self.chunk.emit(text)
 
     def run(self):
         try:
-            # Собираем историю в формат Ollama /api/chat
-            msgs = []
-            if self.state.system_prompt.strip():
-                msgs.append({"role": "system", "content": self.state.system_prompt})
-            for m in self.state.messages:
-                msgs.append({"role": m.role, "content": m.content})
-            msgs.append({"role": "user", "content": self.user_prompt})
-
-            payload = {
-                "model": self.state.model,
-                "messages": msgs,
-                "stream": True,
-            }
-            url = f"{OLLAMA_URL}/api/chat"
-            self.started_reply.emit()
-            with requests.post(url, json=payload, stream=True, timeout=60) as r:
-                r.raise_for_status()
-                full = []
-                for line in r.iter_lines(decode_unicode=True):
-                    if self._stop_flag:
-                        break
-                    if not line:
-                        continue
-                    try:
-                        obj = json.loads(line)
-                    except Exception:
-                        continue
-                    if obj.get("done"):
-                        break
-                    msg = obj.get("message", {})
-                    delta = msg.get("content", "")
-                    if delta:
-                        full.append(delta)
-                        self.chunk.emit(delta)
-                # если не было принудительной остановки — добавим в историю целиком
-                if not self._stop_flag:
-                    answer = "".join(full)
-                    self.state.messages.append(ChatMessage(role="user", content=self.user_prompt))
-                    self.state.messages.append(ChatMessage(role="assistant", content=answer))
-                    self.finished_ok.emit()
+            ctx = self.request.build()
+            self.context_info.emit(ctx.used_tokens, ctx.budget, ctx.dropped, ctx.recalled)
+            answer = self.request.run(self._deliver, self.started_reply.emit)
+            self._flush_pending()
+            if answer is not None:
+                self.finished_ok.emit()
         except Exception as e:
+            self._flush_pending()
             self.failed.emit(str(e))
 
 
+class PaintCounter(QtCore.QObject):
+    """Считает перерисовки виджета (события Paint)."""
+
+    def __init__(self, widget: QtWidgets.QWidget):
+        super().__init__(widget)
+        self.count = 0
+        widget.installEventFilter(self)
+
+    def eventFilter(self, obj, e):
+        if e.type() == QtCore.QEvent.Type.Paint:
+            self.count += 1
+        return False
+
+
+class ChatHistoryModel(QtCore.QAbstractListModel):
+    """Сообщения чата для ChatView.
+
+    Хранит только роль и текст; у каждого изменения сообщения новый
+    version, по нему делегат понимает, что отрисовку пора обновить.
+    """
+    RoleRole = QtCore.Qt.ItemDataRole.UserRole + 1
+    VersionRole = QtCore.Qt.ItemDataRole.UserRole + 2
+    UidRole = QtCore.Qt.ItemDataRole.UserRole + 3
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._items: List[list] = []  # [role, text, version, pending, uid, message_id]
+        self._version = 0
+        self._uid = 0
+
+    def _next_version(self) -> int:
+        self._version += 1
+        return self._version
+
+    def _new_item(self, role: str, text: str, pending: bool = False, message_id: Optional[int] = None) -> list:
+        self._uid += 1
+        return [role, text, self._next_version(), pending, self._uid, message_id]
+
+    def row_of_message(self, message_id: int) -> int:
+        for row, item in enumerate(self._items):
+            if item[5] == message_id:
+                return row
+        return -1
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self._items)
+
+    def data(self, index, role=QtCore.Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        item = self._items[index.row()]
+        if role == QtCore.Qt.ItemDataRole.DisplayRole:
+            return item[1]
+        if role == self.RoleRole:
+            return item[0]
+        if role == self.VersionRole:
+            return item[2]
+        if role == self.UidRole:
+            return item[4]
+        return None
+
+    def append(self, role: str, text: str, pending: bool = False):
+        row = len(self._items)
+        self.beginInsertRows(QtCore.QModelIndex(), row, row)
+        self._items.append(self._new_item(role, text, pending))
+        self.endInsertRows()
+
+    def prepend(self, messages):
+        """Вставить более ранние сообщения в начало (подгрузка истории)."""
+        if not messages:
+            return
+        self.beginInsertRows(QtCore.QModelIndex(), 0, len(messages) - 1)
+        self._items[:0] = [self._new_item(m.role, m.content, message_id=m.id) for m in messages]
+        self.endInsertRows()
+
+    def append_to_last(self, delta: str):
+        """Дописать дельту стрима; плейсхолдер заменяется первой дельтой."""
+        if not self._items:
+            return
+        item = self._items[-1]
+        item[1] = delta if item[3] else item[1] + delta
+        item[2] = self._next_version()
+        item[3] = False
+        idx = self.index(len(self._items) - 1)
+        self.dataChanged.emit(idx, idx)
+
+    def set_messages(self, messages):
+        self.beginResetModel()
+        self._items = [self._new_item(m.role, m.content, message_id=m.id) for m in messages]
+        self.endResetModel()
+
+    def clear(self):
+        self.set_messages([])
+
+
+class BubbleDelegate(QtWidgets.QStyledItemDelegate):
+    """Рисует сообщение «пузырём».
+
+    Вёрстка (QTextDocument) дорогая, поэтому документы кэшируются по
+    (version, ширина) в LRU на RENDER_CACHE_SIZE штук: сообщения за
+    пределами экрана вытесняются и собираются заново при прокрутке к ним.
+    Высоты хранятся отдельно — они дешёвые и нужны для всей полосы прокрутки.
+    """
+    MARGIN = 6
+
+    def __init__(self, view: QtWidgets.QListView, cache_size: int = RENDER_CACHE_SIZE):
+        super().__init__(view)
+        self.view = view
+        self.cache_size = cache_size
+        self._docs: "OrderedDict[tuple, QtGui.QTextDocument]" = OrderedDict()
+        self._heights: dict = {}  # uid -> (version, width, height)
+
+    def reset(self):
+        self._docs.clear()
+        self._heights.clear()
+
+    def _width(self) -> int:
+        return max(100, self.view.viewport().width() - 2 * self.MARGIN)
+
+    def _document(self, index, width: int) -> QtGui.QTextDocument:
+        key = (index.data(ChatHistoryModel.VersionRole), width)
+        doc = self._docs.get(key)
+        if doc is not None:
+            self._docs.move_to_end(key)
+            return doc
+        role = index.data(ChatHistoryModel.RoleRole)
+        who, _bg, text_color = ROLE_STYLES.get(role, (role, "#fff", "#000"))
+        doc = QtGui.QTextDocument()
+        doc.setDefaultFont(self.view.font())
+        doc.setDocumentMargin(8)
+        cursor = QtGui.QTextCursor(doc)
+        headfmt = QtGui.QTextCharFormat()
+        headfmt.setForeground(QtGui.QColor(text_color))
+        headfmt.setFontWeight(QtGui.QFont.Weight.Bold)
+        cursor.insertText(f"{who}:\n", headfmt)
+        bodyfmt = QtGui.QTextCharFormat()
+        bodyfmt.setForeground(QtGui.QColor("#212121"))  # Тёмно-серый текст для читаемости
+        cursor.insertText(index.data(), bodyfmt)
+        doc.setTextWidth(width)
+        self._docs[key] = doc
+        while len(self._docs) > self.cache_size:
+            self._docs.popitem(last=False)
+        return doc
+
+    def sizeHint(self, option, index):
+        width = self._width()
+        version = index.data(ChatHistoryModel.VersionRole)
+        uid = index.data(ChatHistoryModel.UidRole)
+        cached = self._heights.get(uid)
+        if cached and cached[0] == version and cached[1] == width:
+            height = cached[2]
+        else:
+            height = int(self._document(index, width).size().height())
+            self._heights[uid] = (version, width, height)
+        return QtCore.QSize(width, height + 2 * self.MARGIN)
+
+    def paint(self, painter, option, index):
+        width = self._width()
+        doc = self._document(index, width)
+        role = index.data(ChatHistoryModel.RoleRole)
+        bg = ROLE_STYLES.get(role, (role, "#fff", "#000"))[1]
+        rect = QtCore.QRectF(option.rect).adjusted(self.MARGIN, self.MARGIN, -self.MARGIN, -self.MARGIN)
+        painter.save()
+        painter.setRenderHint(QtGui.QPainter.RenderHint.Antialiasing)
+        painter.setBrush(QtGui.QColor(bg))
+        selected = bool(option.state & QtWidgets.QStyle.StateFlag.State_Selected)
+        painter.setPen(QtGui.QPen(QtGui.QColor("#1565c0" if selected else "#bbb")))
+        painter.drawRoundedRect(rect, 6, 6)
+        painter.translate(rect.topLeft())
+        doc.drawContents(painter, QtCore.QRectF(0, 0, rect.width(), rect.height()))
+        painter.restore()
+
+
+class ChatView(QtWidgets.QListView):
+    """История чата: раскладываются и рисуются только видимые сообщения."""
+    reached_top = QtCore.pyqtSignal()
+
+    def __init__(self, model: ChatHistoryModel, parent=None):
+        super().__init__(parent)
+        self.setModel(model)
+        self.bubbles = BubbleDelegate(self)
+        self.setItemDelegate(self.bubbles)
+        model.modelReset.connect(self.bubbles.reset)
+        self.setVerticalScrollMode(QtWidgets.QAbstractItemView.ScrollMode.ScrollPerPixel)
+        self.setHorizontalScrollBarPolicy(QtCore.Qt.ScrollBarPolicy.ScrollBarAlwaysOff)
+        self.setResizeMode(QtWidgets.QListView.ResizeMode.Adjust)
+        self.setLayoutMode(QtWidgets.QListView.LayoutMode.Batched)
+        self.setBatchSize(100)
+        self.setUniformItemSizes(False)
+        self.setSelectionMode(QtWidgets.QAbstractItemView.SelectionMode.ExtendedSelection)
+        self.setContextMenuPolicy(QtCore.Qt.ContextMenuPolicy.ActionsContextMenu)
+        copy_action = QtGui.QAction("📋 Копировать", self)
+        copy_action.setShortcut(QtGui.QKeySequence.StandardKey.Copy)
+        copy_action.setShortcutContext(QtCore.Qt.ShortcutContext.WidgetShortcut)
+        copy_action.triggered.connect(self.copy_selected)
+        self.addAction(copy_action)
+        # Прилипание к низу: пока пользователь внизу, новые сообщения прокручиваются
+        self._stick = True
+        # Расстояние до низа, которое держим при вставке сообщений сверху
+        self._anchor: Optional[int] = None
+        self._adjusting = False
+        bar = self.verticalScrollBar()
+        bar.valueChanged.connect(self._on_scrolled)
+        bar.rangeChanged.connect(self._on_range_changed)
+
+    def _on_scrolled(self, value: int):
+        if self._adjusting:
+            return
+        self._anchor = None
+        self._stick = value >= self.verticalScrollBar().maximum() - 4
+        if value == 0 and self.verticalScrollBar().maximum() > 0:
+            self.reached_top.emit()
+
+    def _on_range_changed(self, _min: int, maximum: int):
+        bar = self.verticalScrollBar()
+        self._adjusting = True
+        if self._anchor is not None:
+            bar.setValue(maximum - self._anchor)
+        elif self._stick:
+            bar.setValue(maximum)
+        self._adjusting = False
+
+    def keep_position(self):
+        """Вызвать перед вставкой строк сверху, чтобы текст не «уехал»."""
+        bar = self.verticalScrollBar()
+        self._anchor = bar.maximum() - bar.value()
+
+    def dataChanged(self, top_left, bottom_right, roles=()):
+        super().dataChanged(top_left, bottom_right, roles)
+        # Высота изменённого сообщения могла поменяться
+        self.scheduleDelayedItemsLayout()
+
+    def copy_selected(self):
+        rows = sorted(i.row() for i in self.selectedIndexes())
+        text = "\n\n".join(self.model().index(r).data() for r in rows)
+        if text:
+            QtWidgets.QApplication.clipboard().setText(text)
+
+
+class ModelsLoader(QtCore.QThread):
+    """Обновляет каталог моделей (/api/tags + /api/show) в фоне."""
+    loaded = QtCore.pyqtSignal(list)
+    failed = QtCore.pyqtSignal(str)
+
+    def __init__(self, catalog: ModelCatalog, parent=None):
+        super().__init__(parent)
+        self.catalog = catalog
+
+    def run(self):
+        pool = get_pool()
+        try:
+            names = self.catalog.refresh()
+        except Exception as e:
+            if len(pool.backends) < 2:
+                self.failed.emit(str(e))
+                return
+            names = []
+        if len(pool.backends) > 1:
+            # Модели остальных серверов пула — в конец списка
+            pool.check_all()
+            names += [n for n in pool.all_models() if n not in names]
+        if names:
+            self.loaded.emit(names)
+        else:
+            self.failed.emit("ни один сервер Ollama не ответил")
+
+
+class BackgroundCall(QtCore.QThread):
+    """Выполняет блокирующую функцию (обычно HTTP‑запрос) вне GUI‑потока."""
+    done = QtCore.pyqtSignal(object)
+    failed = QtCore.pyqtSignal(str)
+
+    def __init__(self, fn, *args, parent=None):
+        super().__init__(parent)
+        self.fn = fn
+        self.args = args
+
+    def run(self):
+        try:
+            self.done.emit(self.fn(*self.args))
+        except Exception as e:
+            self.failed.emit(str(e))
+
+
+class ResidencyPanel(QtWidgets.QDialog):
+    """Панель моделей, загруженных в память Ollama (/api/ps)."""
+
+    def __init__(self, main: "MainWindow"):
+        super().__init__(main)
+        self.main = main
+        self.setWindowTitle("🧩 Модели в памяти Ollama")
+        self.resize(640, 320)
+        self._call: Optional[BackgroundCall] = None
+        self._unload_call: Optional[BackgroundCall] = None
+        self._models: list = []
+
+        lay = QtWidgets.QVBoxLayout(self)
+        self.table = QtWidgets.QTableWidget(0, 4)
+        self.table.setHorizontalHeaderLabels(["Модель", "Память", "VRAM", "Выгрузится"])
+        self.table.horizontalHeader().setSectionResizeMode(0, QtWidgets.QHeaderView.ResizeMode.Stretch)
+        self.table.setSelectionBehavior(QtWidgets.QAbstractItemView.SelectionBehavior.SelectRows)
+        self.table.setEditTriggers(QtWidgets.QAbstractItemView.EditTrigger.NoEditTriggers)
+        lay.addWidget(self.table)
+
+        ka_bar = QtWidgets.QHBoxLayout()
+        ka_bar.addWidget(QtWidgets.QLabel("keep_alive:"))
+        self.keep_alive_edit = QtWidgets.QLineEdit(self.main.state.keep_alive)
+        self.keep_alive_edit.setToolTip("Сколько держать модель в памяти: 5m, 30m, 2h, -1 (всегда)")
+        self.keep_alive_edit.editingFinished.connect(self.on_keep_alive_changed)
+        ka_bar.addWidget(self.keep_alive_edit)
+        ka_bar.addStretch(1)
+        lay.addLayout(ka_bar)
+
+        hint = QtWidgets.QLabel(
+            "💡 <i>Чтобы две модели оставались в памяти одновременно, "
+            "на сервере нужен OLLAMA_MAX_LOADED_MODELS ≥ 2</i>"
+        )
+        hint.setWordWrap(True)
+        lay.addWidget(hint)
+
+        btns = QtWidgets.QHBoxLayout()
+        refresh_btn = QtWidgets.QPushButton("🔄 Обновить")
+        unload_btn = QtWidgets.QPushButton("⏏️ Выгрузить выбранную")
+        unload_idle_btn = QtWidgets.QPushButton("🧹 Выгрузить неиспользуемые")
+        refresh_btn.clicked.connect(self.refresh)
+        unload_btn.clicked.connect(self.on_unload_selected)
+        unload_idle_btn.clicked.connect(self.on_unload_idle)
+        btns.addWidget(refresh_btn)
+        btns.addStretch(1)
+        btns.addWidget(unload_btn)
+        btns.addWidget(unload_idle_btn)
+        lay.addLayout(btns)
+
+        self.timer = QtCore.QTimer(self)
+        self.timer.setInterval(5000)
+        self.timer.timeout.connect(self.refresh)
+
+    def showEvent(self, e):
+        super().showEvent(e)
+        self.refresh()
+        self.timer.start()
+
+    def hideEvent(self, e):
+        self.timer.stop()
+        super().hideEvent(e)
+
+    def refresh(self):
+        if self._call and self._call.isRunning():
+            return
+        self._call = BackgroundCall(running_models, parent=self)
+        self._call.done.connect(self.on_loaded)
+        self._call.failed.connect(lambda err: self.setWindowTitle(f"🧩 Модели в памяти — ошибка: {err}"))
+        self._call.start()
+
+    def on_loaded(self, models: list):
+        self.setWindowTitle("🧩 Модели в памяти Ollama")
+        self._models = models
+        self.table.setRowCount(len(models))
+        for row, m in enumerate(models):
+            name = m["name"]
+            if name == self.main.state.model:
+                name += "  (текущая)"
+            for col, text in enumerate((
+                name,
+                format_size(m["size"]),
+                format_size(m["size_vram"]),
+                m["expires_at"][:19].replace("T", " "),
+            )):
+                self.table.setItem(row, col, QtWidgets.QTableWidgetItem(text))
+
+    def on_keep_alive_changed(self):
+        value = self.keep_alive_edit.text().strip() or DEFAULT_KEEP_ALIVE
+        if value != self.main.state.keep_alive:
+            self.main.state.keep_alive = value
+            self.main.save_state()
+
+    def _unload(self, names: list):
+        if not names:
+            return
+        call = BackgroundCall(lambda: [unload_model(n) for n in names], parent=self)
+        call.done.connect(lambda _: self.refresh())
+        call.failed.connect(lambda err: QtWidgets.QMessageBox.warning(self, "Ошибка", err))
+        call.start()
+        self._unload_call = call
+
+    def on_unload_selected(self):
+        row = self.table.currentRow()
+        if 0 <= row < len(self._models):
+            self._unload([self._models[row]["name"]])
+
+    def on_unload_idle(self):
+        current = self.main.state.model
+        self._unload([m["name"] for m in self._models if m["name"] != current])
+
+
+class SessionBrowser(QtWidgets.QDialog):
+    """Список прошлых разговоров; страницы подгружаются при прокрутке вниз."""
+    PAGE = 50
+
+    def __init__(self, main: "MainWindow"):
+        super().__init__(main)
+        self.main = main
+        self.setWindowTitle("🗂️ Разговоры")
+        self.resize(560, 480)
+        self._offset = 0
+        self._exhausted = False
+
+        lay = QtWidgets.QVBoxLayout(self)
+        self.list = QtWidgets.QListWidget()
+        self.list.itemActivated.connect(self.on_open)
+        self.list.verticalScrollBar().valueChanged.connect(self._on_scrolled)
+        lay.addWidget(self.list)
+
+        btns = QtWidgets.QHBoxLayout()
+        open_btn = QtWidgets.QPushButton("📂 Открыть")
+        delete_btn = QtWidgets.QPushButton("🗑️ Удалить")
+        close_btn = QtWidgets.QPushButton("Закрыть")
+        open_btn.clicked.connect(lambda: self.on_open(self.list.currentItem()))
+        delete_btn.clicked.connect(self.on_delete)
+        close_btn.clicked.connect(self.reject)
+        btns.addWidget(open_btn)
+        btns.addWidget(delete_btn)
+        btns.addStretch(1)
+        btns.addWidget(close_btn)
+        lay.addLayout(btns)
+
+    def reload(self):
+        self.list.clear()
+        self._offset = 0
+        self._exhausted = False
+        self.load_more()
+
+    def load_more(self):
+        if self._exhausted:
+            return
+        page = self.main.store.list_sessions(self._offset, self.PAGE)
+        self._offset += len(page)
+        self._exhausted = len(page) < self.PAGE
+        for sess in page:
+            when = time.strftime("%Y-%m-%d %H:%M", time.localtime(sess["updated_at"]))
+            title = sess["title"] or "(без вопросов)"
+            item = QtWidgets.QListWidgetItem(f"{when}  ·  {title}  ·  {sess['count']} сообщ.")
+            item.setData(QtCore.Qt.ItemDataRole.UserRole, sess["id"])
+            if sess["model"]:
+                item.setToolTip(sess["model"])
+            if sess["id"] in {t.session_id for t in self.main.all_tabs()}:
+                font = item.font()
+                font.setBold(True)
+                item.setFont(font)
+            self.list.addItem(item)
+
+    def _on_scrolled(self, value: int):
+        if value >= self.list.verticalScrollBar().maximum():
+            self.load_more()
+
+    def on_open(self, item):
+        if item is None:
+            return
+        if self.main.open_session(item.data(QtCore.Qt.ItemDataRole.UserRole)):
+            self.accept()
+
+    def on_delete(self):
+        item = self.list.currentItem()
+        if item is None:
+            return
+        sid = item.data(QtCore.Qt.ItemDataRole.UserRole)
+        reply = QtWidgets.QMessageBox.question(
+            self, "Удаление", "Удалить выбранный разговор?",
+            QtWidgets.QMessageBox.StandardButton.Yes | QtWidgets.QMessageBox.StandardButton.No,
+        )
+        if reply != QtWidgets.QMessageBox.StandardButton.Yes:
+            return
+        self.main.store.delete_session(sid)
+        self.main.search_index.delete_session(sid)
+        self.main.forget_session(sid)
+        self.list.takeItem(self.list.row(item))
+        self._offset = max(0, self._offset - 1)
+
+
+class SearchPanel(QtWidgets.QDialog):
+    """Поиск по всем разговорам: ранжированные результаты с подсветкой."""
+
+    def __init__(self, main: "MainWindow"):
+        super().__init__(main)
+        self.main = main
+        self.setWindowTitle("🔎 Поиск по истории")
+        self.resize(640, 520)
+
+        lay = QtWidgets.QVBoxLayout(self)
+        self.query_edit = QtWidgets.QLineEdit()
+        self.query_edit.setPlaceholderText("Что искать… (все слова, последнее — по началу)")
+        lay.addWidget(self.query_edit)
+        self.results = QtWidgets.QTextBrowser()
+        self.results.setOpenLinks(False)
+        self.results.anchorClicked.connect(self.on_result_clicked)
+        lay.addWidget(self.results, 1)
+        self.info = QtWidgets.QLabel()
+        lay.addWidget(self.info)
+
+        # Поиск по мере набора, с небольшой задержкой
+        self.debounce = QtCore.QTimer(self)
+        self.debounce.setSingleShot(True)
+        self.debounce.setInterval(150)
+        self.debounce.timeout.connect(self.run_query)
+        self.query_edit.textChanged.connect(self.debounce.start)
+        self.query_edit.returnPressed.connect(self.run_query)
+
+    def run_query(self):
+        text = self.query_edit.text().strip()
+        if not text:
+            self.results.clear()
+            self.info.clear()
+            return
+        t0 = time.perf_counter()
+        hits = self.main.search_index.search(text)
+        elapsed = (time.perf_counter() - t0) * 1000
+        parts = []
+        for hit in hits:
+            who = ROLE_STYLES.get(hit["role"], (hit["role"],))[0]
+            when = time.strftime("%Y-%m-%d %H:%M", time.localtime(float(hit["ts"])))
+            snippet = html.escape(hit["snippet"]).replace("\n", " ")
+            snippet = snippet.replace(HIT_START, "<b style='background:#fff59d'>").replace(HIT_END, "</b>")
+            parts.append(
+                f"<p><a href='msg:{hit['session_id']}:{hit['id']}'>{when} · {who}</a><br>{snippet}</p>"
+            )
+        self.results.setHtml("".join(parts) or "<i>Ничего не найдено</i>")
+        self.info.setText(f"Найдено: {len(hits)} за {elapsed:.1f} мс")
+
+    def on_result_clicked(self, url: QtCore.QUrl):
+        _, session_id, message_id = url.toString().split(":")
+        self.main.jump_to_message(int(session_id), int(message_id))
+
+
+class BackendsPanel(QtWidgets.QDialog):
+    """Серверы Ollama: список адресов и состояние каждого по проверкам пула."""
+
+    def __init__(self, main: "MainWindow"):
+        super().__init__(main)
+        self.main = main
+        self.setWindowTitle("🖧 Серверы Ollama")
+        self.resize(760, 420)
+
+        lay = QtWidgets.QVBoxLayout(self)
+        lay.addWidget(QtWidgets.QLabel("Адреса серверов, по одному в строке (первый — основной):"))
+        self.urls_edit = QtWidgets.QPlainTextEdit()
+        self.urls_edit.setFixedHeight(90)
+        self.urls_edit.setPlaceholderText(get_client().base_url)
+        self.urls_edit.setPlainText("\n".join(main.state.backends))
+        lay.addWidget(self.urls_edit)
+
+        self.table = QtWidgets.QTableWidget(0, 7)
+        self.table.setHorizontalHeaderLabels(
+            ["Сервер", "Состояние", "Моделей", "В памяти", "TTFT", "Сейчас / всего", "Ошибка"]
+        )
+        self.table.horizontalHeader().setSectionResizeMode(6, QtWidgets.QHeaderView.ResizeMode.Stretch)
+        self.table.setEditTriggers(QtWidgets.QAbstractItemView.EditTrigger.NoEditTriggers)
+        lay.addWidget(self.table, 1)
+
+        hint = QtWidgets.QLabel(
+            "💡 <i>Запрос уходит на доступный сервер с нужной моделью: меньше запросов в работе → "
+            "модель уже в памяти → меньше TTFT. Если сервер отказал до первого токена, "
+            "ответ тут же запрашивается у следующего.</i>"
+        )
+        hint.setWordWrap(True)
+        lay.addWidget(hint)
+
+        btns = QtWidgets.QHBoxLayout()
+        check_btn = QtWidgets.QPushButton("🔄 Проверить сейчас")
+        save_btn = QtWidgets.QPushButton("💾 Сохранить")
+        check_btn.clicked.connect(self.on_check)
+        save_btn.clicked.connect(self.on_save)
+        btns.addWidget(check_btn)
+        btns.addStretch(1)
+        btns.addWidget(save_btn)
+        lay.addLayout(btns)
+
+        self.timer = QtCore.QTimer(self)
+        self.timer.setInterval(1000)
+        self.timer.timeout.connect(self.refresh)
+
+    def showEvent(self, e):
+        super().showEvent(e)
+        self.refresh()
+        self.timer.start()
+
+    def hideEvent(self, e):
+        self.timer.stop()
+        super().hideEvent(e)
+
+    def refresh(self):
+        rows = get_pool().snapshot()
+        self.table.setRowCount(len(rows))
+        for row, b in enumerate(rows):
+            if not b["last_check"]:
+                status = "⏳ проверяется"
+            else:
+                status = "✅ доступен" if b["healthy"] else "❌ недоступен"
+            cells = [
+                b["url"], status,
+                "—" if b["models"] is None else str(b["models"]),
+                ", ".join(b["loaded"]) or "—",
+                "—" if b["ttft"] is None else f"{b['ttft'] * 1000:.0f} мс",
+                f"{b['inflight']} / {b['served']}",
+                b["last_error"],
+            ]
+            for col, text in enumerate(cells):
+                item = QtWidgets.QTableWidgetItem(text)
+                if col == 6 and text:
+                    item.setToolTip(text)
+                self.table.setItem(row, col, item)
+
+    def on_check(self):
+        get_pool().check_now()
+        self.main.statusBar().showMessage("🔄 Проверяю серверы Ollama...", 3000)
+
+    def on_save(self):
+        urls = [u.strip() for u in self.urls_edit.toPlainText().splitlines() if u.strip()]
+        bad = [u for u in urls if not u.startswith(("http://", "https://"))]
+        if bad:
+            QtWidgets.QMessageBox.warning(self, "Серверы", "Адрес должен начинаться с http:// или https://:\n" + "\n".join(bad))
+            return
+        self.main.state.backends = urls
+        self.main.save_state()
+        get_pool().configure(urls)
+        self.refresh()
+        # Список моделей — объединение по всем серверам
+        self.main.populate_models()
+
+
+# Колонки панели производительности: (заголовок, поле summarize_metrics, формат)
+METRIC_COLUMNS = [
+    ("TTFT p50, мс", "ttft_ms_p50", "{:.0f}"),
+    ("TTFT p99, мс", "ttft_ms_p99", "{:.0f}"),
+    ("ток/с p50", "tokens_per_sec_p50", "{:.1f}"),
+    ("джиттер p50, мс", "jitter_ms_p50", "{:.0f}"),
+    ("джиттер p99, мс", "jitter_ms_p99", "{:.0f}"),
+    ("пауза max p90, мс", "gap_max_ms_p90", "{:.0f}"),
+    ("промпт p90, мс", "prompt_eval_ms_p90", "{:.0f}"),
+    ("загрузка p90, мс", "load_ms_p90", "{:.0f}"),
+]
+METRIC_PERIODS = {"24 часа": 86400, "7 дней": 7 * 86400, "30 дней": 30 * 86400, "Всё время": 0}
+METRIC_BUCKETS = {"По часам": 3600, "По дням": 86400, "По неделям": 7 * 86400}
+
+
+class MetricsPanel(QtWidgets.QDialog):
+    """Перцентили замеров ответов по моделям и интервалам времени.
+
+    Данные — таблица metrics хранилища (пишется вместе с ответом);
+    выгрузка сохраняет сырые замеры выбранного фильтра в CSV или NDJSON.
+    """
+
+    def __init__(self, main: "MainWindow"):
+        super().__init__(main)
+        self.main = main
+        self.setWindowTitle("📈 Производительность моделей")
+        self.resize(900, 420)
+        self._rows: List[dict] = []
+
+        lay = QtWidgets.QVBoxLayout(self)
+        bar = QtWidgets.QHBoxLayout()
+        self.model_combo = QtWidgets.QComboBox()
+        self.period_combo = QtWidgets.QComboBox()
+        self.period_combo.addItems(list(METRIC_PERIODS))
+        self.period_combo.setCurrentIndex(1)
+        self.bucket_combo = QtWidgets.QComboBox()
+        self.bucket_combo.addItems(list(METRIC_BUCKETS))
+        self.bucket_combo.setCurrentIndex(1)
+        for combo in (self.model_combo, self.period_combo, self.bucket_combo):
+            combo.activated.connect(self.reload)
+            bar.addWidget(combo)
+        bar.addStretch(1)
+        lay.addLayout(bar)
+
+        self.table = QtWidgets.QTableWidget(0, 3 + len(METRIC_COLUMNS))
+        self.table.setHorizontalHeaderLabels(["Модель", "С", "Ответов"] + [c[0] for c in METRIC_COLUMNS])
+        self.table.setEditTriggers(QtWidgets.QAbstractItemView.EditTrigger.NoEditTriggers)
+        self.table.setSelectionBehavior(QtWidgets.QAbstractItemView.SelectionBehavior.SelectRows)
+        self.table.horizontalHeader().setSectionResizeMode(QtWidgets.QHeaderView.ResizeMode.ResizeToContents)
+        lay.addWidget(self.table, 1)
+
+        btns = QtWidgets.QHBoxLayout()
+        refresh_btn = QtWidgets.QPushButton("🔄 Обновить")
+        csv_btn = QtWidgets.QPushButton("💾 CSV…")
+        ndjson_btn = QtWidgets.QPushButton("💾 NDJSON…")
+        refresh_btn.clicked.connect(self.reload)
+        csv_btn.clicked.connect(lambda: self.on_export("csv"))
+        ndjson_btn.clicked.connect(lambda: self.on_export("ndjson"))
+        self.count_label = QtWidgets.QLabel()
+        btns.addWidget(refresh_btn)
+        btns.addWidget(self.count_label)
+        btns.addStretch(1)
+        btns.addWidget(csv_btn)
+        btns.addWidget(ndjson_btn)
+        lay.addLayout(btns)
+
+    def showEvent(self, e):
+        super().showEvent(e)
+        current = self.model_combo.currentText()
+        self.main.writer.flush()
+        self.model_combo.clear()
+        self.model_combo.addItem("Все модели")
+        self.model_combo.addItems(self.main.store.metric_models())
+        idx = self.model_combo.findText(current)
+        self.model_combo.setCurrentIndex(max(0, idx))
+        self.reload()
+
+    def reload(self, *_):
+        period = METRIC_PERIODS[self.period_combo.currentText()]
+        model = self.model_combo.currentText() if self.model_combo.currentIndex() > 0 else None
+        self.main.writer.flush()
+        self._rows = self.main.store.load_metrics(model, time.time() - period if period else None)
+        summary = summarize_metrics(self._rows, METRIC_BUCKETS[self.bucket_combo.currentText()])
+        fmt_time = "%Y-%m-%d %H:%M" if self.bucket_combo.currentIndex() == 0 else "%Y-%m-%d"
+        self.table.setRowCount(len(summary))
+        for row, rec in enumerate(summary):
+            cells = [rec["model"], time.strftime(fmt_time, time.localtime(rec["start"])), str(rec["count"])]
+            for _, key, fmt in METRIC_COLUMNS:
+                cells.append("—" if rec[key] is None else fmt.format(rec[key]))
+            for col, text in enumerate(cells):
+                self.table.setItem(row, col, QtWidgets.QTableWidgetItem(text))
+        self.count_label.setText(f"Замеров: {len(self._rows)}")
+
+    def on_export(self, fmt: str):
+        if not self._rows:
+            QtWidgets.QMessageBox.information(self, "Экспорт", "Нет замеров для выгрузки")
+            return
+        path, _ = QtWidgets.QFileDialog.getSaveFileName(
+            self, "Экспорт замеров", str(Path.home() / f"ollama-metrics.{fmt}"),
+            "CSV (*.csv)" if fmt == "csv" else "NDJSON (*.ndjson *.jsonl)",
+        )
+        if not path:
+            return
+        try:
+            count = export_metrics(self._rows, path)
+        except OSError as e:
+            QtWidgets.QMessageBox.warning(self, "Экспорт", f"Не удалось сохранить файл:\n{e}")
+            return
+        self.main.statusBar().showMessage(f"💾 Выгружено замеров: {count}", 5000)
+
+
+class InflightLimiter(QtCore.QObject):
+    """Общий предел одновременных запросов к Ollama (max_inflight).
+
+    Через него запускаются воркеры всех вкладок и сравнения моделей;
+    воркер, которому не хватило слота, ждёт и стартует, когда
+    освободится место.
+    """
+    changed = QtCore.pyqtSignal()
+
+    def __init__(self, state: ChatState, parent=None):
+        super().__init__(parent)
+        self.state = state
+        self._active: list = []
+        self._waiting: deque = deque()
+
+    def active_count(self) -> int:
+        return len(self._active)
+
+    def waiting_count(self) -> int:
+        return len(self._waiting)
+
+    def is_waiting(self, worker: QtCore.QThread) -> bool:
+        return worker in self._waiting
+
+    def start(self, worker: QtCore.QThread) -> bool:
+        """Запускает воркер сейчас или ставит в очередь; True — запущен сразу."""
+        worker.finished.connect(partial(self._release, worker))
+        self._waiting.append(worker)
+        self._pump()
+        self.changed.emit()
+        return worker in self._active
+
+    def cancel(self, worker: QtCore.QThread) -> bool:
+        """Убирает ещё не запущенный воркер из очереди."""
+        if worker in self._waiting:
+            self._waiting.remove(worker)
+            self.changed.emit()
+            return True
+        return False
+
+    def set_limit(self, limit: int):
+        self.state.max_inflight = max(1, limit)
+        self._pump()
+        self.changed.emit()
+
+    def _release(self, worker: QtCore.QThread):
+        if worker in self._active:
+            self._active.remove(worker)
+            self._pump()
+            self.changed.emit()
+
+    def _pump(self):
+        while self._waiting and len(self._active) < max(1, self.state.max_inflight):
+            worker = self._waiting.popleft()
+            self._active.append(worker)
+            worker.start()
+
+
+class ChatTab(QtWidgets.QWidget):
+    """Вкладка разговора: своя история, модель, ответ в работе и команды.
+
+    Пока вкладка в фоне, дельты ответа копятся в pending и попадают в
+    модель истории одной вставкой, когда вкладку открывают, — фоновые
+    вкладки не тратят время GUI на отрисовку.
+    """
+
+    def __init__(self, model: str, parent=None):
+        super().__init__(parent)
+        self.model = model
+        self.messages: List[ChatMessage] = []
+        self.session_id: Optional[int] = None
+        self.oldest_id: Optional[int] = None
+        self.worker: Optional[ChatWorker] = None
+        self.running = False
+        self.cmd_extractor = CommandExtractor()
+        self.suggestions: List[str] = []
+        self.pending: List[str] = []
+        self.unread = False
+        self.failed = False
+        self.closed = False
+
+        self.history_model = ChatHistoryModel(self)
+        self.history = ChatView(self.history_model)
+        self.history.setStyleSheet("""
+            QListView {
+                background-color: #d8d8d8;
+                border: 1px solid #999;
+                border-radius: 4px;
+                padding: 8px;
+                color: #212121;
+            }
+        """)
+        self.paint_counter = PaintCounter(self.history.viewport())
+        lay = QtWidgets.QVBoxLayout(self)
+        lay.setContentsMargins(0, 0, 0, 0)
+        lay.addWidget(self.history)
+
+    @property
+    def busy(self) -> bool:
+        """Ответ генерируется или ждёт свободного слота."""
+        return self.running
+
+    def buffer(self, delta: str):
+        """Дельта для фоновой вкладки: копим, изредка склеивая в одну строку."""
+        self.pending.append(delta)
+        if len(self.pending) >= 256:
+            self.pending[:] = ["".join(self.pending)]
+
+    def flush_pending(self):
+        """Переносит накопленные в фоне дельты в историю одной вставкой."""
+        if self.pending:
+            self.history_model.append_to_last("".join(self.pending))
+            self.pending.clear()
+
+    def label(self) -> str:
+        """Короткое имя вкладки: начало первого вопроса."""
+        first = next((m.content for m in self.messages if m.role == "user"), "")
+        if not first:
+            first = self.history_model.data(self.history_model.index(0)) if self.history_model.rowCount() else ""
+        return " ".join((first or "").split())[:24] or "Новый чат"
+
+    def title(self) -> str:
+        text = self.label()
+        if self.busy:
+            return f"🔄 {text}"
+        if self.failed:
+            return f"❌ {text}"
+        return f"• {text}" if self.unread else text
+
+
+class FanoutColumn(QtWidgets.QFrame):
+    """Колонка сравнения: ответ одной модели и его замеры."""
+
+    def __init__(self, model: str, parent=None):
+        super().__init__(parent)
+        self.model = model
+        self.worker: Optional[ChatWorker] = None
+        self.cancelled = False
+        self.done = False
+        self.error = ""
+        self.setFrameShape(QtWidgets.QFrame.Shape.StyledPanel)
+        self.setMinimumWidth(260)
+        lay = QtWidgets.QVBoxLayout(self)
+        lay.setContentsMargins(4, 4, 4, 4)
+        title = QtWidgets.QLabel(f"<b>{html.escape(model)}</b>")
+        lay.addWidget(title)
+        self.status = QtWidgets.QLabel("⏳ В очереди")
+        self.status.setStyleSheet("color:#666;")
+        self.status.setWordWrap(True)
+        lay.addWidget(self.status)
+        self.view = QtWidgets.QPlainTextEdit(readOnly=True)
+        lay.addWidget(self.view, 1)
+
+    def append(self, delta: str):
+        cursor = self.view.textCursor()
+        cursor.movePosition(QtGui.QTextCursor.MoveOperation.End)
+        cursor.insertText(delta)
+
+
+class FanoutPanel(QtWidgets.QDialog):
+    """Один вопрос нескольким моделям: ответы стримятся рядом.
+
+    Контекст (системный промпт и история) — как у обычного запроса, но
+    ответы в историю разговора не попадают. Одновременно генерируется
+    не больше fanout_concurrency ответов, остальные ждут очереди.
+    """
+
+    def __init__(self, main: "MainWindow"):
+        super().__init__(main)
+        self.main = main
+        self.setWindowTitle("⚖️ Сравнение моделей")
+        self.resize(1000, 600)
+        self.columns: List[FanoutColumn] = []
+
+        lay = QtWidgets.QVBoxLayout(self)
+        top = QtWidgets.QHBoxLayout()
+        self.models_list = QtWidgets.QListWidget()
+        self.models_list.setFixedHeight(90)
+        self.models_list.setToolTip("Отметьте модели для сравнения")
+        top.addWidget(self.models_list, 1)
+        self.prompt_edit = QtWidgets.QPlainTextEdit()
+        self.prompt_edit.setFixedHeight(90)
+        self.prompt_edit.setPlaceholderText("Вопрос для всех отмеченных моделей…")
+        top.addWidget(self.prompt_edit, 2)
+        lay.addLayout(top)
+
+        bar = QtWidgets.QHBoxLayout()
+        bar.addWidget(QtWidgets.QLabel("Одновременно:"))
+        self.limit_spin = QtWidgets.QSpinBox()
+        self.limit_spin.setRange(1, 8)
+        self.limit_spin.setValue(main.state.fanout_concurrency)
+        self.limit_spin.setToolTip("Больше параллельных ответов — больше нагрузка на CPU/GPU и память")
+        self.limit_spin.valueChanged.connect(self.on_limit_changed)
+        bar.addWidget(self.limit_spin)
+        bar.addStretch(1)
+        self.send_btn = QtWidgets.QPushButton("📨 Отправить всем")
+        self.stop_btn = QtWidgets.QPushButton("⏹️ Остановить")
+        self.stop_btn.setEnabled(False)
+        self.send_btn.clicked.connect(self.on_send)
+        self.stop_btn.clicked.connect(self.on_stop)
+        bar.addWidget(self.send_btn)
+        bar.addWidget(self.stop_btn)
+        lay.addLayout(bar)
+
+        self.splitter = QtWidgets.QSplitter(QtCore.Qt.Orientation.Horizontal)
+        lay.addWidget(self.splitter, 1)
+
+    def showEvent(self, e):
+        super().showEvent(e)
+        self.fill_models()
+        if not self.prompt_edit.toPlainText():
+            self.prompt_edit.setPlainText(self.main.input.toPlainText())
+
+    def fill_models(self):
+        box = self.main.model_box
+        names = [box.itemText(i) for i in range(box.count())]
+        checked = set(self.main.state.fanout_models) or {self.main.state.model}
+        self.models_list.clear()
+        for name in names:
+            item = QtWidgets.QListWidgetItem(name)
+            item.setFlags(item.flags() | QtCore.Qt.ItemFlag.ItemIsUserCheckable)
+            item.setCheckState(
+                QtCore.Qt.CheckState.Checked if name in checked else QtCore.Qt.CheckState.Unchecked
+            )
+            self.models_list.addItem(item)
+
+    def selected_models(self) -> List[str]:
+        return [
+            self.models_list.item(i).text()
+            for i in range(self.models_list.count())
+            if self.models_list.item(i).checkState() == QtCore.Qt.CheckState.Checked
+        ]
+
+    def running(self) -> List[FanoutColumn]:
+        """Колонки с идущим ответом (в том числе ждущие слота общего лимитера)."""
+        return [c for c in self.columns if c.worker is not None and not c.done]
+
+    def on_limit_changed(self, value: int):
+        self.main.state.fanout_concurrency = value
+        self.main.save_state()
+        self.pump()
+
+    def on_send(self):
+        models = self.selected_models()
+        prompt = self.prompt_edit.toPlainText().strip()
+        if not models or not prompt or self.running():
+            return
+        self.main.state.fanout_models = models
+        self.main.state.system_prompt = self.main.sys_prompt.toPlainText()
+        self.main.save_state()
+        for col in self.columns:
+            col.setParent(None)
+            col.deleteLater()
+        self.columns = []
+        self._prompt = prompt
+        for model in models:
+            col = FanoutColumn(model)
+            self.splitter.addWidget(col)
+            self.columns.append(col)
+        self.send_btn.setEnabled(False)
+        self.stop_btn.setEnabled(True)
+        self.pump()
+
+    def pump(self):
+        """Запускает ожидающие колонки, пока есть свободные слоты."""
+        free = self.main.state.fanout_concurrency - len(self.running())
+        for col in self.columns:
+            if free <= 0:
+                break
+            if col.worker is not None or col.cancelled:
+                continue
+            worker = ChatWorker(
+                replace(self.main.state, messages=list(self.main.tab.messages)),
+                self._prompt, self.main.make_context_builder(col.model),
+                self, model=col.model, record=False,
+            )
+            worker.chunk.connect(col.append)
+            worker.chunk.connect(lambda _d, c=col: self.update_status(c))
+            worker.failed.connect(lambda err, c=col: setattr(c, "error", err))
+            worker.finished.connect(lambda c=col: self.on_worker_done(c))
+            col.worker = worker
+            if self.main.limiter.start(worker):
+                col.status.setText("🔄 Ждём первый токен…")
+            else:
+                col.status.setText("⏳ Ждём свободного слота…")
+                worker.started.connect(lambda c=col: c.status.setText("🔄 Ждём первый токен…"))
+            free -= 1
+
+    def update_status(self, col: FanoutColumn):
+        timing = col.worker.timing
+        if col.error:
+            col.status.setText(f"❌ {col.error}")
+            return
+        if timing.finished is None:
+            prefix = "🔄"
+        else:
+            prefix = "⏹️ Остановлено ·" if col.cancelled else "✅"
+        col.status.setText(f"{prefix} {timing.summary()}")
+
+    def on_worker_done(self, col: FanoutColumn):
+        col.done = True
+        self.update_status(col)
+        self.pump()
+        if not self.running() and all(c.worker is not None or c.cancelled for c in self.columns):
+            self.send_btn.setEnabled(True)
+            self.stop_btn.setEnabled(False)
+
+    def shutdown(self, timeout_ms: int = 2000):
+        self.on_stop()
+        for col in self.columns:
+            if col.worker is not None:
+                col.worker.wait(timeout_ms)
+
+    def on_stop(self):
+        # Ожидающие не запускаем вовсе, идущие останавливаем
+        for col in self.columns:
+            col.cancelled = True
+            if col.worker is None:
+                col.status.setText("⛔ Отменено")
+            elif self.main.limiter.cancel(col.worker):
+                col.worker.deleteLater()
+                col.worker = None
+                col.status.setText("⛔ Отменено")
+            elif not col.done:
+                col.worker.stop()
+        if not self.running():
+            self.send_btn.setEnabled(True)
+            self.stop_btn.setEnabled(False)
+
+
+class StartupProfile:
+    """Замеры фаз запуска (--startup-profile): строка в stderr на каждую фазу."""
+
+    def __init__(self, t0: float):
+        self.enabled = False
+        self.t0 = t0
+        self.last = t0
+
+    def mark(self, phase: str):
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        print(f"⏱️ {phase:<40} {(now - self.last) * 1000:8.1f} мс   "
+              f"(с запуска {(now - self.t0) * 1000:8.1f} мс)", file=sys.stderr, flush=True)
+        self.last = now
+
+
+STARTUP = StartupProfile(_STARTUP_T0)
+
+
+class TrayIcon(QtWidgets.QSystemTrayIcon):
+    """Иконка в трее — первое, что появляется при запуске.
+
+    Главное окно (виджеты, стили, меню, хранилище, сеть) строится при
+    первом обращении к нему: клик по иконке или пункт меню. Старт с
+    --minimize платит только за трей.
+    """
+
+    def __init__(self, parent=None):
+        icon = QtGui.QIcon(str(ICON_PATH)) if ICON_PATH.exists() else QtGui.QIcon.fromTheme("chat")
+        super().__init__(icon, parent)
+        self.setToolTip(APP_NAME)
+        self._window: Optional[MainWindow] = None
+        self.menu = QtWidgets.QMenu()
+        self.action_show_hide = self.menu.addAction("👁️ Показать/Скрыть")
+        self.action_new_chat = self.menu.addAction("🆕 Новый чат")
+        self.menu.addSeparator()
+        self.action_quit = self.menu.addAction("🚪 Выход")
+        self.setContextMenu(self.menu)
+        self.action_show_hide.triggered.connect(lambda: self.window().toggle_visible())
+        self.action_new_chat.triggered.connect(lambda: self.window().new_chat())
+        self.action_quit.triggered.connect(self.on_quit)
+        self.activated.connect(self.on_activated)
+
+    def attach(self, window: "MainWindow"):
+        self._window = window
+
+    def window(self) -> "MainWindow":
+        if self._window is None:
+            MainWindow(tray=self)
+            STARTUP.mark("главное окно построено")
+        return self._window
+
+    def on_activated(self, reason: QtWidgets.QSystemTrayIcon.ActivationReason):
+        if reason in (QtWidgets.QSystemTrayIcon.ActivationReason.Trigger,
+                      QtWidgets.QSystemTrayIcon.ActivationReason.DoubleClick):
+            self.window().toggle_visible()
+
+    def on_quit(self):
+        if self._window is not None:
+            self._window.on_quit()
+        else:
+            QtWidgets.QApplication.quit()
+
+
+# ====== Локальный API ======
+class IpcConnection(QtCore.QObject):
+    """Одно подключение к локальному API: строка запроса, затем поток ответов."""
+    request = QtCore.pyqtSignal(object)  # dict из строки запроса
+    gone = QtCore.pyqtSignal()  # клиент ушёл, не дождавшись конца ответа
+
+    def __init__(self, sock, parent=None):
+        super().__init__(parent)
+        self.sock = sock
+        self.closed = False
+        self._buf = b""
+        sock.setParent(self)
+        sock.readyRead.connect(self.on_ready_read)
+        sock.disconnected.connect(self.on_disconnected)
+
+    def on_ready_read(self):
+        data = bytes(self.sock.readAll())
+        if self.closed:
+            return  # запрос уже принят — остальное не читаем и не копим
+        self._buf += data
+        if b"\n" not in self._buf[:IPC_MAX_REQUEST_BYTES + 1]:
+            if len(self._buf) > IPC_MAX_REQUEST_BYTES:
+                self._buf = b""
+                self.finish({"error": f"запрос длиннее {format_size(IPC_MAX_REQUEST_BYTES)}"})
+            return
+        line = self._buf.split(b"\n", 1)[0]
+        self._buf = b""
+        try:
+            req = json.loads(line)
+        except ValueError as e:
+            req = None
+            self.send({"error": f"неверный JSON: {e}"})
+        if not isinstance(req, dict):
+            self.finish()
+            return
+        self.request.emit(req)
+
+    def send(self, msg: dict):
+        if not self.closed:
+            self.sock.write((json.dumps(msg, ensure_ascii=False) + "\n").encode("utf-8"))
+
+    def finish(self, msg: Optional[dict] = None):
+        """Последний ответ; соединение закрывается, когда всё записано."""
+        if self.closed:
+            return
+        if msg is not None:
+            self.send(msg)
+        self.closed = True
+        self.sock.disconnectFromServer()
+
+    def on_disconnected(self):
+        if not self.closed:
+            self.closed = True
+            self.gone.emit()
+        self.deleteLater()
+
+
+class IpcServer(QtCore.QObject):
+    """Локальный API запущенного приложения на Unix‑сокете IPC_SOCKET_PATH.
+
+    Запрос — строка JSON {"cmd": ...}, ответы — строки JSON:
+      ping                          → {"ok": true, "version": ...}
+      show                          → показать окно (так будит его второй запуск)
+      models                        → {"models": [...], "current": ...}
+      ask {prompt, model?, new_tab?, no_cache?}
+                                    → {"model": ...}, {"delta": ...}…, {"done": true, ...}
+      suggestions                   → {"suggestions": [...]} текущей вкладки
+      run {index | command}         → {"job": id, ...}, затем {"done": true, "returncode": ...}
+    Выполняется только команда, предложенная в текущей вкладке и не попавшая
+    в чёрный список. Ошибка — {"error": ...}. Окно строится по первому запросу,
+    которому оно нужно.
+    """
+
+    def __init__(self, tray: Optional[TrayIcon], path: str = IPC_SOCKET_PATH, parent=None):
+        super().__init__(parent)
+        from PyQt6 import QtNetwork
+        self.tray = tray
+        self.path = path
+        self.server = QtNetwork.QLocalServer(self)
+        self.server.newConnection.connect(self.on_new_connection)
+
+    def listen(self) -> str:
+        """Занимает сокет: "ok", "running" — его держит живой экземпляр,
+        "error" — причина в server.errorString()."""
+        from PyQt6 import QtNetwork
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        if self._bind():
+            return "ok"
+        if self.server.serverError() != QtNetwork.QAbstractSocket.SocketError.AddressInUseError:
+            return "error"
+        # Решает сам bind: сокет удаляется, только если на нём никто не отвечает.
+        # Проверку и повторный bind запуски проходят по очереди, иначе второй
+        # сотрёт сокет, который первый только что занял вместо оставшегося
+        import fcntl
+        with open(self.path + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if ipc_running(self.path):
+                return "running"
+            QtNetwork.QLocalServer.removeServer(self.path)
+            return "ok" if self._bind() else "error"
+
+    def _bind(self) -> bool:
+        # Не UserAccessOption: с ним Qt создаёт сокет рядом и переименовывает
+        # поверх пути, молча отбирая его у живого экземпляра. Права — через umask
+        old = os.umask(0o077)
+        try:
+            return self.server.listen(self.path)
+        finally:
+            os.umask(old)
+
+    def close(self):
+        self.server.close()
+
+    def on_new_connection(self):
+        while self.server.hasPendingConnections():
+            conn = IpcConnection(self.server.nextPendingConnection(), self)
+            conn.request.connect(partial(self.handle, conn))
+
+    def handle(self, conn: IpcConnection, req: dict):
+        cmd = req.get("cmd")
+        handler = getattr(self, f"cmd_{cmd}", None) if isinstance(cmd, str) else None
+        if handler is None:
+            conn.finish({"error": f"неизвестная команда: {cmd}"})
+            return
+        try:
+            handler(conn, req)
+        except Exception as e:
+            conn.finish({"error": str(e)})
+
+    def cmd_ping(self, conn: IpcConnection, _req: dict):
+        conn.finish({"ok": True, "version": APP_VERSION, "pid": os.getpid()})
+
+    def cmd_show(self, conn: IpcConnection, _req: dict):
+        win = self.tray.window()
+        win.show()
+        win.raise_()
+        win.activateWindow()
+        conn.finish({"ok": True})
+
+    def cmd_models(self, conn: IpcConnection, _req: dict):
+        win = self.tray.window()
+        loader = win.models_loader
+        if loader is not None and loader.isRunning():
+            # Окно только что построено — отвечаем, когда список загрузится
+            loader.finished.connect(lambda: self.cmd_models(conn, _req))
+            return
+        names = [win.model_box.itemText(i) for i in range(win.model_box.count())]
+        conn.finish({"models": names, "current": win.tab.model})
+
+    def cmd_suggestions(self, conn: IpcConnection, _req: dict):
+        win = self.tray.window()
+        conn.finish({"suggestions": win.tab.suggestions, "model": win.tab.model})
+
+    def cmd_ask(self, conn: IpcConnection, req: dict):
+        prompt = str(req.get("prompt") or "").strip()
+        if not prompt:
+            conn.finish({"error": "пустой вопрос"})
+            return
+        win = self.tray.window()
+        # Идущий ответ не трогаем — вопрос уходит в новую вкладку
+        tab = win.tab
+        if tab.busy or req.get("new_tab"):
+            tab = win.new_tab()
+        model = req.get("model") or win.model_box.currentText() or tab.model
+        idx = win.model_box.findText(model)
+        if idx >= 0:
+            win.model_box.setCurrentIndex(idx)
+        tab.model = model
+        worker = win.submit(tab, prompt, bypass_cache=bool(req.get("no_cache")))
+        conn.send({"model": model, "queued": win.limiter.is_waiting(worker)})
+        worker.chunk.connect(lambda delta: conn.send({"delta": delta}))
+        worker.failed.connect(lambda err: conn.finish({"error": err}))
+        worker.finished.connect(partial(self._ask_done, conn, tab, worker))
+        # Снят с очереди до старта — finished уже не придёт
+        worker.destroyed.connect(lambda: conn.finish({"error": "⛔ отменено"}))
+        # Клиент прервался (Ctrl+C) — ответ больше никому не нужен
+        conn.gone.connect(lambda: tab.worker is worker and win.stop_tab(tab))
+
+    def _ask_done(self, conn: IpcConnection, tab: ChatTab, worker: ChatWorker):
+        timing = worker.timing
+        conn.finish({
+            "done": True,
+            "stopped": timing.final is None and not worker.cached,
+            "cached": worker.cached,
+            "backend": worker.backend_url,
+            "metrics": timing.metrics() if timing.finished is not None else {},
+            "suggestions": tab.suggestions,
+        })
+
+    def cmd_run(self, conn: IpcConnection, req: dict):
+        win = self.tray.window()
+        suggestions = win.tab.suggestions
+        if req.get("index") is not None:
+            index = int(req["index"])
+            if not 0 <= index < len(suggestions):
+                conn.finish({"error": f"нет команды №{index} (предложено {len(suggestions)})"})
+                return
+            command = suggestions[index]
+        else:
+            command = str(req.get("command") or "").strip()
+            if command not in suggestions:
+                conn.finish({"error": "команда не из предложенных в текущей вкладке"})
+                return
+        if not win.is_command_allowed(command):
+            conn.finish({"error": f"⛔ команда запрещена: {command}"})
+            return
+        queue = win.job_queue
+        job = queue.submit([command])[0]
+        conn.send({"job": job.id, "command": command})
+
+        def on_finished(done: Job):
+            if done is not job:
+                return
+            queue.job_finished.disconnect(on_finished)
+            conn.finish({
+                "done": True,
+                "status": job.status,
+                "returncode": job.returncode,
+                "error": job.error,
+                "output": job.doc.toPlainText() if job.doc is not None else "",
+            })
+
+        queue.job_finished.connect(on_finished)
+
+
 class MainWindow(QtWidgets.QMainWindow):
-    def __init__(self):
+    # Ошибка фоновой записи (WriteBehind, из его потока) — показывается в статусе
+    write_failed = QtCore.pyqtSignal(str)
+
+    def __init__(self, tray: Optional["TrayIcon"] = None):
         super().__init__()
         self.setWindowTitle(APP_NAME)
         
@@ -176,21 +1636,61 @@ class MainWindow(QtWidgets.QMainWindow):
         
         self.resize(820, 600)
 
+        STARTUP.mark("окно: старт")
         self.state = self.load_state()
-        self.worker: Optional[ChatWorker] = None
+        get_client().set_timeouts(self.state.connect_timeout, self.state.read_timeout)
+        # Пул серверов: проверки здоровья идут в фоне, запросы — на лучший сервер
+        get_pool().configure(self.state.backends)
+        get_pool().start()
+        self.backends_panel: Optional[BackendsPanel] = None
+        # Чёрный список компилируется один раз и пересобирается только при смене правил
+        self.deny_matcher = DenyMatcher(self.state.deny_patterns)
+        self._last_deny: Optional[int] = None
+        # Все запросы к Ollama (вкладки и сравнение моделей) — через общий предел
+        self.limiter = InflightLimiter(self.state, self)
+        # Одобренные команды выполняются в очереди, без модальных окон
+        self.job_queue = JobQueue(self.state, self)
+        self.job_queue.job_finished.connect(self.on_job_finished)
+        self.job_queue.shell_provider = self.current_shell
+        self.job_panel: Optional[JobPanel] = None
+        # Общие shell по разговорам: session_id -> ShellSession (LRU)
+        self.shells: "OrderedDict[Optional[int], ShellSession]" = OrderedDict()
+        self.catalog = ModelCatalog()
+        self.models_loader: Optional[ModelsLoader] = None
+        self.residency_panel: Optional[ResidencyPanel] = None
+        self.session_browser: Optional[SessionBrowser] = None
+        # Журнал истории (сегменты) и хранилище разговоров;
+        # при первом запуске переносим в хранилище накопленный журнал
+        self.history_log = HistoryLog()
+        self.store = ConversationStore()
+        if self.store.is_empty():
+            self.store.import_records(self.history_log.iter_records())
+        # Полнотекстовый индекс ведётся в фоновом потоке
+        self.search_index = SearchIndex()
+        self.search_index.start(self.store)
+        self.search_panel: Optional[SearchPanel] = None
+        self.fanout_panel: Optional[FanoutPanel] = None
+        self.metrics_panel: Optional[MetricsPanel] = None
+        self._response_cache: Optional[ResponseCache] = None
+        self._memory: Optional[MemoryIndex] = None
+        # Вся запись на диск (конфиг, журнал, хранилище) — в фоновом потоке
+        self.writer = WriteBehind(self.history_log, self.store, self.search_index,
+                                  on_error=self.write_failed.emit)
+        self.write_failed.connect(self.on_write_failed)
+        self._preloads: dict = {}
+        STARTUP.mark("окно: конфиг, хранилище, индекс")
+
+        # Виджеты: каждый разговор — своя вкладка (ChatTab)
+        self.tabs = QtWidgets.QTabWidget()
+        self.tabs.setTabsClosable(True)
+        self.tabs.setMovable(True)
+        self.tabs.setDocumentMode(True)
+        new_tab_btn = QtWidgets.QToolButton()
+        new_tab_btn.setText("➕")
+        new_tab_btn.setToolTip("Новая вкладка (Ctrl+T)")
+        new_tab_btn.clicked.connect(lambda: self.new_tab())
+        self.tabs.setCornerWidget(new_tab_btn, QtCore.Qt.Corner.TopRightCorner)
 
-        # Виджеты
-        self.history = QtWidgets.QTextEdit(readOnly=True)
-        self.history.setStyleSheet("""
-            QTextEdit {
-                background-color: #d8d8d8;
-                border: 1px solid #999;
-                border-radius: 4px;
-                padding: 8px;
-                color: #212121;
-            }
-        """)
-        
         self.input = QtWidgets.QPlainTextEdit()
         self.input.setPlaceholderText("Введите сообщение… (Enter — отправить, Shift+Enter — новая строка)")
         self.input.setStyleSheet("""
@@ -305,7 +1805,7 @@ class MainWindow(QtWidgets.QMainWindow):
         v.addWidget(QtWidgets.QLabel("⚙️ Системный промпт:"))
         v.addWidget(self.sys_prompt)
         v.addWidget(QtWidgets.QLabel("💬 История:"))
-        v.addWidget(self.history, 1)
+        v.addWidget(self.tabs, 1)
         # --- Предложенные команды от ассистента ---
         cmd_label = QtWidgets.QLabel("🔧 Предложенные команды (обновляются при следующем вопросе):")
         cmd_label.setWordWrap(True)
@@ -320,15 +1820,18 @@ class MainWindow(QtWidgets.QMainWindow):
         sug_btn_bar = QtWidgets.QHBoxLayout()
         self.sug_preview_btn = QtWidgets.QPushButton("👁️ Просмотр")
         self.sug_accept_btn = QtWidgets.QPushButton("✅ Выполнить")
+        self.sug_accept_all_btn = QtWidgets.QPushButton("⏩ Выполнить все")
         self.sug_reject_btn = QtWidgets.QPushButton("🗑️ Убрать")
         sug_btn_bar.addWidget(self.sug_preview_btn)
         sug_btn_bar.addWidget(self.sug_accept_btn)
+        sug_btn_bar.addWidget(self.sug_accept_all_btn)
         sug_btn_bar.addWidget(self.sug_reject_btn)
         v.addLayout(sug_btn_bar)
         v.addWidget(QtWidgets.QLabel("✏️ Сообщение:"))
         v.addWidget(self.input)
         v.addLayout(btn_bar)
         self.setCentralWidget(central)
+        STARTUP.mark("окно: виджеты и стили")
 
         # Меню
         menubar = self.menuBar()
@@ -337,6 +1840,28 @@ class MainWindow(QtWidgets.QMainWindow):
         new_chat_action = file_menu.addAction("🆕 Новый чат")
         new_chat_action.setShortcut("Ctrl+N")
         new_chat_action.triggered.connect(self.new_chat)
+        resend_action = file_menu.addAction("🔁 Отправить без кэша")
+        resend_action.setShortcut("Ctrl+Shift+Return")
+        resend_action.triggered.connect(lambda: self.on_send(bypass_cache=True))
+        new_tab_action = file_menu.addAction("🗂️ Новая вкладка")
+        new_tab_action.setShortcut("Ctrl+T")
+        new_tab_action.triggered.connect(lambda: self.new_tab())
+        close_tab_action = file_menu.addAction("✖️ Закрыть вкладку")
+        close_tab_action.setShortcut("Ctrl+W")
+        close_tab_action.triggered.connect(lambda: self.close_tab(self.tabs.currentIndex()))
+
+        sessions_action = file_menu.addAction("🗂️ Разговоры...")
+        sessions_action.setShortcut("Ctrl+O")
+        sessions_action.triggered.connect(self.show_session_browser)
+        search_action = file_menu.addAction("🔎 Поиск по истории...")
+        search_action.setShortcut("Ctrl+F")
+        search_action.triggered.connect(self.show_search_panel)
+        fanout_action = file_menu.addAction("⚖️ Сравнить модели...")
+        fanout_action.setShortcut("Ctrl+M")
+        fanout_action.triggered.connect(self.show_fanout_panel)
+        jobs_action = file_menu.addAction("🧰 Выполнение команд...")
+        jobs_action.setShortcut("Ctrl+J")
+        jobs_action.triggered.connect(self.show_job_panel)
         
         file_menu.addSeparator()
         
@@ -347,22 +1872,40 @@ class MainWindow(QtWidgets.QMainWindow):
         settings_menu = menubar.addMenu("⚙️ Настройки")
         security_action = settings_menu.addAction("🛡️ Безопасность команд")
         security_action.triggered.connect(self.show_security_settings)
+        residency_action = settings_menu.addAction("🧩 Модели в памяти")
+        residency_action.triggered.connect(self.show_residency_panel)
+        self.summarize_action = settings_menu.addAction("🗜️ Сворачивать старую историю в сводку")
+        self.summarize_action.setCheckable(True)
+        self.summarize_action.setChecked(self.state.context_policy == "summarize")
+        self.summarize_action.toggled.connect(self.on_context_policy_toggled)
+        inflight_action = settings_menu.addAction("🚦 Одновременных запросов...")
+        inflight_action.triggered.connect(self.ask_max_inflight)
+        backends_action = settings_menu.addAction("🖧 Серверы Ollama...")
+        backends_action.triggered.connect(self.show_backends_panel)
+        self.cache_action = settings_menu.addAction("💾 Кэшировать ответы")
+        self.cache_action.setCheckable(True)
+        self.cache_action.setChecked(self.state.response_cache)
+        self.cache_action.toggled.connect(self.on_cache_toggled)
+        cache_stats_action = settings_menu.addAction("📦 Кэш ответов...")
+        cache_stats_action.triggered.connect(self.show_cache_stats)
+        self.memory_action = settings_menu.addAction("🧠 Помнить прошлые разговоры")
+        self.memory_action.setCheckable(True)
+        self.memory_action.setChecked(self.state.memory_enabled)
+        self.memory_action.toggled.connect(self.on_memory_toggled)
+        memory_stats_action = settings_menu.addAction("🧠 Память...")
+        memory_stats_action.triggered.connect(self.show_memory_stats)
         
         help_menu = menubar.addMenu("❓ Помощь")
         about_action = help_menu.addAction("ℹ️ О программе")
         about_action.triggered.connect(self.show_about)
-
-        # Трей
-        icon = QtGui.QIcon(str(ICON_PATH)) if ICON_PATH.exists() else QtGui.QIcon.fromTheme("chat")
-        self.tray = QtWidgets.QSystemTrayIcon(icon, self)
-        self.tray.setToolTip(APP_NAME)
-        menu = QtWidgets.QMenu()
-        self.action_show_hide = menu.addAction("👁️ Показать/Скрыть")
-        self.action_new_chat = menu.addAction("🆕 Новый чат")
-        menu.addSeparator()
-        self.action_quit = menu.addAction("🚪 Выход")
-        self.tray.setContextMenu(menu)
-        self.tray.activated.connect(self.on_tray_activated)
+        conn_stats_action = help_menu.addAction("📊 Соединения с Ollama")
+        conn_stats_action.triggered.connect(self.show_connection_stats)
+        metrics_action = help_menu.addAction("📈 Производительность моделей")
+        metrics_action.triggered.connect(self.show_metrics_panel)
+
+        # Трей обычно уже создан (см. main) — окно к нему только подключается
+        self.tray = tray or TrayIcon(self)
+        self.tray.attach(self)
         self.tray.show()
 
         # Сигналы
@@ -372,192 +1915,704 @@ class MainWindow(QtWidgets.QMainWindow):
         # suggested commands
         self.sug_preview_btn.clicked.connect(self.on_suggest_preview)
         self.sug_accept_btn.clicked.connect(self.on_suggest_accept)
+        self.sug_accept_all_btn.clicked.connect(self.on_suggest_accept_all)
         self.sug_reject_btn.clicked.connect(self.on_suggest_reject)
-        self.action_quit.triggered.connect(self.on_quit)
-        self.action_show_hide.triggered.connect(self.toggle_visible)
-        self.action_new_chat.triggered.connect(self.new_chat)
         self.input.installEventFilter(self)
-
-        # Данные
-        self.populate_models()
-        self.restore_history_to_view()
-        
-        # Статус бар
+        self.input.textChanged.connect(self.update_context_meter)
+        self.model_box.currentTextChanged.connect(self.update_context_meter)
+        self.model_box.activated.connect(self.on_model_selected)
+        self.tabs.currentChanged.connect(self.on_tab_changed)
+        self.tabs.tabCloseRequested.connect(self.close_tab)
+        self.tabs.tabBar().tabMoved.connect(lambda *_: self.save_state())
+        self.limiter.changed.connect(self.update_inflight_label)
+
+        # Статус бар: скорость доставки стрима и индикатор заполнения контекста
+        self.stream_label = QtWidgets.QLabel()
+        self.statusBar().addPermanentWidget(self.stream_label)
+        self.context_label = QtWidgets.QLabel()
+        self.statusBar().addPermanentWidget(self.context_label)
+        self.inflight_label = QtWidgets.QLabel()
+        self.statusBar().addPermanentWidget(self.inflight_label)
+        self.timing_label = QtWidgets.QLabel()
+        self.statusBar().addPermanentWidget(self.timing_label)
+        self.stream_timer = QtCore.QTimer(self)
+        self.stream_timer.setInterval(1000)
+        self.stream_timer.timeout.connect(self.update_stream_stats)
+        self._stream_mark = (0.0, 0, 0, 0)
+
+        # Данные: сразу из кэша, затем обновление из сети в фоне
         self.statusBar().showMessage("✅ Готов к работе")
+        self._fill_model_box(self.catalog.names() or [self.state.model])
+        STARTUP.mark("окно: меню и сигналы")
+        # Восстанавливаем вкладки прошлого запуска (или продолжаем последний разговор)
+        self.restore_tabs()
+        self.update_context_meter()
+        self.update_inflight_label()
+        self.populate_models()
+        # Память (numpy и догоняющая индексация) — уже после показа окна
+        QtCore.QTimer.singleShot(0, self.memory_index)
+        STARTUP.mark("окно: история и запуск загрузки моделей")
 
     # ====== Служебные ======
     def load_state(self) -> ChatState:
         ensure_paths()
-        if os.path.exists(CONFIG_PATH):
-            try:
-                with open(CONFIG_PATH, "r", encoding="utf-8") as f:
-                    cfg = json.load(f)
-                st = ChatState(
-                    model=cfg.get("model", "phi3.5:3.8b-mini-instruct"),
-                    system_prompt=cfg.get("system_prompt", ""),
-                    messages=[],
-                )
-                # Загружаем настройки безопасности
-                if "safe_sudo_commands" in cfg:
-                    st.safe_sudo_commands = cfg["safe_sudo_commands"]
-                if "deny_patterns" in cfg:
-                    st.deny_patterns = cfg["deny_patterns"]
-                return st
-            except Exception:
-                pass
-        return ChatState()
+        st = load_chat_state()
+        # Значения, которые понимает только окно
+        if st.job_mode not in JOB_MODES:
+            st.job_mode = ChatState.job_mode
+        if st.exec_backend not in EXEC_BACKENDS:
+            st.exec_backend = ChatState.exec_backend
+        return st
 
     def save_state(self):
-        ensure_paths()
+        """Ставит конфиг в очередь фоновой записи (файл меняется, только если есть изменения)."""
         cfg = {
             "model": self.state.model,
             "system_prompt": self.sys_prompt.toPlainText(),
+            "connect_timeout": self.state.connect_timeout,
+            "read_timeout": self.state.read_timeout,
+            "num_ctx": self.state.num_ctx,
+            "context_policy": self.state.context_policy,
+            "keep_alive": self.state.keep_alive,
+            "chunk_mode": self.state.chunk_mode,
+            "chunk_flush_ms": self.state.chunk_flush_ms,
+            "chunk_flush_bytes": self.state.chunk_flush_bytes,
+            "runner_max_lines": self.state.runner_max_lines,
+            "runner_flush_ms": self.state.runner_flush_ms,
+            "job_concurrency": self.state.job_concurrency,
+            "job_mode": self.state.job_mode,
+            "max_inflight": self.state.max_inflight,
+            "backends": self.state.backends,
+            "response_cache": self.state.response_cache,
+            "cache_ttl_hours": self.state.cache_ttl_hours,
+            "cache_max_mb": self.state.cache_max_mb,
+            "memory": self.state.memory_enabled,
+            "embed_model": self.state.embed_model,
+            "memory_k": self.state.memory_k,
+            "memory_tokens": self.state.memory_tokens,
+            "tabs": [t.session_id for t in self.all_tabs() if t.session_id is not None],
+            "active_tab": self.tabs.currentIndex(),
+            "fanout_concurrency": self.state.fanout_concurrency,
+            "fanout_models": self.state.fanout_models,
+            "exec_backend": self.state.exec_backend,
+            "shell_timeout": self.state.shell_timeout,
             "safe_sudo_commands": self.state.safe_sudo_commands,
             "deny_patterns": self.state.deny_patterns,
         }
-        with open(CONFIG_PATH, "w", encoding="utf-8") as f:
-            json.dump(cfg, f, ensure_ascii=False, indent=2)
+        self.writer.save_config(CONFIG_PATH, cfg)
 
-    def append_history_log(self, role: str, content: str):
-        ensure_paths()
+    def append_history_log(self, role: str, content: str, tab: Optional["ChatTab"] = None,
+                           metrics: Optional[dict] = None):
+        tab = tab or self.tab
         rec = {"ts": int(time.time()), "role": role, "content": content}
-        with open(HISTORY_PATH, "a", encoding="utf-8") as f:
-            f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        if metrics:
+            rec["metrics"] = metrics
+        if role == "system" and content == NEW_CHAT_MARKER:
+            self.writer.append_history(rec)
+            return
+        # Сессия создаётся при первом сообщении, чтобы не плодить пустые
+        if tab.session_id is None:
+            tab.session_id = self.writer.new_session(tab.model)
+        self.writer.append_history(rec, tab.session_id, tab.model)
+
+    def on_write_failed(self, text: str):
+        self.statusBar().showMessage(f"❌ Фоновая запись: {text}", 15000)
+
+    # ====== Вкладки ======
+    @property
+    def tab(self) -> Optional[ChatTab]:
+        return self.tabs.currentWidget()
+
+    @property
+    def worker(self) -> Optional[ChatWorker]:
+        return self.tab.worker if self.tab is not None else None
+
+    @property
+    def session_id(self) -> Optional[int]:
+        return self.tab.session_id if self.tab is not None else None
+
+    @property
+    def history_model(self) -> ChatHistoryModel:
+        return self.tab.history_model
+
+    @property
+    def history(self) -> ChatView:
+        return self.tab.history
+
+    @property
+    def paint_counter(self) -> PaintCounter:
+        return self.tab.paint_counter
+
+    def all_tabs(self) -> List[ChatTab]:
+        return [self.tabs.widget(i) for i in range(self.tabs.count())]
+
+    def new_tab(self, activate: bool = True) -> ChatTab:
+        tab = ChatTab(self.state.model)
+        tab.history.reached_top.connect(partial(self.load_older_messages, tab))
+        index = self.tabs.addTab(tab, tab.title())
+        if activate:
+            self.tabs.setCurrentIndex(index)
+        return tab
+
+    def restore_tabs(self):
+        """Открывает разговоры из прошлого запуска, по вкладке на каждый."""
+        sessions = self.state.open_tabs
+        if not sessions:
+            last = self.store.last_session()
+            sessions = [last] if last is not None else []
+        for sid in sessions:
+            tab = self.new_tab(activate=False)
+            if not self.load_session(tab, sid):
+                self.tabs.removeTab(self.tabs.indexOf(tab))
+                tab.deleteLater()
+        if self.tabs.count() == 0:
+            self.new_tab()
+        self.tabs.setCurrentIndex(min(max(0, self.state.active_tab), self.tabs.count() - 1))
+        self.on_tab_changed(self.tabs.currentIndex())
+
+    def update_tab_title(self, tab: ChatTab):
+        index = self.tabs.indexOf(tab)
+        if index >= 0:
+            self.tabs.setTabText(index, tab.title())
+            self.tabs.setTabToolTip(index, tab.model)
+
+    def update_send_buttons(self):
+        busy = self.tab is not None and self.tab.busy
+        self.send_btn.setEnabled(not busy)
+        self.stop_btn.setEnabled(busy)
+
+    def on_tab_changed(self, _index: int):
+        """Открыли вкладку: дорисовываем накопленное и переключаем панели на неё."""
+        tab = self.tab
+        if tab is None:
+            return
+        tab.flush_pending()
+        tab.unread = False
+        self.update_tab_title(tab)
+        idx = self.model_box.findText(tab.model)
+        if idx >= 0:
+            self.model_box.setCurrentIndex(idx)
+        self.fill_suggestions(tab.suggestions)
+        self.update_send_buttons()
+        self.update_context_meter()
+        self.show_timing(tab)
+        # Счётчики стрима — по ответу этой вкладки
+        self.stream_label.clear()
+        if tab.busy and tab.worker.isRunning():
+            self.start_stream_stats()
+        else:
+            self.stream_timer.stop()
+
+    def close_tab(self, index: int):
+        tab = self.tabs.widget(index)
+        if tab is None:
+            return
+        tab.closed = True
+        self.tabs.removeTab(index)
+        if tab.busy:
+            # Виджет удалим, когда воркер действительно завершится
+            if not self.cancel_waiting(tab):
+                tab.worker.stop()
+        else:
+            tab.deleteLater()
+        if self.tabs.count() == 0:
+            self.new_tab()
+        self.save_state()
+
+    def cancel_waiting(self, tab: ChatTab) -> bool:
+        """Снимает ещё не запущенный ответ вкладки с очереди лимитера."""
+        worker = tab.worker
+        if worker is None or not self.limiter.cancel(worker):
+            return False
+        worker.deleteLater()
+        self.on_worker_finished(tab)
+        return True
+
+    def forget_session(self, session_id: int):
+        """Разговор удалён — закрываем показывающие его вкладки."""
+        for tab in self.all_tabs():
+            if tab.session_id == session_id:
+                self.close_tab(self.tabs.indexOf(tab))
+
+    def update_inflight_label(self):
+        active, waiting = self.limiter.active_count(), self.limiter.waiting_count()
+        text = f"🚦 {active}/{self.state.max_inflight}"
+        if waiting:
+            text += f", в очереди: {waiting}"
+        self.inflight_label.setText(text)
+
+    def ask_max_inflight(self):
+        value, ok = QtWidgets.QInputDialog.getInt(
+            self, "Одновременные запросы",
+            "Сколько ответов Ollama генерирует одновременно\n(все вкладки и сравнение моделей):",
+            self.state.max_inflight, 1, 16,
+        )
+        if ok:
+            self.limiter.set_limit(value)
+            self.save_state()
+
+    def open_session(self, session_id: int) -> bool:
+        """Показать сохранённый разговор (последнюю страницу) и продолжить его.
+
+        Уже открытый разговор просто выбирается; иначе он загружается в
+        текущую вкладку, если та пустая, или в новую.
+        """
+        for tab in self.all_tabs():
+            if tab.session_id == session_id:
+                self.tabs.setCurrentWidget(tab)
+                return True
+        tab = self.tab
+        if tab is None or tab.busy or tab.messages or tab.session_id is not None:
+            tab = self.new_tab(activate=False)
+        if not self.load_session(tab, session_id):
+            if not tab.messages and tab is not self.tab:
+                self.tabs.removeTab(self.tabs.indexOf(tab))
+                tab.deleteLater()
+            return False
+        self.tabs.setCurrentWidget(tab)
+        self.on_tab_changed(self.tabs.currentIndex())
+        return True
+
+    def load_session(self, tab: ChatTab, session_id: int) -> bool:
+        """Загружает последнюю страницу разговора во вкладку."""
+        if tab.busy:
+            self.statusBar().showMessage("⚠️ Дождитесь окончания ответа")
+            return False
+        self.writer.flush()
+        page = self.store.load_messages(session_id, HISTORY_PAGE_SIZE)
+        if not page:
+            return False
+        tab.session_id = session_id
+        tab.oldest_id = page[0]["id"]
+        tab.messages[:] = [
+            ChatMessage(role=m["role"], content=m["content"], id=m["id"])
+            for m in page if m["role"] in ("user", "assistant")
+        ]
+        tab.suggestions = []
+        tab.history_model.set_messages(tab.messages)
+        self.update_tab_title(tab)
+        return True
+
+    def load_older_messages(self, tab: Optional[ChatTab] = None):
+        """Прокрутили к началу — подгружаем предыдущую страницу из хранилища."""
+        tab = tab or self.tab
+        if tab.session_id is None or tab.oldest_id is None or tab.busy:
+            return
+        page = self.store.load_messages(tab.session_id, HISTORY_PAGE_SIZE, before_id=tab.oldest_id)
+        if not page:
+            tab.oldest_id = None
+            return
+        tab.oldest_id = page[0]["id"]
+        older = [
+            ChatMessage(role=m["role"], content=m["content"], id=m["id"])
+            for m in page if m["role"] in ("user", "assistant")
+        ]
+        tab.messages[:0] = older
+        tab.history.keep_position()
+        tab.history_model.prepend(older)
+
+    def jump_to_message(self, session_id: int, message_id: int):
+        """Открыть разговор и прокрутить к сообщению (подгружая страницы при необходимости)."""
+        if not self.open_session(session_id):
+            return
+        tab = self.tab
+        row = tab.history_model.row_of_message(message_id)
+        if row < 0 and not tab.busy:
+            # Сообщения текущего чата в модели ещё без id — перечитываем из хранилища
+            self.load_session(tab, session_id)
+            row = tab.history_model.row_of_message(message_id)
+        while row < 0 and tab.oldest_id is not None and message_id < tab.oldest_id:
+            self.load_older_messages(tab)
+            row = tab.history_model.row_of_message(message_id)
+        if row < 0:
+            self.statusBar().showMessage("⚠️ Сообщение не найдено в разговоре")
+            return
+        index = tab.history_model.index(row)
+        tab.history.setCurrentIndex(index)
+        tab.history.scrollTo(index, QtWidgets.QAbstractItemView.ScrollHint.PositionAtCenter)
+        if not self.isVisible():
+            self.toggle_visible()
+
+    def show_backends_panel(self):
+        if self.backends_panel is None:
+            self.backends_panel = BackendsPanel(self)
+        self.backends_panel.show()
+        self.backends_panel.raise_()
+        self.backends_panel.activateWindow()
+
+    def show_metrics_panel(self):
+        if self.metrics_panel is None:
+            self.metrics_panel = MetricsPanel(self)
+        self.metrics_panel.show()
+        self.metrics_panel.raise_()
+        self.metrics_panel.activateWindow()
+
+    def show_fanout_panel(self):
+        if self.fanout_panel is None:
+            self.fanout_panel = FanoutPanel(self)
+        self.fanout_panel.show()
+        self.fanout_panel.raise_()
+        self.fanout_panel.activateWindow()
+
+    def show_search_panel(self):
+        if self.search_panel is None:
+            self.search_panel = SearchPanel(self)
+        self.search_panel.show()
+        self.search_panel.raise_()
+        self.search_panel.activateWindow()
+        self.search_panel.query_edit.setFocus()
+
+    def show_session_browser(self):
+        if self.session_browser is None:
+            self.session_browser = SessionBrowser(self)
+        self.writer.flush()
+        self.session_browser.reload()
+        self.session_browser.show()
+        self.session_browser.raise_()
+        self.session_browser.activateWindow()
 
     def restore_history_to_view(self):
-        self.history.clear()
-        for m in self.state.messages:
-            self._append_bubble(m.role, m.content)
+        self.history_model.set_messages(self.tab.messages)
+
+    # ====== Контекст ======
+    def make_context_builder(self, model: Optional[str] = None) -> ContextBuilder:
+        meta = self.catalog.info(model or self.state.model)
+        return ContextBuilder(
+            budget=context_budget(meta, self.state.num_ctx),
+            policy=self.state.context_policy,
+            memory_tokens=self.state.memory_tokens,
+        )
+
+    def update_context_meter(self, *_):
+        """Сколько окна модели займёт следующий запрос (с учётом набираемого текста)."""
+        model = self.model_box.currentText() or self.state.model
+        messages = self.tab.messages if self.tab is not None else []
+        ctx = self.make_context_builder(model).build(
+            self.sys_prompt.toPlainText(), messages, self.input.toPlainText()
+        )
+        self.show_context_info(ctx.used_tokens, ctx.budget, ctx.dropped)
+
+    def show_context_info(self, used: int, budget: int, dropped: int, recalled: int = 0):
+        pct = min(100, used * 100 // max(1, budget))
+        text = f"🧠 Контекст: ~{used}/{budget} ({pct}%)"
+        if dropped:
+            text += f", вне окна: {dropped}"
+        if recalled:
+            text += f", из памяти: {recalled}"
+        self.context_label.setText(text)
+
+    def on_context_policy_toggled(self, checked: bool):
+        self.state.context_policy = "summarize" if checked else "drop"
+        self.save_state()
+        self.update_context_meter()
 
     # ====== UI helpers ======
-    def _append_bubble(self, role: str, text: str):
-        role_tag = {
-            "user": ("👤 Вы", "#e3f2fd", "#1565c0"),      # Голубой фон, синий текст
-            "assistant": ("🤖 Модель", "#f1f8e9", "#33691e"),  # Светло-зелёный фон, тёмно-зелёный текст
-            "system": ("⚙️ System", "#fff9c4", "#f57f17"),     # Жёлтый фон, оранжевый текст
-        }.get(role, (role, "#fff", "#000"))
-        who, bg, text_color = role_tag
-        cursor = self.history.textCursor()
-        cursor.movePosition(QtGui.QTextCursor.MoveOperation.End)
-        fmt = QtGui.QTextBlockFormat()
-        fmt.setLeftMargin(8)
-        fmt.setRightMargin(8)
-        fmt.setTopMargin(4)
-        fmt.setBottomMargin(4)
-        cursor.insertBlock(fmt)
-
-        # Заголовок (имя роли)
-        boxfmt = QtGui.QTextCharFormat()
-        boxfmt.setBackground(QtGui.QColor(bg))
-        boxfmt.setForeground(QtGui.QColor(text_color))
-        boxfmt.setFontWeight(QtGui.QFont.Weight.Bold)
-        cursor.insertText(f"{who}:\n", boxfmt)
-
-        # Текст сообщения
-        bodyfmt = QtGui.QTextCharFormat()
-        bodyfmt.setFontWeight(QtGui.QFont.Weight.Normal)
-        bodyfmt.setBackground(QtGui.QColor(bg))
-        bodyfmt.setForeground(QtGui.QColor("#212121"))  # Тёмно-серый текст для читаемости
-        cursor.insertText(text + "\n\n", bodyfmt)
-        self.history.ensureCursorVisible()
+    def _append_bubble(self, role: str, text: str, pending: bool = False):
+        self.history_model.append(role, text, pending)
 
     # ====== Модели ======
     def populate_models(self):
-        self.model_box.clear()
+        """Запускает фоновое обновление списка моделей (GUI не блокируется)."""
+        if self.models_loader and self.models_loader.isRunning():
+            return
+        self.refresh_models_btn.setEnabled(False)
         self.statusBar().showMessage("🔄 Загрузка моделей...")
-        try:
-            r = requests.get(f"{OLLAMA_URL}/api/tags", timeout=5)
-            r.raise_for_status()
-            data = r.json()
-            models = [m.get("name") for m in data.get("models", []) if m.get("name")]
-            if not models:
-                raise RuntimeError("models empty")
-            for name in models:
-                self.model_box.addItem(name)
-            # выбрать сохранённую
-            idx = self.model_box.findText(self.state.model)
-            if idx >= 0:
-                self.model_box.setCurrentIndex(idx)
-            else:
-                self.model_box.setCurrentIndex(0)
-                self.state.model = self.model_box.currentText()
-            self.statusBar().showMessage(f"✅ Загружено моделей: {len(models)}")
-        except Exception as e:
-            # Фоллбек: оставить текущую модель
-            self.model_box.addItem(self.state.model)
-            self.statusBar().showMessage(f"⚠️ Ошибка загрузки моделей: {e}")
+        self.models_loader = ModelsLoader(self.catalog, self)
+        self.models_loader.loaded.connect(self.on_models_loaded)
+        self.models_loader.failed.connect(self.on_models_failed)
+        self.models_loader.start()
+
+    def _fill_model_box(self, models: list):
+        # Сохраняем выбор пользователя, если он успел сменить модель
+        current = self.model_box.currentText() or (self.tab.model if self.tab else self.state.model)
+        self.model_box.blockSignals(True)
+        self.model_box.clear()
+        for name in models:
+            self.model_box.addItem(name)
+            meta = self.catalog.info(name)
+            if meta:
+                ctx = meta.get("num_ctx") or meta.get("context_length") or "?"
+                tip = f"Параметров: {meta.get('parameter_size') or '?'}, контекст: {ctx}"
+                if meta.get("quantization"):
+                    tip += f", {meta['quantization']}"
+                self.model_box.setItemData(self.model_box.count() - 1, tip, QtCore.Qt.ItemDataRole.ToolTipRole)
+        # выбрать сохранённую
+        idx = self.model_box.findText(current)
+        if idx >= 0:
+            self.model_box.setCurrentIndex(idx)
+        else:
+            self.model_box.setCurrentIndex(0)
+        self.model_box.blockSignals(False)
+        self.state.model = self.model_box.currentText()
+        if self.tab is not None:
+            self.tab.model = self.state.model
+            self.update_tab_title(self.tab)
+
+    def on_models_loaded(self, models: list):
+        self.refresh_models_btn.setEnabled(True)
+        if not models:
+            self.statusBar().showMessage("⚠️ Ошибка загрузки моделей: models empty")
+            return
+        self._fill_model_box(models)
+        self.statusBar().showMessage(f"✅ Загружено моделей: {len(models)}")
+
+    def on_model_selected(self, index: int):
+        """Пользователь выбрал модель — грузим её веса в фоне, пока он печатает."""
+        name = self.model_box.itemText(index)
+        if name and self.tab is not None and not self.tab.busy:
+            self.tab.model = name
+            self.update_tab_title(self.tab)
+        if not name or name in self._preloads:
+            return
+        call = BackgroundCall(preload_model, name, self.state.keep_alive, parent=self)
+        call.done.connect(lambda _: self.statusBar().showMessage(f"🧩 Модель {name} загружена в память"))
+        call.failed.connect(lambda err: self.statusBar().showMessage(f"⚠️ Не удалось загрузить {name}: {err}"))
+        call.finished.connect(lambda: self._preloads.pop(name, None))
+        self._preloads[name] = call
+        self.statusBar().showMessage(f"⏳ Загружаю модель {name}...")
+        call.start()
+
+    def show_residency_panel(self):
+        if self.residency_panel is None:
+            self.residency_panel = ResidencyPanel(self)
+        self.residency_panel.show()
+        self.residency_panel.raise_()
+        self.residency_panel.activateWindow()
+
+    def on_models_failed(self, err: str):
+        # Фоллбек: оставить список из кэша / текущую модель
+        self.refresh_models_btn.setEnabled(True)
+        self.statusBar().showMessage(f"⚠️ Ошибка загрузки моделей: {err}")
 
     # ====== Отправка ======
-    def on_send(self):
-        if self.worker and self.worker.isRunning():
+    def on_send(self, bypass_cache: bool = False):
+        tab = self.tab
+        if tab.busy:
             return
         prompt = self.input.toPlainText().strip()
         if not prompt:
             return
-        self.state.model = self.model_box.currentText()
+        tab.model = self.model_box.currentText()
+        self.input.clear()
+        self.submit(tab, prompt, bypass_cache)
+
+    def submit(self, tab: ChatTab, prompt: str, bypass_cache: bool = False) -> ChatWorker:
+        """Задаёт вопрос во вкладке tab её модели — из поля ввода или через локальный API."""
+        self.state.model = tab.model
         self.state.system_prompt = self.sys_prompt.toPlainText()
         self.save_state()
 
         # Очищаем список предложенных команд перед новым запросом
-        self.suggested_list.clear()
+        if tab is self.tab:
+            self.suggested_list.clear()
+        tab.suggestions = []
+        tab.cmd_extractor = CommandExtractor()
+        tab.failed = False
 
         # UI
-        self._append_bubble("user", prompt)
-        self.append_history_log("user", prompt)
-        self.input.clear()
+        tab.history_model.append("user", prompt)
+        self.append_history_log("user", prompt, tab)
+
+        # Плейсхолдер для потока (заменяется первой дельтой)
+        tab.history_model.append("assistant", "⏳ Думаю...", True)
+
+        # Запуск воркера: своя модель и история вкладки, общий предел запросов;
+        # память ищет по другим разговорам — текущий и так в контексте
+        memory = self.memory_index()
+        recall = None
+        if memory is not None:
+            recall = partial(memory.recall, k=self.state.memory_k, exclude_session=tab.session_id)
+        worker = ChatWorker(
+            replace(self.state, model=tab.model, messages=tab.messages),
+            prompt, self.make_context_builder(tab.model), self,
+            cache=self.response_cache(), digest=self.catalog.digest(tab.model),
+            bypass_cache=bypass_cache, recall=recall,
+        )
+        worker.context_info.connect(partial(self.on_context_info, tab))
+        worker.chunk.connect(partial(self.on_chunk, tab))
+        worker.started.connect(partial(self.on_worker_started, tab))
+        worker.started_reply.connect(partial(self.on_started_reply, tab))
+        worker.finished_ok.connect(partial(self.on_finished_ok, tab))
+        worker.failed.connect(partial(self.on_failed, tab))
+        worker.finished.connect(partial(self.on_worker_finished, tab))
+        tab.worker = worker
+        tab.running = True
+        self.update_send_buttons()
+        self.update_tab_title(tab)
+        if not self.limiter.start(worker):
+            self.statusBar().showMessage(
+                f"⏳ В очереди: одновременно идёт {self.limiter.active_count()} ответ(а)"
+            )
+        return worker
 
-        # Плейсхолдер для потока
-        self._append_bubble("assistant", "⏳ Думаю...")
+    def on_worker_started(self, tab: ChatTab):
+        if tab is self.tab:
+            self.start_stream_stats()
+            self.statusBar().showMessage("💭 Отправляю запрос...")
 
-        # Запуск воркера
-        self.worker = ChatWorker(self.state, prompt, self)
-        self.worker.chunk.connect(self.on_chunk)
-        self.worker.started_reply.connect(self.on_started_reply)
-        self.worker.finished_ok.connect(self.on_finished_ok)
-        self.worker.failed.connect(self.on_failed)
-        self.worker.start()
-        
-        self.statusBar().showMessage("💭 Отправляю запрос...")
+    def on_context_info(self, tab: ChatTab, used: int, budget: int, dropped: int, recalled: int):
+        if tab is self.tab:
+            self.show_context_info(used, budget, dropped, recalled)
 
-    def on_chunk(self, delta: str):
-        # добавляем текст к последнему блоку ассистента
-        cursor = self.history.textCursor()
-        cursor.movePosition(QtGui.QTextCursor.MoveOperation.End)
-        cursor.movePosition(QtGui.QTextCursor.MoveOperation.PreviousBlock)
-        # переходим на последний блок ("⏳ Думаю...") и заменяем, добавляя дельту
-        self.history.moveCursor(QtGui.QTextCursor.MoveOperation.End)
-        self.history.insertPlainText(delta)
-        self.history.ensureCursorVisible()
+    def on_chunk(self, tab: ChatTab, delta: str):
+        if tab.closed:
+            return
+        if tab is self.tab:
+            # добавляем текст к последнему сообщению ассистента
+            tab.history_model.append_to_last(delta)
+        else:
+            # фоновая вкладка не рисуется: копим до переключения на неё
+            tab.buffer(delta)
+            if not tab.unread:
+                tab.unread = True
+                self.update_tab_title(tab)
+        # и сразу показываем команды из строк, которые уже закончились
+        commands = tab.cmd_extractor.feed(delta)
+        if commands:
+            tab.suggestions.extend(commands)
+            if tab is self.tab:
+                self.add_suggestions(commands)
+
+    def _stream_rates(self, mark) -> tuple:
+        t0, deltas0, signals0, paints0 = mark
+        dt = max(1e-6, time.monotonic() - t0)
+        w = self.worker
+        return (
+            (w.delta_count - deltas0) / dt,
+            (w.signal_count - signals0) / dt,
+            (self.paint_counter.count - paints0) / dt,
+        )
 
-    def on_started_reply(self):
-        self.send_btn.setEnabled(False)
-        self.stop_btn.setEnabled(True)
-        self.statusBar().showMessage("🔄 Получаю ответ...")
+    def start_stream_stats(self):
+        w = self.worker
+        self._stream_mark = (time.monotonic(), w.delta_count, w.signal_count, self.paint_counter.count)
+        self._stream_start = self._stream_mark
+        self.stream_timer.start()
 
-    def on_finished_ok(self):
-        self.send_btn.setEnabled(True)
-        self.stop_btn.setEnabled(False)
-        self.statusBar().showMessage("✅ Готов к работе")
-        # Сохраним последнюю реплику ассистента в лог (из state)
-        if self.state.messages and self.state.messages[-1].role == "assistant":
-            self.append_history_log("assistant", self.state.messages[-1].content)
-            # После получения ответа попробуем извлечь команды и показать их
-            commands = self.parse_commands(self.state.messages[-1].content)
-            self.suggested_list.clear()
-            for cmd in commands:
-                item = QtWidgets.QListWidgetItem(cmd)
-                self.suggested_list.addItem(item)
+    def update_stream_stats(self):
+        """Раз в секунду: токены/с из сети, сигналы/с в GUI, перерисовки/с."""
+        if not self.worker:
+            return
+        tps, sps, pps = self._stream_rates(self._stream_mark)
+        self._stream_mark = (time.monotonic(), self.worker.delta_count,
+                             self.worker.signal_count, self.paint_counter.count)
+        self.stream_label.setText(f"📦 {tps:.0f} ток/с → {sps:.0f} сигн/с, {pps:.0f} перерис/с")
+
+    def stop_stream_stats(self):
+        self.stream_timer.stop()
+        if not self.worker or not hasattr(self, "_stream_start"):
+            return
+        # Итог по всему ответу
+        tps, sps, pps = self._stream_rates(self._stream_start)
+        self.stream_label.setText(
+            f"📦 {self.worker.delta_count} ток. ({tps:.0f}/с), "
+            f"сигналов {self.worker.signal_count} ({sps:.0f}/с), перерис. {pps:.0f}/с"
+        )
 
-    def on_failed(self, err: str):
-        self.send_btn.setEnabled(True)
-        self.stop_btn.setEnabled(False)
+    def on_started_reply(self, tab: ChatTab):
+        if tab is self.tab:
+            self.statusBar().showMessage("🔄 Получаю ответ...")
+
+    def on_finished_ok(self, tab: ChatTab):
+        if tab.closed:
+            return
+        # Сохраним последнюю реплику ассистента в лог (из истории вкладки)
+        cached = tab.worker.cached
+        if cached:
+            # Пометка только в окне: в истории остаётся сам ответ
+            note = "\n\n💾 ответ из кэша (🔁 Ctrl+Shift+Enter — спросить заново)"
+            if tab is self.tab:
+                tab.history_model.append_to_last(note)
+            else:
+                tab.buffer(note)
+        if tab.messages and tab.messages[-1].role == "assistant":
+            # Замеры ответа из кэша ничего не говорят о модели — не пишем их
+            self.append_history_log("assistant", tab.messages[-1].content, tab,
+                                    metrics=None if cached else tab.worker.timing.metrics())
+            # Команды из последней (незаконченной) строки ответа
+            tail = tab.cmd_extractor.finish()
+            tab.suggestions.extend(tail)
+            if tab is self.tab:
+                self.add_suggestions(tail)
+        if tab is self.tab:
+            self.statusBar().showMessage("✅ Готов к работе")
+            self.update_context_meter()
+        else:
+            self.statusBar().showMessage(f"✅ Ответ готов: {tab.label()}", 5000)
+
+    def on_worker_finished(self, tab: ChatTab):
+        tab.running = False
+        if tab.closed:
+            tab.deleteLater()
+            return
+        if tab is self.tab:
+            self.stop_stream_stats()
+            self.update_send_buttons()
+            self.show_timing(tab)
+        self.update_tab_title(tab)
+
+    def show_timing(self, tab: ChatTab):
+        """Замеры последнего ответа вкладки: TTFT, скорость, джиттер, счётчики Ollama."""
+        timing = tab.worker.timing if tab.worker is not None else None
+        if timing is None or timing.finished is None:
+            self.timing_label.clear()
+            return
+        if tab.worker.cached:
+            stats = self._response_cache.stats()
+            self.timing_label.setText(
+                f"💾 из кэша · попаданий {stats['hits']}/{stats['hits'] + stats['misses']}"
+                f" ({stats['hit_rate'] * 100:.0f}%)"
+            )
+            return
+        text = f"⏱️ {timing.summary()}"
+        final = timing.final or {}
+        if final.get("prompt_eval_count") and final.get("prompt_eval_duration"):
+            rate = final["prompt_eval_count"] / (final["prompt_eval_duration"] / 1e9)
+            text += f" · промпт {rate:.0f} ток/с"
+        if final.get("load_duration", 0) >= 1e8:
+            text += f" · загрузка {final['load_duration'] / 1e9:.1f} с"
+        if len(get_pool().backends) > 1 and tab.worker.backend_url:
+            text += f" · 🖧 {QtCore.QUrl(tab.worker.backend_url).host()}"
+        self.timing_label.setText(text)
+
+    def fill_suggestions(self, commands: list):
+        """Заменяет список предложенных команд."""
+        self.suggested_list.clear()
+        self.add_suggestions(commands)
+
+    def add_suggestions(self, commands: list):
+        """Дописывает команды в список; запрещённые помечаются сразу, пачкой."""
+        for cmd, rule in zip(commands, self.deny_matcher.check_many(commands)):
+            item = QtWidgets.QListWidgetItem(cmd)
+            if rule is not None:
+                item.setText(f"⛔ {cmd}")
+                item.setData(QtCore.Qt.ItemDataRole.UserRole, cmd)
+                item.setForeground(QtGui.QColor("#b71c1c"))
+                item.setToolTip(f"Запрещено правилом: {rule}")
+            self.suggested_list.addItem(item)
+
+    def on_failed(self, tab: ChatTab, err: str):
+        if tab.closed:
+            return
+        tab.failed = True
+        if tab is not self.tab:
+            # Фоновую вкладку не прерываем модальным окном
+            self.statusBar().showMessage(f"❌ Ошибка во вкладке «{tab.label()}»: {err}")
+            return
         self.statusBar().showMessage(f"❌ Ошибка: {err}")
         QtWidgets.QMessageBox.warning(self, "Ошибка", f"Не удалось получить ответ от Ollama:\n{err}")
 
     def on_stop(self):
-        if self.worker and self.worker.isRunning():
-            self.worker.stop()
-            self.statusBar().showMessage("⏹️ Остановлено")
+        self.stop_tab(self.tab)
+
+    def stop_tab(self, tab: ChatTab):
+        if not tab.busy:
+            return
+        if self.cancel_waiting(tab):
+            tab.history_model.append_to_last("⏹️ Отменено до начала ответа")
+        else:
+            tab.worker.stop()
+        self.statusBar().showMessage("⏹️ Остановлено")
 
     # ====== Трей/окно ======
     def closeEvent(self, e: QtGui.QCloseEvent):
@@ -580,17 +2635,45 @@ class MainWindow(QtWidgets.QMainWindow):
             self.activateWindow()
 
     def new_chat(self):
-        self.state.messages.clear()
-        self.history.clear()
+        tab = self.tab
+        if tab.busy:
+            # Идущий ответ не трогаем — новый чат открываем рядом
+            tab = self.new_tab()
+        tab.messages.clear()
+        tab.history_model.clear()
+        tab.session_id = None
+        tab.oldest_id = None
+        tab.suggestions = []
+        tab.failed = False
+        self.suggested_list.clear()
+        self.update_tab_title(tab)
+        self.update_context_meter()
         self.append_history_log("system", "--- new chat ---")
         self.statusBar().showMessage("🆕 Начат новый чат")
 
-    def on_tray_activated(self, reason: QtWidgets.QSystemTrayIcon.ActivationReason):
-        if reason in (QtWidgets.QSystemTrayIcon.ActivationReason.Trigger, 
-                      QtWidgets.QSystemTrayIcon.ActivationReason.DoubleClick):
-            self.toggle_visible()
-
     def on_quit(self):
+        self.job_queue.shutdown()
+        if self.fanout_panel is not None:
+            self.fanout_panel.shutdown()
+        for tab in self.all_tabs():
+            if tab.busy and not self.cancel_waiting(tab):
+                tab.worker.stop()
+        for tab in self.all_tabs():
+            if tab.worker is not None:
+                tab.worker.wait(2000)
+        for shell in self.shells.values():
+            shell.close()
+        self.save_state()
+        self.writer.close()
+        self.search_index.close()
+        if self._memory is not None:
+            self._memory.close()
+        self.store.close()
+        self.history_log.close()
+        if self._response_cache is not None:
+            self._response_cache.close()
+        get_pool().close()
+        get_client().close()
         QtWidgets.QApplication.quit()
 
     def show_about(self):
@@ -613,6 +2696,143 @@ class MainWindow(QtWidgets.QMainWindow):
             """
         )
 
+    def response_cache(self) -> Optional[ResponseCache]:
+        """Кэш ответов, если включён (база открывается при первом обращении)."""
+        if not self.state.response_cache:
+            return None
+        if self._response_cache is None:
+            self._response_cache = ResponseCache(
+                max_bytes=self.state.cache_max_mb * 1024 * 1024,
+                ttl=self.state.cache_ttl_hours * 3600,
+            )
+        return self._response_cache
+
+    def on_cache_toggled(self, checked: bool):
+        self.state.response_cache = checked
+        self.save_state()
+        self.statusBar().showMessage("💾 Кэш ответов включён" if checked else "💾 Кэш ответов выключен", 5000)
+
+    def show_cache_stats(self):
+        """Попадания/промахи и размер кэша ответов; здесь же очистка."""
+        cache = self._response_cache or ResponseCache(
+            max_bytes=self.state.cache_max_mb * 1024 * 1024, ttl=self.state.cache_ttl_hours * 3600
+        )
+        self._response_cache = cache
+        stats = cache.stats()
+        lines = [
+            f"Кэш: {'включён' if self.state.response_cache else 'выключен'}",
+            f"Записей: {stats['entries']}, {format_size(stats['bytes'])} из {self.state.cache_max_mb} МБ",
+            f"Срок жизни: {self.state.cache_ttl_hours:g} ч",
+            f"Попаданий: {stats['hits']}, промахов: {stats['misses']} ({stats['hit_rate'] * 100:.0f}%)",
+            f"Вытеснено за сеанс: {stats['evicted']}",
+        ]
+        box = QtWidgets.QMessageBox(self)
+        box.setWindowTitle("Кэш ответов")
+        box.setText("\n".join(lines))
+        clear_btn = box.addButton("🧹 Очистить", QtWidgets.QMessageBox.ButtonRole.DestructiveRole)
+        box.addButton(QtWidgets.QMessageBox.StandardButton.Close)
+        box.exec()
+        if box.clickedButton() is clear_btn:
+            cache.clear()
+            self.statusBar().showMessage("🧹 Кэш ответов очищен", 5000)
+
+    def memory_index(self) -> Optional[MemoryIndex]:
+        """Память прошлых разговоров, если включена: индекс открывается и
+        догоняет хранилище в фоновом потоке при первом обращении."""
+        if not self.state.memory_enabled or not memory_available():
+            return None
+        if self._memory is None:
+            self._memory = MemoryIndex(self.store, self.state.embed_model)
+            self._memory.start()
+            self.writer.memory = self._memory
+        return self._memory
+
+    def close_memory(self):
+        if self._memory is not None:
+            self.writer.memory = None
+            self._memory.close()
+            self._memory = None
+
+    def on_memory_toggled(self, checked: bool):
+        if checked and not memory_available():
+            QtWidgets.QMessageBox.warning(self, "Память", "Для памяти нужен numpy:\n  pacman -S python-numpy")
+            self.memory_action.setChecked(False)
+            return
+        self.state.memory_enabled = checked
+        self.save_state()
+        if checked:
+            self.memory_index()
+            self.statusBar().showMessage(
+                f"🧠 Память включена: прошлые ответы индексируются моделью {self.state.embed_model}", 5000)
+        else:
+            self.close_memory()
+            self.statusBar().showMessage("🧠 Память выключена", 5000)
+
+    def show_memory_stats(self):
+        """Состояние индекса памяти; здесь же смена модели эмбеддингов и перестройка."""
+        memory = self.memory_index()
+        lines = [f"Память: {'включена' if self.state.memory_enabled else 'выключена'}",
+                 f"Модель эмбеддингов: {self.state.embed_model}"]
+        if memory is not None:
+            st = memory.status()
+            lines += [
+                f"В индексе ответов: {st['count']} (размерность {st['dim'] or '—'}, {format_size(st['bytes'])})",
+                f"Ждут индексации: {st['pending']}" + (" — идёт" if st["indexing"] else ""),
+                f"Подмешивается: до {self.state.memory_k} фрагментов, до {self.state.memory_tokens} токенов",
+            ]
+            if st["error"]:
+                lines.append(f"❌ {st['error']}")
+        elif not memory_available():
+            lines.append("Нужен numpy: pacman -S python-numpy")
+        box = QtWidgets.QMessageBox(self)
+        box.setWindowTitle("Память прошлых разговоров")
+        box.setText("\n".join(lines))
+        model_btn = box.addButton("🔤 Модель...", QtWidgets.QMessageBox.ButtonRole.ActionRole)
+        rebuild_btn = None
+        if memory is not None:
+            rebuild_btn = box.addButton("🔄 Перестроить", QtWidgets.QMessageBox.ButtonRole.DestructiveRole)
+        box.addButton(QtWidgets.QMessageBox.StandardButton.Close)
+        box.exec()
+        if box.clickedButton() is model_btn:
+            self.ask_embed_model()
+        elif rebuild_btn is not None and box.clickedButton() is rebuild_btn:
+            memory.rebuild()
+            self.statusBar().showMessage("🔄 Память перестраивается в фоне", 5000)
+
+    def ask_embed_model(self):
+        names = self.catalog.names()
+        current = names.index(self.state.embed_model) if self.state.embed_model in names else -1
+        if current < 0:
+            names = [self.state.embed_model] + names
+            current = 0
+        model, ok = QtWidgets.QInputDialog.getItem(
+            self, "Модель эмбеддингов",
+            "Модель для поиска по прошлым разговорам\n(свой индекс у каждой модели; ollama pull nomic-embed-text):",
+            names, current, True,
+        )
+        model = model.strip()
+        if not ok or not model or model == self.state.embed_model:
+            return
+        self.close_memory()
+        self.state.embed_model = model
+        self.save_state()
+        self.memory_index()
+        self.statusBar().showMessage(f"🧠 Модель эмбеддингов: {model}", 5000)
+
+    def show_connection_stats(self):
+        """Счётчики новых/переиспользованных соединений по эндпоинтам"""
+        client = get_client()
+        stats = client.stats.snapshot()
+        lines = [f"Сервер: {client.base_url}", ""]
+        if not stats:
+            lines.append("Запросов пока не было")
+        for endpoint, rec in sorted(stats.items()):
+            lines.append(
+                f"{endpoint}: запросов {rec['requests']}, "
+                f"новых соединений {rec['new']}, keep-alive {rec['reused']}"
+            )
+        QtWidgets.QMessageBox.information(self, "Соединения с Ollama", "\n".join(lines))
+
     def show_security_settings(self):
         """Диалог настройки безопасности команд"""
         dlg = QtWidgets.QDialog(self)
@@ -686,7 +2906,17 @@ class MainWindow(QtWidgets.QMainWindow):
         )
         deny_hint.setWordWrap(True)
         deny_layout.addWidget(deny_hint)
-        
+
+        # Какие правила реально срабатывали за этот сеанс
+        deny_stats = self.deny_matcher.stats()
+        if deny_stats:
+            stats_label = QtWidgets.QLabel(
+                "📊 Срабатывания за сеанс: "
+                + ", ".join(f"<code>{html.escape(pat)}</code> × {n}" for pat, n in deny_stats[:5])
+            )
+            stats_label.setWordWrap(True)
+            deny_layout.addWidget(stats_label)
+
         tabs.addTab(deny_tab, "❌ Чёрный список")
         
         # === Вкладка 3: Справка ===
@@ -784,14 +3014,9 @@ class MainWindow(QtWidgets.QMainWindow):
         deny_text = self.deny_edit.toPlainText()
         deny_pats = [line.strip() for line in deny_text.splitlines() if line.strip()]
         
-        # Проверяем regex на валидность
-        import re
-        invalid_patterns = []
-        for pat in deny_pats:
-            try:
-                re.compile(pat)
-            except re.error:
-                invalid_patterns.append(pat)
+        # Компилируем сразу: тот же результат и проверяет regex, и идёт в работу
+        matcher = DenyMatcher(deny_pats)
+        invalid_patterns = matcher.invalid
         
         if invalid_patterns:
             QtWidgets.QMessageBox.critical(
@@ -804,6 +3029,7 @@ class MainWindow(QtWidgets.QMainWindow):
         # Сохраняем
         self.state.safe_sudo_commands = sudo_cmds
         self.state.deny_patterns = deny_pats
+        self.deny_matcher = matcher
         self.save_state()
         
         QtWidgets.QMessageBox.information(
@@ -823,71 +3049,23 @@ class MainWindow(QtWidgets.QMainWindow):
         - Блоки ```bash```, ```sh```, ```fish```, или просто ```
         - Команды в обратных кавычках `команда`
         - Строки, начинающиеся с `$ `, `> `, `sudo `
-        Возвращает список строк (команд).
+        Возвращает список строк (команд) в порядке появления.
+        Во время стрима то же делает CommandExtractor, по дельтам.
         """
-        cmds = []
-        if not text:
-            return cmds
-
-        import re
-
-        # 1) Блоки кода ```bash```, ```sh```, ```fish```, или просто ```
-        code_blocks = re.findall(r"```(?:bash|sh|fish)?\s*\n(.*?)```", text, flags=re.S | re.I)
-        for block in code_blocks:
-            for line in block.splitlines():
-                line = line.strip()
-                if not line or line.startswith("#"):
-                    continue
-                # убираем префиксы $ и >
-                if line.startswith("$ "):
-                    line = line[2:].strip()
-                elif line.startswith("> "):
-                    line = line[2:].strip()
-                if line:
-                    cmds.append(line)
-
-        # 2) Команды в обратных кавычках `команда`
-        inline_cmds = re.findall(r"`([^`\n]+)`", text)
-        for cmd in inline_cmds:
-            cmd = cmd.strip()
-            # проверяем, что это похоже на команду (начинается с буквы/цифры)
-            parts = cmd.split()
-            if parts and re.match(r"^[a-z0-9_\-./]+$", parts[0], flags=re.I):
-                if cmd not in cmds and len(cmd) < 200:  # фильтр слишком длинных строк
-                    cmds.append(cmd)
-
-        # 3) Строки, начинающиеся с $ или > или sudo
-        for line in text.splitlines():
-            s = line.strip()
-            if not s:
-                continue
-            if s.startswith("$ "):
-                candidate = s[2:].strip()
-                if candidate and candidate not in cmds:
-                    cmds.append(candidate)
-            elif s.startswith("> "):
-                candidate = s[2:].strip()
-                if candidate and candidate not in cmds:
-                    cmds.append(candidate)
-            elif s.startswith("sudo ") and s not in cmds:
-                cmds.append(s)
-
-        # Убираем дубликаты, сохраняем порядок
-        seen = set()
-        out = []
-        for c in cmds:
-            if c not in seen:
-                seen.add(c)
-                out.append(c)
-        return out
+        return parse_commands(text)
 
     # ====== Обработчики команд ======
+    @staticmethod
+    def _suggestion_text(item: QtWidgets.QListWidgetItem) -> str:
+        """Исходная команда (у запрещённых в тексте элемента есть пометка ⛔)."""
+        return item.data(QtCore.Qt.ItemDataRole.UserRole) or item.text()
+
     def on_suggest_preview(self):
         item = self.suggested_list.currentItem()
         if not item:
             QtWidgets.QMessageBox.information(self, "Просмотр", "Выберите команду в списке")
             return
-        cmd = item.text()
+        cmd = self._suggestion_text(item)
         QtWidgets.QMessageBox.information(self, "Просмотр команды", f"Команда:\n{cmd}")
 
     def on_suggest_reject(self):
@@ -902,7 +3080,7 @@ class MainWindow(QtWidgets.QMainWindow):
         if not item:
             QtWidgets.QMessageBox.information(self, "Одобрение", "Выберите команду для одобрения")
             return
-        cmd = item.text()
+        cmd = self._suggestion_text(item)
         # показать подтверждение
         resp = QtWidgets.QMessageBox.question(
             self,
@@ -914,82 +3092,92 @@ class MainWindow(QtWidgets.QMainWindow):
             # Проверим разрешение команды (allowlist)
             allowed = self.is_command_allowed(cmd)
             if not allowed:
-                QtWidgets.QMessageBox.critical(self, "Запрещено", "Эта команда не разрешена к автоматическому выполнению")
+                rule = self.deny_matcher.patterns[self._last_deny] if self._last_deny is not None else None
+                reason = f"\n\nСработало правило: {rule}" if rule else ""
+                QtWidgets.QMessageBox.critical(self, "Запрещено", f"Эта команда не разрешена к автоматическому выполнению{reason}")
                 return
 
-            # Создадим диалог для вывода логов выполнения
-            dlg = QtWidgets.QDialog(self)
-            dlg.setWindowTitle(f"Выполнение: {cmd}")
-            dlg.resize(700, 400)
-            lay = QtWidgets.QVBoxLayout(dlg)
-            out_view = QtWidgets.QTextEdit(readOnly=True)
-            out_view.setStyleSheet("background:#111; color:#cfc; font-family: monospace;")
-            lay.addWidget(out_view)
-            btns = QtWidgets.QHBoxLayout()
-            stop_btn = QtWidgets.QPushButton("Остановить")
-            close_btn = QtWidgets.QPushButton("Закрыть")
-            close_btn.setEnabled(False)
-            btns.addWidget(stop_btn)
-            btns.addStretch(1)
-            btns.addWidget(close_btn)
-            lay.addLayout(btns)
-
-            # запустим CommandRunner
-            runner = CommandRunner(cmd, parent=self)
-
-            def on_stdout(line):
-                out_view.append(f"[out] {line}")
-
-            def on_stderr(line):
-                out_view.append(f"[err] {line}")
-
-            def on_failed(err):
-                out_view.append(f"[failed] {err}")
-                close_btn.setEnabled(True)
-
-            def on_finished(rc):
-                out_view.append(f"[finished] returncode={rc}")
-                close_btn.setEnabled(True)
-
-            runner.line_stdout.connect(on_stdout)
-            runner.line_stderr.connect(on_stderr)
-            runner.failed.connect(on_failed)
-            runner.finished.connect(on_finished)
-
-            def on_stop_clicked():
-                runner.stop()
-                stop_btn.setEnabled(False)
-
-            def on_close_clicked():
-                dlg.accept()
-
-            stop_btn.clicked.connect(on_stop_clicked)
-            close_btn.clicked.connect(on_close_clicked)
-
-            runner.start()
-            dlg.exec()
+            self.run_commands([cmd])
 
+    def on_suggest_accept_all(self):
+        """Одобрить пакетом все разрешённые команды из списка."""
+        commands = [self._suggestion_text(self.suggested_list.item(i)) for i in range(self.suggested_list.count())]
+        allowed = [cmd for cmd in commands if self.is_command_allowed(cmd)]
+        if not allowed:
+            QtWidgets.QMessageBox.information(self, "Одобрение", "Нет разрешённых команд для выполнения")
+            return
+        blocked = len(commands) - len(allowed)
+        note = f"\n\n⛔ Пропущено запрещённых: {blocked}" if blocked else ""
+        resp = QtWidgets.QMessageBox.question(
+            self,
+            "Подтвердите выполнение",
+            f"Выполнить {len(allowed)} команд ({JOB_MODES[self.state.job_mode].lower()})?\n\n"
+            + "\n".join(allowed) + note,
+            QtWidgets.QMessageBox.StandardButton.Yes | QtWidgets.QMessageBox.StandardButton.No,
+        )
+        if resp == QtWidgets.QMessageBox.StandardButton.Yes:
+            self.run_commands(allowed, self.state.job_mode)
+
+    def run_commands(self, commands: list, mode: str = "parallel"):
+        """Ставит одобренные команды в очередь и показывает панель задач."""
+        self.job_queue.submit(commands, mode)
+        self.show_job_panel()
+
+    def show_job_panel(self):
+        if self.job_panel is None:
+            self.job_panel = JobPanel(self, self.job_queue)
+        self.job_panel.show()
+        self.job_panel.raise_()
+        self.job_panel.activateWindow()
+
+    def current_shell(self) -> Optional[ShellSession]:
+        """Shell текущего разговора, если включён общий shell."""
+        if self.state.exec_backend != "shell":
+            return None
+        shell = self.shells.get(self.session_id)
+        if shell is None:
+            shell = ShellSession()
+            self.shells[self.session_id] = shell
+            while len(self.shells) > SHELL_SESSIONS_MAX:
+                _, old = self.shells.popitem(last=False)
+                self._close_shell(old)
+        self.shells.move_to_end(self.session_id)
+        return shell
+
+    @staticmethod
+    def _close_shell(shell: ShellSession):
+        # close() ждёт текущую команду — не в GUI‑потоке
+        shell.interrupt()
+        threading.Thread(target=shell.close, daemon=True).start()
+
+    def restart_shell(self):
+        """Бросает shell текущего разговора; следующая команда поднимет новый."""
+        shell = self.shells.pop(self.session_id, None)
+        if shell is not None:
+            self._close_shell(shell)
+        self.statusBar().showMessage("🔄 Shell будет перезапущен при следующей команде", 5000)
+
+    def on_job_finished(self, job: Job):
+        status = JOB_STATUS_LABELS.get(job.status, job.status)
+        code = f" (код {job.returncode})" if job.returncode is not None else ""
+        self.statusBar().showMessage(f"{status}: {job.command}{code}", 5000)
+        if job.status in ("done", "failed"):
             # логируем в историю (команду НЕ удаляем из списка)
-            self.append_history_log("system", f"Выполнена команда: {cmd}")
+            self.append_history_log("system", f"Выполнена команда: {job.command}")
 
     def is_command_allowed(self, cmd: str) -> bool:
         """Проверка команд через чёрный список (blacklist).
         Разрешены ВСЕ команды, кроме явно опасных.
         Блокируются только деструктивные операции и потенциально опасные паттерны.
         """
-        import re
-
+        self._last_deny = None
         if not cmd or not cmd.strip():
             return False
 
-        # Используем паттерны из настроек
-        for pattern in self.state.deny_patterns:
-            try:
-                if re.search(pattern, cmd, flags=re.I):
-                    return False
-            except re.error:
-                # Если regex невалиден - пропускаем
-                continue
+        # Паттерны из настроек, заранее скомпилированные (невалидные пропущены)
+        self._last_deny = self.deny_matcher.match(cmd)
+        if self._last_deny is not None:
+            return False
         
         # Дополнительная проверка: запрещаем sudo с опасными командами
         if cmd.strip().startswith("sudo"):
@@ -1009,20 +3197,49 @@ class MainWindow(QtWidgets.QMainWindow):
 
 class CommandRunner(QtCore.QThread):
     """Выполняет одну команду в отдельном потоке, стримит stdout/stderr.
+
+    Один поток читает оба канала через selectors сырыми байтами и
+    складывает строки в OutputRing (ограничен runner_max_lines). В GUI
+    уходит не каждая строка, а уведомление output_ready не чаще раза в
+    flush_ms; окно забирает всё накопленное через take_batch().
+    С shell (ShellSession) команда уходит в общий shell сессии, а не в
+    новый процесс; timeout действует только там. stop() до захвата shell
+    отменяет запуск, а Ctrl+C шлёт, только если в shell идёт эта команда.
     Сигналы:
-      line_stdout(str), line_stderr(str), finished(int returncode), failed(str error)
+      output_ready(), finished(int returncode), failed(str error)
     """
-    line_stdout = QtCore.pyqtSignal(str)
-    line_stderr = QtCore.pyqtSignal(str)
+    output_ready = QtCore.pyqtSignal()
     finished = QtCore.pyqtSignal(int)
     failed = QtCore.pyqtSignal(str)
 
-    def __init__(self, command: str, parent=None):
+    def __init__(self, command: str, max_lines: int = 5000, flush_ms: int = 100,
+                 shell: Optional[ShellSession] = None, timeout: Optional[float] = None, parent=None):
         super().__init__(parent)
         self.command = command
+        self.shell = shell
+        self.timeout = timeout
+        self.output = OutputRing(max_lines)
+        self.flush_interval = max(1, flush_ms) / 1000
         self._proc = None
+        self._cancelled = False
+        # Уведомление отправлено, а окно ещё не забрало пачку
+        self._notified = False
+
+    def take_batch(self) -> list:
+        """Вызывается из GUI: все строки, накопленные с прошлого раза."""
+        self._notified = False
+        return self.output.take()
+
+    def _notify(self):
+        if not self._notified and self.output.pending():
+            self._notified = True
+            self.output_ready.emit()
 
     def run(self):
+        if self.shell is not None:
+            self.run_in_shell()
+            return
+        import selectors
         import shlex
         import subprocess
 
@@ -1033,33 +3250,61 @@ class CommandRunner(QtCore.QThread):
                 args,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE,
-                text=True,
-                bufsize=1,
+                bufsize=0,
             )
 
-            # читаем stdout и stderr по строкам
-            assert self._proc.stdout is not None
-            assert self._proc.stderr is not None
-            from threading import Thread
-
-            def read_stream(stream, emitter):
-                for ln in iter(stream.readline, ""):
-                    emitter.emit(ln.rstrip('\n'))
-                stream.close()
-
-            t1 = Thread(target=read_stream, args=(self._proc.stdout, self.line_stdout))
-            t2 = Thread(target=read_stream, args=(self._proc.stderr, self.line_stderr))
-            t1.start()
-            t2.start()
-            t1.join()
-            t2.join()
+            # читаем stdout и stderr одним потоком, кусками байт
+            sel = selectors.DefaultSelector()
+            sel.register(self._proc.stdout, selectors.EVENT_READ, "out")
+            sel.register(self._proc.stderr, selectors.EVENT_READ, "err")
+            last_flush = time.monotonic()
+            while sel.get_map():
+                for key, _ in sel.select(timeout=self.flush_interval):
+                    data = os.read(key.fd, 65536)
+                    if data:
+                        self.output.feed(key.data, data)
+                    else:
+                        sel.unregister(key.fileobj)
+                        key.fileobj.close()
+                now = time.monotonic()
+                if now - last_flush >= self.flush_interval:
+                    self._notify()
+                    last_flush = now
+            sel.close()
+            self.output.close()
 
             rc = self._proc.wait()
+            self._notify()
             self.finished.emit(rc)
         except Exception as e:
             self.failed.emit(str(e))
 
+    def run_in_shell(self):
+        def on_data(data: bytes):
+            self.output.feed("out", data)
+            # Пока окно не забрало прошлую пачку, новых уведомлений не будет
+            self._notify()
+
+        try:
+            rc = self.shell.run(self.command, on_data, self.timeout, owner=self,
+                                cancelled=lambda: self._cancelled)
+        except ShellTimeout as e:
+            self.output.close()
+            self._notify()
+            self.failed.emit(str(e))
+            return
+        except Exception as e:
+            self.failed.emit(str(e))
+            return
+        self.output.close()
+        self._notify()
+        self.finished.emit(rc)
+
     def stop(self):
+        self._cancelled = True
+        if self.shell is not None:
+            self.shell.interrupt(owner=self)
+            return
         if self._proc and self._proc.poll() is None:
             try:
                 self._proc.terminate()
@@ -1067,32 +3312,405 @@ class CommandRunner(QtCore.QThread):
                 pass
 
 
-def main():
-    import argparse
-    parser = argparse.ArgumentParser(description=f"{APP_NAME} v{APP_VERSION}")
-    parser.add_argument("--minimize", action="store_true", help="Старт свернутым в трей")
-    parser.add_argument("--version", action="version", version=f"{APP_NAME} {APP_VERSION}")
-    args = parser.parse_args()
+@dataclass
+class Job:
+    """Одобренная команда в очереди выполнения."""
+    id: int
+    command: str
+    after: Optional["Job"] = None  # ждать завершения этой задачи
+    need_success: bool = False  # ...и только если она завершилась с кодом 0
+    status: str = "queued"
+    started: float = 0.0
+    ended: float = 0.0
+    returncode: Optional[int] = None
+    error: str = ""
+    cancel_requested: bool = False
+    runner: Optional["CommandRunner"] = None
+    shell: Optional[ShellSession] = None  # общий shell сессии или None — отдельный процесс
+    doc: Optional[QtGui.QTextDocument] = None  # вывод задачи, ограничен runner_max_lines
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "failed", "cancelled", "skipped")
+
+    def duration(self) -> float:
+        if not self.started:
+            return 0.0
+        return (self.ended or time.monotonic()) - self.started
+
+
+class JobQueue(QtCore.QObject):
+    """Очередь одобренных команд: не больше job_concurrency одновременно.
+
+    Пакет команд можно запустить параллельно, по очереди (каждая ждёт
+    предыдущую) или цепочкой (после ошибки остальные пропускаются).
+    Общий shell выполняет одну команду за раз, поэтому задачи одного
+    shell стартуют по очереди и в «параллельном» режиме.
+    """
+    changed = QtCore.pyqtSignal(int)  # id задачи, у которой сменилось состояние
+    jobs_added = QtCore.pyqtSignal()
+    job_finished = QtCore.pyqtSignal(object)  # Job
+
+    def __init__(self, state: ChatState, parent=None):
+        super().__init__(parent)
+        self.state = state
+        self.jobs: List[Job] = []
+        self._next_id = 1
+        # Откуда брать shell для новых задач (None — запускать отдельным процессом)
+        self.shell_provider: Callable[[], Optional[ShellSession]] = lambda: None
+
+    def running_count(self) -> int:
+        return sum(1 for j in self.jobs if j.status == "running")
+
+    def set_limit(self, limit: int):
+        self.state.job_concurrency = max(1, limit)
+        self._pump()
+
+    def submit(self, commands: List[str], mode: str = "parallel") -> List[Job]:
+        added: List[Job] = []
+        prev: Optional[Job] = None
+        shell = self.shell_provider()
+        for cmd in commands:
+            job = Job(self._next_id, cmd, shell=shell)
+            self._next_id += 1
+            if mode in ("sequential", "chain") and prev is not None:
+                job.after = prev
+                job.need_success = mode == "chain"
+            doc = QtGui.QTextDocument(self)
+            doc.setDocumentLayout(QtWidgets.QPlainTextDocumentLayout(doc))
+            doc.setMaximumBlockCount(self.state.runner_max_lines)
+            job.doc = doc
+            self.jobs.append(job)
+            added.append(job)
+            prev = job
+        self.jobs_added.emit()
+        self._pump()
+        return added
+
+    def _set_status(self, job: Job, status: str):
+        job.status = status
+        self.changed.emit(job.id)
+        if job.finished:
+            self.job_finished.emit(job)
+
+    def _pump(self):
+        """Запускает готовые задачи, пока есть свободные слоты."""
+        progress = True
+        while progress:
+            progress = False
+            for job in self.jobs:
+                if job.status != "queued":
+                    continue
+                dep = job.after
+                if dep is not None and not dep.finished:
+                    continue
+                if dep is not None and job.need_success and dep.status != "done":
+                    job.ended = time.monotonic()
+                    self._set_status(job, "skipped")
+                    progress = True
+                    continue
+                if self.running_count() >= max(1, self.state.job_concurrency):
+                    return
+                if job.shell is not None and any(
+                        j.status == "running" and j.shell is job.shell for j in self.jobs):
+                    continue
+                self._start(job)
+                progress = True
+
+    def _start(self, job: Job):
+        runner = CommandRunner(job.command, self.state.runner_max_lines, self.state.runner_flush_ms,
+                               shell=job.shell, timeout=self.state.shell_timeout, parent=self)
+        job.runner = runner
+        job.started = time.monotonic()
+        runner.output_ready.connect(lambda: self._on_output(job))
+        runner.finished.connect(lambda rc: self._on_finished(job, rc))
+        runner.failed.connect(lambda err: self._on_failed(job, err))
+        self._set_status(job, "running")
+        runner.start()
+
+    def _on_output(self, job: Job):
+        batch = job.runner.take_batch() if job.runner else []
+        if not batch:
+            return
+        cursor = QtGui.QTextCursor(job.doc)
+        cursor.movePosition(QtGui.QTextCursor.MoveOperation.End)
+        text = "\n".join(f"[{stream}] {line}" for stream, line in batch)
+        cursor.insertText(text if job.doc.isEmpty() else "\n" + text)
+
+    def _on_finished(self, job: Job, rc: int):
+        self._on_output(job)
+        job.returncode = rc
+        job.ended = time.monotonic()
+        if job.cancel_requested:
+            status = "cancelled"
+        else:
+            status = "done" if rc == 0 else "failed"
+        self._set_status(job, status)
+        self._pump()
+
+    def _on_failed(self, job: Job, err: str):
+        job.error = err
+        job.ended = time.monotonic()
+        self._set_status(job, "cancelled" if job.cancel_requested else "failed")
+        self._pump()
+
+    def cancel(self, job: Job):
+        if job.status == "queued":
+            job.ended = time.monotonic()
+            self._set_status(job, "cancelled")
+            self._pump()
+        elif job.status == "running" and job.runner:
+            job.cancel_requested = True
+            job.runner.stop()
+
+    def cancel_all(self):
+        # Сначала снимаем ожидающие, чтобы освободившиеся слоты их не подхватили
+        for job in self.jobs:
+            if job.status == "queued":
+                job.ended = time.monotonic()
+                self._set_status(job, "cancelled")
+        for job in self.jobs:
+            if job.status == "running":
+                self.cancel(job)
+
+    def clear_finished(self):
+        for job in [j for j in self.jobs if j.finished]:
+            if job.runner:
+                job.runner.wait(1000)
+                job.runner.deleteLater()
+            if job.doc is not None:
+                job.doc.deleteLater()
+            self.jobs.remove(job)
+        self.jobs_added.emit()
+
+    def shutdown(self, timeout_ms: int = 2000):
+        self.cancel_all()
+        for job in self.jobs:
+            if job.runner and job.runner.isRunning():
+                job.runner.wait(timeout_ms)
+
+
+class JobPanel(QtWidgets.QDialog):
+    """Немодальная панель очереди команд: статус, время, код, вывод выбранной."""
+
+    def __init__(self, main: "MainWindow", queue: JobQueue):
+        super().__init__(main)
+        self.main = main
+        self.queue = queue
+        self.setWindowTitle("🧰 Выполнение команд")
+        self.resize(760, 520)
+
+        lay = QtWidgets.QVBoxLayout(self)
+        top = QtWidgets.QHBoxLayout()
+        top.addWidget(QtWidgets.QLabel("Одновременно:"))
+        self.limit_spin = QtWidgets.QSpinBox()
+        self.limit_spin.setRange(1, 16)
+        self.limit_spin.setValue(main.state.job_concurrency)
+        self.limit_spin.valueChanged.connect(self.on_limit_changed)
+        top.addWidget(self.limit_spin)
+        top.addSpacing(12)
+        top.addWidget(QtWidgets.QLabel("Пакет:"))
+        self.mode_box = QtWidgets.QComboBox()
+        for key, label in JOB_MODES.items():
+            self.mode_box.addItem(label, key)
+        self.mode_box.setCurrentIndex(max(0, self.mode_box.findData(main.state.job_mode)))
+        self.mode_box.currentIndexChanged.connect(self.on_mode_changed)
+        top.addWidget(self.mode_box)
+        top.addSpacing(12)
+        top.addWidget(QtWidgets.QLabel("Запуск:"))
+        self.backend_box = QtWidgets.QComboBox()
+        for key, label in EXEC_BACKENDS.items():
+            self.backend_box.addItem(label, key)
+        self.backend_box.setCurrentIndex(max(0, self.backend_box.findData(main.state.exec_backend)))
+        self.backend_box.setToolTip(
+            "Общий shell: один bash на разговор, cd и переменные сохраняются между командами;\n"
+            "команды одного shell выполняются по одной"
+        )
+        self.backend_box.currentIndexChanged.connect(self.on_backend_changed)
+        top.addWidget(self.backend_box)
+        restart_btn = QtWidgets.QPushButton("🔄 Перезапустить shell")
+        restart_btn.clicked.connect(main.restart_shell)
+        top.addWidget(restart_btn)
+        top.addStretch(1)
+        lay.addLayout(top)
+
+        self.table = QtWidgets.QTableWidget(0, 5)
+        self.table.setHorizontalHeaderLabels(["#", "Команда", "Статус", "Время", "Код"])
+        self.table.horizontalHeader().setSectionResizeMode(1, QtWidgets.QHeaderView.ResizeMode.Stretch)
+        self.table.verticalHeader().setVisible(False)
+        self.table.setSelectionBehavior(QtWidgets.QAbstractItemView.SelectionBehavior.SelectRows)
+        self.table.setSelectionMode(QtWidgets.QAbstractItemView.SelectionMode.SingleSelection)
+        self.table.setEditTriggers(QtWidgets.QAbstractItemView.EditTrigger.NoEditTriggers)
+        self.table.itemSelectionChanged.connect(self.on_selection_changed)
+        lay.addWidget(self.table, 1)
+
+        self.out_view = QtWidgets.QPlainTextEdit(readOnly=True)
+        self.out_view.setStyleSheet("background:#111; color:#cfc; font-family: monospace;")
+        lay.addWidget(self.out_view, 2)
+
+        btns = QtWidgets.QHBoxLayout()
+        cancel_btn = QtWidgets.QPushButton("⛔ Отменить")
+        cancel_all_btn = QtWidgets.QPushButton("⛔ Отменить все")
+        clear_btn = QtWidgets.QPushButton("🧹 Убрать завершённые")
+        cancel_btn.clicked.connect(self.on_cancel)
+        cancel_all_btn.clicked.connect(self.queue.cancel_all)
+        clear_btn.clicked.connect(self.queue.clear_finished)
+        btns.addWidget(cancel_btn)
+        btns.addWidget(cancel_all_btn)
+        btns.addStretch(1)
+        btns.addWidget(clear_btn)
+        lay.addLayout(btns)
+
+        self.queue.changed.connect(self.update_job)
+        self.queue.jobs_added.connect(self.rebuild)
+        # Пока что-то выполняется, обновляем столбец «Время»
+        self.timer = QtCore.QTimer(self)
+        self.timer.setInterval(500)
+        self.timer.timeout.connect(self.tick)
+        self.rebuild()
+
+    def _row_of(self, job_id: int) -> int:
+        for row, job in enumerate(self.queue.jobs):
+            if job.id == job_id:
+                return row
+        return -1
+
+    def _selected_job(self) -> Optional[Job]:
+        row = self.table.currentRow()
+        return self.queue.jobs[row] if 0 <= row < len(self.queue.jobs) else None
+
+    def _fill_row(self, row: int, job: Job):
+        status = JOB_STATUS_LABELS.get(job.status, job.status)
+        if job.error:
+            status += f": {job.error}"
+        duration = f"{job.duration():.1f} с" if job.started else ""
+        code = "" if job.returncode is None else str(job.returncode)
+        for col, text in enumerate((str(job.id), job.command, status, duration, code)):
+            item = self.table.item(row, col)
+            if item is None:
+                item = QtWidgets.QTableWidgetItem()
+                self.table.setItem(row, col, item)
+            item.setText(text)
+        self.table.item(row, 1).setToolTip(job.command)
+
+    def rebuild(self):
+        selected = self._selected_job()
+        self.table.setRowCount(len(self.queue.jobs))
+        for row, job in enumerate(self.queue.jobs):
+            self._fill_row(row, job)
+        if selected in self.queue.jobs:
+            self.table.selectRow(self.queue.jobs.index(selected))
+        elif self.queue.jobs:
+            self.table.selectRow(len(self.queue.jobs) - 1)
+        else:
+            empty = QtGui.QTextDocument(self.out_view)
+            empty.setDocumentLayout(QtWidgets.QPlainTextDocumentLayout(empty))
+            self.out_view.setDocument(empty)
+        self.tick()
+
+    def update_job(self, job_id: int):
+        row = self._row_of(job_id)
+        if row >= 0:
+            self._fill_row(row, self.queue.jobs[row])
+        if self.queue.running_count() and not self.timer.isActive():
+            self.timer.start()
+
+    def tick(self):
+        running = False
+        for row, job in enumerate(self.queue.jobs):
+            if job.status == "running":
+                running = True
+                self._fill_row(row, job)
+        if not running:
+            self.timer.stop()
+        elif not self.timer.isActive():
+            self.timer.start()
+
+    def on_selection_changed(self):
+        job = self._selected_job()
+        if job and job.doc is not None and self.out_view.document() is not job.doc:
+            self.out_view.setDocument(job.doc)
+            self.out_view.moveCursor(QtGui.QTextCursor.MoveOperation.End)
+
+    def on_cancel(self):
+        job = self._selected_job()
+        if job:
+            self.queue.cancel(job)
+
+    def on_limit_changed(self, value: int):
+        self.queue.set_limit(value)
+        self.main.save_state()
+
+    def on_mode_changed(self, _index: int):
+        self.main.state.job_mode = self.mode_box.currentData()
+        self.main.save_state()
+
+    def on_backend_changed(self, _index: int):
+        self.main.state.exec_backend = self.backend_box.currentData()
+        self.main.save_state()
+
+
+def main(args: Optional[argparse.Namespace] = None):
+    args = args or parse_args()
+    STARTUP.enabled = args.startup_profile
+    STARTUP.mark("импорт модулей")
+
+    # Один экземпляр на пользователя: второй запуск показывает окно первого и выходит
+    if args.compact_history:
+        if ipc_running():
+            # Запущенное приложение дописывает в журнал и держит его индекс — сегменты не трогаем
+            print(f"❌ {APP_NAME} запущен: закройте его перед --compact-history", file=sys.stderr)
+            sys.exit(1)
+        log = HistoryLog()
+        before, after = log.compact()
+        log.close()
+        print(f"Сегментов журнала: {before} → {after}")
+        return
 
     app = QtWidgets.QApplication(sys.argv)
     app.setApplicationName(APP_NAME)
     app.setOrganizationName("OllamaChat")
     app.setApplicationVersion(APP_VERSION)
+    # Окно прячется в трей, а не закрывается; выход — только из меню
+    app.setQuitOnLastWindowClosed(False)
     
     # тема иконок
     QtGui.QIcon.setThemeSearchPaths(QtGui.QIcon.themeSearchPaths() + ["/usr/share/icons", "/usr/local/share/icons"])
     if not QtGui.QIcon.themeName():
         QtGui.QIcon.setThemeName("breeze")
-
-    w = MainWindow()
-    if args.minimize:
-        w.hide()
-    else:
-        w.show()
-
-    sys.exit(app.exec())
+    STARTUP.mark("QApplication")
+
+    # Один экземпляр: кто занял сокет, тот и работает; второй запуск будит окно первого
+    ipc = None
+    if ipc_available():
+        ipc = IpcServer(None)
+        status = ipc.listen()
+        if status == "running":
+            if not args.minimize:
+                for _ in ipc_request({"cmd": "show"}, timeout=10):
+                    pass
+            print(f"{APP_NAME} уже запущен", file=sys.stderr)
+            return
+        if status == "error":
+            print(f"⚠️ Локальный API недоступен: {ipc.server.errorString()}", file=sys.stderr)
+        STARTUP.mark("локальный API")
+
+    # Сначала трей; окно — сразу только при обычном старте, иначе по первому клику
+    tray = TrayIcon()
+    tray.show()
+    STARTUP.mark("трей")
+    if ipc:
+        ipc.tray = tray
+    if not args.minimize:
+        tray.window().show()
+    QtCore.QTimer.singleShot(0, lambda: STARTUP.mark("цикл событий запущен"))
+
+    rc = app.exec()
+    if ipc is not None:
+        ipc.close()
+    sys.exit(rc)
 
 
 if __name__ == "__main__":
     ensure_paths()
-    main()
+    main(ARGS)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+Клиент локального API запущенного Ollama Tray Chat (Unix‑сокет).
+
+Qt не загружается: вопрос уходит в уже открытое приложение, ответ
+печатается в stdout по мере генерации, а история пишется там же, где и
+при вводе в окне.
+
+  ollama_tray_ctl.py ask "как посмотреть открытые порты?"
+  echo "объясни этот лог" | ollama_tray_ctl.py ask -m qwen2.5:7b
+  ollama_tray_ctl.py models
+  ollama_tray_ctl.py suggestions          # команды из последнего ответа
+  ollama_tray_ctl.py run 0                # выполнить предложенную команду №0
+  ollama_tray_ctl.py show                 # показать окно
+
+Код возврата: 0 — успех, 1 — ошибка запроса или ответ остановлен,
+2 — приложение не запущено.
+"""
+import argparse
+import sys
+
+from ollama_core import ipc_request
+
+
+def cmd_ask(args) -> int:
+    prompt = " ".join(args.prompt) if args.prompt else sys.stdin.read()
+    request = {"cmd": "ask", "prompt": prompt.strip(), "model": args.model,
+               "new_tab": args.new_tab, "no_cache": args.no_cache}
+    rc = 1
+    for msg in ipc_request(request):
+        if "delta" in msg:
+            sys.stdout.write(msg["delta"])
+            sys.stdout.flush()
+        elif "error" in msg:
+            print(f"\n❌ {msg['error']}", file=sys.stderr)
+        elif msg.get("done"):
+            print()
+            if msg.get("stopped"):
+                print("⏹️ Ответ остановлен", file=sys.stderr)
+            else:
+                rc = 0
+            if args.verbose:
+                metrics = msg.get("metrics") or {}
+                source = "💾 из кэша" if msg.get("cached") else f"🖧 {msg.get('backend') or '—'}"
+                print(f"⏱️ TTFT {metrics.get('ttft_ms')} мс · {metrics.get('tokens_per_sec')} ток/с · {source}",
+                      file=sys.stderr)
+            for i, command in enumerate(msg.get("suggestions") or []):
+                print(f"💡 [{i}] {command}", file=sys.stderr)
+        elif "model" in msg and msg.get("queued"):
+            print(f"⏳ {msg['model']}: ждём свободного слота…", file=sys.stderr)
+    return rc
+
+
+def cmd_run(args) -> int:
+    target = args.target
+    request = {"cmd": "run"}
+    if target.isdigit():
+        request["index"] = int(target)
+    else:
+        request["command"] = target
+    rc = 1
+    for msg in ipc_request(request):
+        if "error" in msg and not msg.get("done"):
+            print(f"❌ {msg['error']}", file=sys.stderr)
+        elif "job" in msg:
+            print(f"▶️ {msg['command']}", file=sys.stderr)
+        elif msg.get("done"):
+            if msg.get("output"):
+                print(msg["output"])
+            if msg.get("error"):
+                print(f"❌ {msg['error']}", file=sys.stderr)
+            rc = 0 if msg.get("status") == "done" else (msg.get("returncode") or 1)
+    return rc
+
+
+def cmd_simple(args) -> int:
+    for msg in ipc_request({"cmd": args.cmd}):
+        if "error" in msg:
+            print(f"❌ {msg['error']}", file=sys.stderr)
+            return 1
+        if "models" in msg:
+            for name in msg["models"]:
+                print(f"{'*' if name == msg.get('current') else ' '} {name}")
+        elif "suggestions" in msg:
+            for i, command in enumerate(msg["suggestions"]):
+                print(f"[{i}] {command}")
+        elif "version" in msg:
+            print(f"версия {msg['version']}, pid {msg['pid']}")
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Клиент запущенного Ollama Tray Chat")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("ask", help="Задать вопрос (без аргументов — из stdin)")
+    p.add_argument("prompt", nargs="*")
+    p.add_argument("-m", "--model", help="Модель (по умолчанию выбранная в окне)")
+    p.add_argument("--new-tab", action="store_true", help="Открыть для вопроса новую вкладку")
+    p.add_argument("--no-cache", action="store_true", help="Не брать ответ из кэша")
+    p.add_argument("-v", "--verbose", action="store_true", help="Замеры ответа в stderr")
+    p.set_defaults(func=cmd_ask)
+
+    p = sub.add_parser("run", help="Выполнить предложенную команду (номер или текст)")
+    p.add_argument("target")
+    p.set_defaults(func=cmd_run)
+
+    for name, text in (("models", "Список моделей"), ("suggestions", "Предложенные команды"),
+                       ("show", "Показать окно"), ("ping", "Проверить, запущено ли приложение")):
+        sub.add_parser(name, help=text).set_defaults(func=cmd_simple)
+
+    args = parser.parse_args()
+    try:
+        return args.func(args)
+    except ConnectionError as e:
+        print(f"❌ {e}", file=sys.stderr)
+        return 2
+    except KeyboardInterrupt:
+        # Соединение закрыто — приложение остановит ответ само
+        return 130
+
+
+if __name__ == "__main__":
+    sys.exit(main())